@@ -59,8 +59,36 @@ class Settings(BaseSettings):
     TGBOT_REQUIRES_INVITE: bool = False
     TGBOT_WEBHOOK_URL: str | None = None
     TGBOT_WEBHOOK_SECRET_TOKEN: SecretStr | None = None
+    # Bot API server, e.g. bench.telegram_emulator for load tests
+    TGBOT_API_URL: str = "https://api.telegram.org"
+    # seconds to wait for follow-up messages before generating a post, 0 disables
+    TGBOT_DEBOUNCE_SECONDS: float = 0
     CORS_ALLOW_ORIGINS: list[str] = []
     LOGFIRE_TOKEN: SecretStr | None = None
+    # post generations recorded for bench.replay, secrets are redacted
+    POST_GENERATOR_RECORD_DIR: Path | None = None
+    # share of the jobs recorded
+    POST_GENERATOR_RECORD_RATE: float = 1
+    # bearer token of the /metrics scrapes, the API doesn't serve them when unset
+    METRICS_TOKEN: SecretStr | None = None
+    # port of the worker /metrics, not served when unset
+    WORKER_METRICS_PORT: int | None = None
+    # event loop lag metric and stack logging of the calls blocking the loop
+    LOOP_MONITOR: bool = False
+    LOOP_MONITOR_THRESHOLD_SECONDS: float = 0.25
+    # share of the jobs and requests profiled, see app.core.profiling
+    PROFILING_RATE: float = 0
+    # profiles are uploaded to the bucket when unset
+    PROFILING_DIR: Path | None = None
+    # ready drafts per active agent by the package of the latest purchase,
+    # "" for the users without one, see app.tg.agents.drafts
+    DRAFT_POOL_SIZES: dict[str, int] = {}
+    DRAFT_POOL_MAX_AGE_HOURS: float = 24
+    # UTC hours of the scheduled refill
+    DRAFT_POOL_HOURS: set[int] = {2, 3, 4, 5}
+    # images generated ahead per opted-in user a day, 0 disables,
+    # see app.tg.agents.speculative_images
+    SPECULATIVE_IMAGES_DAILY_BUDGET: int = 0
 
     # JWT
     JWT: JWTSettings = JWTSettings()
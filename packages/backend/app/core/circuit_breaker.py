@@ -0,0 +1,266 @@
+import asyncio
+import enum
+import time
+from collections.abc import Awaitable, Callable
+
+import structlog
+from pydantic import BaseModel
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.core.errors import CircuitOpenError, StageTimeoutError
+from app.core.metrics import counter, gauge
+from app.core.redis import get_redis
+from app.core.retry import classify_error, retry_call
+
+logger = structlog.get_logger()
+
+BREAKER_STATE = gauge(
+    "circuit_breaker_state",
+    "Circuit breaker state as seen by this process: 0 closed, 1 half-open, 2 open",
+    ("name",),
+)
+BREAKER_REJECTED = counter(
+    "circuit_breaker_rejected_total",
+    "Calls rejected by an open circuit breaker",
+    ("name",),
+)
+BREAKER_OPENED = counter(
+    "circuit_breaker_opened_total",
+    "Times a circuit breaker was opened by this process",
+    ("name",),
+)
+
+
+class CircuitState(int, enum.Enum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitBreakerConfig(BaseModel):
+    # open when this share of calls in the window fails
+    failure_rate: float = 0.5
+    # open when this share of calls in the window is slower than slow_call_seconds
+    slow_call_rate: float = 0.8
+    slow_call_seconds: float = 30
+    # don't judge the provider by a couple of calls
+    min_calls: int = 5
+    window_seconds: int = 60
+    # how long to reject calls before letting a probe through
+    open_seconds: int = 30
+    probe_timeout_seconds: int = 60
+
+
+class CircuitBreaker:
+    """
+    Closed -> open -> half-open circuit breaker.
+    The state lives in Redis so all API, bot and worker processes share it.
+
+    Keys:
+        {prefix}:open       exists while the circuit is open (TTL = open_seconds)
+        {prefix}:half_open  exists from opening until a probe succeeds
+        {prefix}:probe      taken by the single caller allowed to probe
+        {prefix}:w:{n}      call outcomes in the n-th window
+    """
+
+    def __init__(
+        self,
+        name: str,
+        config: CircuitBreakerConfig | None = None,
+        redis: Redis | None = None,
+    ) -> None:
+        self.name = name
+        self.config = config or CircuitBreakerConfig()
+        self._redis = redis
+        self._prefix = f"viralink:breaker:{name}"
+
+    @property
+    def redis(self) -> Redis:
+        return self._redis or get_redis()
+
+    async def state(self) -> CircuitState:
+        try:
+            is_open, is_half_open = await self.redis.mget(
+                f"{self._prefix}:open", f"{self._prefix}:half_open"
+            )
+        except RedisError as e:
+            logger.warning(f"Circuit breaker {self.name} state is unavailable: {e}")
+            return CircuitState.CLOSED
+        if is_open:
+            state = CircuitState.OPEN
+        elif is_half_open:
+            state = CircuitState.HALF_OPEN
+        else:
+            state = CircuitState.CLOSED
+        BREAKER_STATE.set(state.value, name=self.name)
+        return state
+
+    async def call[T](
+        self,
+        func: Callable[[], Awaitable[T]],
+        *,
+        is_failure: Callable[[Exception], bool] | None = None,
+    ) -> T:
+        """
+        Raises CircuitOpenError without calling the provider while the circuit is open
+
+        is_failure: decides if an error counts against the provider,
+            by default only transient errors and timeouts do
+        """
+        state = await self.state()
+        is_probe = False
+        if state == CircuitState.OPEN:
+            BREAKER_REJECTED.inc(name=self.name)
+            raise CircuitOpenError(
+                f"Circuit {self.name} is open",
+                code=CircuitOpenError.code,
+                breaker=self.name,
+            )
+        if state == CircuitState.HALF_OPEN:
+            is_probe = await self._take_probe()
+            if not is_probe:
+                BREAKER_REJECTED.inc(name=self.name)
+                raise CircuitOpenError(
+                    f"Circuit {self.name} is half-open, probe in progress",
+                    code=CircuitOpenError.code,
+                    breaker=self.name,
+                )
+
+        started_at = time.monotonic()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            # cancelled by a stage timeout or by the user, the provider didn't
+            # answer: a probe gives the slot back, a call counts only if slow
+            if is_probe:
+                await self._release_probe()
+            else:
+                await self._record(False, failed=False, started_at=started_at)
+            raise
+        except Exception as e:
+            failed = (is_failure or _is_provider_failure)(e)
+            await self._record(is_probe, failed=failed, started_at=started_at)
+            raise
+        await self._record(is_probe, failed=False, started_at=started_at)
+        return result
+
+    async def _take_probe(self) -> bool:
+        try:
+            return bool(
+                await self.redis.set(
+                    f"{self._prefix}:probe",
+                    1,
+                    nx=True,
+                    ex=self.config.probe_timeout_seconds,
+                )
+            )
+        except RedisError:
+            return True
+
+    async def _release_probe(self) -> None:
+        try:
+            await self.redis.delete(f"{self._prefix}:probe")
+        except RedisError as e:
+            logger.warning(f"Circuit breaker {self.name} can't release a probe: {e}")
+
+    async def _record(self, is_probe: bool, *, failed: bool, started_at: float) -> None:
+        slow = (time.monotonic() - started_at) >= self.config.slow_call_seconds
+        try:
+            if is_probe:
+                if failed or slow:
+                    await self._open()
+                else:
+                    await self._close()
+                return
+
+            window = int(time.time()) // self.config.window_seconds
+            key = f"{self._prefix}:w:{window}"
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.hincrby(key, "calls", 1)
+                if failed:
+                    pipe.hincrby(key, "failures", 1)
+                if slow:
+                    pipe.hincrby(key, "slow", 1)
+                pipe.expire(key, self.config.window_seconds * 2)
+                pipe.hgetall(key)
+                *_, stats = await pipe.execute()
+
+            calls = int(stats.get(b"calls", 0))
+            if calls < self.config.min_calls:
+                return
+            failure_rate = int(stats.get(b"failures", 0)) / calls
+            slow_call_rate = int(stats.get(b"slow", 0)) / calls
+            if (
+                failure_rate >= self.config.failure_rate
+                or slow_call_rate >= self.config.slow_call_rate
+            ):
+                await self._open()
+        except RedisError as e:
+            logger.warning(f"Circuit breaker {self.name} can't record a call: {e}")
+
+    async def _open(self) -> None:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(f"{self._prefix}:open", 1, ex=self.config.open_seconds)
+            pipe.set(f"{self._prefix}:half_open", 1, ex=24 * 60 * 60)
+            pipe.delete(f"{self._prefix}:probe")
+            await pipe.execute()
+        BREAKER_OPENED.inc(name=self.name)
+        BREAKER_STATE.set(CircuitState.OPEN.value, name=self.name)
+        logger.warning(f"Circuit breaker {self.name} is open")
+
+    async def _close(self) -> None:
+        window = int(time.time()) // self.config.window_seconds
+        await self.redis.delete(
+            f"{self._prefix}:half_open",
+            f"{self._prefix}:probe",
+            f"{self._prefix}:w:{window}",
+        )
+        BREAKER_STATE.set(CircuitState.CLOSED.value, name=self.name)
+        logger.info(f"Circuit breaker {self.name} is closed")
+
+
+PROVIDER_BREAKERS: dict[str, CircuitBreakerConfig] = {
+    "openai": CircuitBreakerConfig(slow_call_seconds=60),
+    "replicate": CircuitBreakerConfig(slow_call_seconds=90),
+    "google": CircuitBreakerConfig(slow_call_seconds=10),
+    "duckduckgo": CircuitBreakerConfig(slow_call_seconds=10),
+    # per scraped host, see Scraper
+    "scraper": CircuitBreakerConfig(min_calls=3, slow_call_seconds=20),
+}
+
+MAX_BREAKERS = 1024
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def circuit_breaker(name: str, *, kind: str | None = None) -> CircuitBreaker:
+    """
+    Returns the breaker for the provider,
+    kind selects the config when the name is more specific (e.g. "scraper:example.com")
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        if len(_breakers) >= MAX_BREAKERS:
+            # breakers are stateless wrappers around Redis keys, safe to drop
+            _breakers.clear()
+        config = PROVIDER_BREAKERS.get(kind or name)
+        breaker = _breakers[name] = CircuitBreaker(name, config)
+    return breaker
+
+
+async def call_provider[T](
+    provider: str,
+    func: Callable[[], Awaitable[T]],
+    *,
+    breaker: str | None = None,
+) -> T:
+    """
+    Calls an external provider through its circuit breaker with the retry policy
+    """
+    circuit = circuit_breaker(breaker or provider, kind=provider)
+    return await retry_call(provider, lambda: circuit.call(func))
+
+
+def _is_provider_failure(error: Exception) -> bool:
+    return isinstance(error, StageTimeoutError) or classify_error(error).retryable
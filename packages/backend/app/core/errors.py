@@ -30,3 +30,18 @@ class ForbiddenError(AppError):
 class UserIsBlockedError(AppError):
     message = "User is blocked"
     code = "user_blocked"
+
+
+class StageTimeoutError(AppError):
+    message = "Stage timed out"
+    code = "stage_timeout"
+
+
+class CircuitOpenError(AppError):
+    message = "Circuit is open"
+    code = "circuit_open"
+
+
+class JobCancelledError(AppError):
+    message = "Job was cancelled"
+    code = "job_cancelled"
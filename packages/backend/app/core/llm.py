@@ -1,37 +1,91 @@
+from collections.abc import Sequence
 from functools import lru_cache
-from typing import Literal, TypeAlias, TypeVar
+from typing import Any, Literal, TypeAlias, TypeVar
 
 import structlog
 from langchain_community.llms import Replicate
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, SecretStr, TypeAdapter
 from ruamel.yaml import YAML
 
 from app.conf import settings
+from app.core.circuit_breaker import call_provider
+from app.core.telemetry import record_cache
 
 logger = structlog.get_logger()
 
-LLMModel: TypeAlias = ChatOpenAI
-ImageLLMModel: TypeAlias = Replicate
+
+class RetryingChatOpenAI(ChatOpenAI):
+    """
+    Calls OpenAI through its circuit breaker and retries transient errors
+    with the shared retry policy instead of the OpenAI client's own retries
+    """
+
+    max_retries: int | None = 0
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        agenerate = super()._agenerate
+        return await call_provider(
+            "openai", lambda: agenerate(messages, stop, run_manager, **kwargs)
+        )
+
+
+class RetryingReplicate(Replicate):  # type: ignore[misc]
+    """
+    Calls Replicate through its circuit breaker
+    and retries throttling and transient errors with the shared retry policy
+    """
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> str:
+        acall = super()._acall
+        return await call_provider(
+            "replicate", lambda: acall(prompt, stop, run_manager, **kwargs)
+        )
+
+
+LLMModel: TypeAlias = RetryingChatOpenAI
+ImageLLMModel: TypeAlias = RetryingReplicate
 
 LLMModelName = Literal["gpt-4o", "o4-mini", "o3"]
 ImageLLMModelName = Literal["recraft-ai/recraft-v3"]
 
 
+@lru_cache
 def get_llm(model: LLMModelName = "gpt-4o") -> LLMModel:
+    """
+    Clients are shared, each holds its own HTTP connection pool
+    """
     match model:
         case "gpt-4o":
-            return ChatOpenAI(
+            return RetryingChatOpenAI(
                 api_key=settings.OPENAI_API_KEY,
                 model="gpt-4o",
             )
         case "o4-mini":
-            return ChatOpenAI(
+            return RetryingChatOpenAI(
                 api_key=settings.OPENAI_API_KEY,
                 model="o4-mini",
             )
         case "o3":
-            return ChatOpenAI(
+            return RetryingChatOpenAI(
                 api_key=settings.OPENAI_API_KEY,
                 model="o3",
             )
@@ -39,15 +93,37 @@ def get_llm(model: LLMModelName = "gpt-4o") -> LLMModel:
             raise ValueError(f"Unsupported model: {model}")
 
 
+@lru_cache
 def get_image_llm(model: ImageLLMModelName = "recraft-ai/recraft-v3") -> ImageLLMModel:
     match model:
         case "recraft-ai/recraft-v3":
             _set_replicate_key(settings.REPLICATE_API_KEY)
-            return Replicate(model=model, model_kwargs={"size": "1365x1024"})
+            return RetryingReplicate(model=model, model_kwargs={"size": "1365x1024"})
         case _:
             raise ValueError(f"Unsupported model: {model}")
 
 
+_llms_with_tools: dict[
+    tuple[LLMModelName, tuple[type[BaseTool], ...]],
+    Runnable[LanguageModelInput, BaseMessage],
+] = {}
+
+
+def get_llm_with_tools(
+    model: LLMModelName, tools: Sequence[BaseTool]
+) -> Runnable[LanguageModelInput, BaseMessage]:
+    """
+    Tool schemas depend only on the tool classes, they are converted once per model.
+    Call the tools through the instances of the job.
+    """
+    key = (model, tuple(type(tool) for tool in tools))
+    llm = _llms_with_tools.get(key)
+    record_cache("llm_with_tools", hit=llm is not None)
+    if llm is None:
+        llm = _llms_with_tools[key] = get_llm(model).bind_tools(list(tools))
+    return llm
+
+
 def _set_replicate_key(replicate_api_key: SecretStr) -> None:
     """
     LangChain bug: https://github.com/langchain-ai/langchain/pull/27859
@@ -0,0 +1,119 @@
+"""
+Event loop lag monitor
+
+A task wakes up every interval and observes how late it was scheduled, which is
+the time other coroutines held the loop. A watchdog thread checks the heartbeat
+of that task and, once the loop is stalled for longer than the threshold, logs
+the stack of the loop thread, i.e. of the blocking call, while it still blocks.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+import structlog
+
+from app.conf import settings
+from app.core.metrics import counter, histogram
+
+logger = structlog.get_logger()
+
+LOOP_LAG = histogram(
+    "event_loop_lag_seconds",
+    "Delay of the event loop wake-ups",
+    ("process",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_BLOCKS = counter(
+    "event_loop_blocks_total",
+    "Event loop stalls longer than LOOP_MONITOR_THRESHOLD_SECONDS",
+    ("process",),
+)
+# frames of the loop thread in the log, the innermost ones
+STACK_LIMIT = 30
+
+
+class LoopMonitor:
+    def __init__(
+        self,
+        process: str,
+        *,
+        interval: float = 0.1,
+        threshold: float = 0.25,
+    ) -> None:
+        self.process = process
+        self.interval = interval
+        self.threshold = threshold
+        self._heartbeat = time.monotonic()
+        self._stopped = threading.Event()
+        self._task: asyncio.Task[None] | None = None
+        self._watchdog: threading.Thread | None = None
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._sample())
+        self._watchdog = threading.Thread(
+            target=self._watch,
+            args=(loop, threading.get_ident()),
+            name="loop-watchdog",
+            daemon=True,
+        )
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._watchdog:
+            await asyncio.to_thread(self._watchdog.join)
+
+    async def _sample(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._heartbeat = now
+            lag = max(now - expected, 0)
+            LOOP_LAG.observe(lag, process=self.process)
+            if lag >= self.threshold:
+                LOOP_BLOCKS.inc(process=self.process)
+                logger.warning(
+                    f"Event loop was blocked for {lag:.3f}s", process=self.process
+                )
+
+    def _watch(self, loop: asyncio.AbstractEventLoop, thread_id: int) -> None:
+        reported = 0.0
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            # a stall is reported once, while it lasts
+            if stalled < self.threshold or heartbeat == reported:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                return
+            task = asyncio.current_task(loop)
+            stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT))
+            # in a field, long events are truncated by the logging
+            logger.warning(
+                f"Event loop is blocked for {stalled:.3f}s in "
+                f"{task.get_name() if task else 'a callback'}",
+                process=self.process,
+                stack=stack,
+            )
+
+
+def start_loop_monitor(process: str) -> LoopMonitor | None:
+    """
+    Starts the monitor of the running loop if LOOP_MONITOR is set
+    """
+    if not settings.LOOP_MONITOR:
+        return None
+    monitor = LoopMonitor(process, threshold=settings.LOOP_MONITOR_THRESHOLD_SECONDS)
+    monitor.start()
+    return monitor
@@ -0,0 +1,231 @@
+"""
+In-process metrics registry
+
+Metrics are plain in-memory counters, gauges and histograms keyed by label values,
+updating them is a dict lookup, so they are safe to use on hot paths.
+Values that are cheaper to read when scraped (pool sizes, queue depth)
+are set by the collectors, see Registry.add_collector.
+render_text() exposes the registry in the Prometheus text format.
+"""
+
+import bisect
+import inspect
+import math
+import threading
+from collections.abc import Awaitable, Callable, Iterator
+
+import structlog
+
+logger = structlog.get_logger()
+
+LabelValues = tuple[str, ...]
+Collector = Callable[[], Awaitable[None] | None]
+
+# seconds, from a cache lookup to an image generation
+DEFAULT_BUCKETS = (
+    *(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5),
+    *(1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+
+class Metric:
+    type_: str = "untyped"
+
+    def __init__(
+        self, name: str, description: str, labels: tuple[str, ...] = ()
+    ) -> None:
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values: dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        if labels.keys() != set(self.labels):
+            raise ValueError(
+                f"Metric {self.name} expects labels {self.labels}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[tuple[dict[str, str], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield dict(zip(self.labels, key, strict=True)), value
+
+
+class Counter(Metric):
+    type_ = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_ = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Counts observations by bucket, the buckets are cumulated when rendered
+    """
+
+    type_ = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count by bucket..., count above the last bucket]
+        self._counts: dict[LabelValues, list[int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            # _values holds the sum
+            self._values[key] = self._values.get(key, 0) + value
+
+    def histograms(self) -> Iterator[tuple[dict[str, str], list[int], float]]:
+        with self._lock:
+            items = [
+                (key, list(counts), self._values[key])
+                for key, counts in self._counts.items()
+            ]
+        for key, counts, total in items:
+            yield dict(zip(self.labels, key, strict=True)), counts, total
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: list[Collector] = []
+
+    def register[M: Metric](self, metric: M) -> M:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labels != metric.labels:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            return existing  # type: ignore[return-value]
+        self._metrics[metric.name] = metric
+        return metric
+
+    def metrics(self) -> list[Metric]:
+        return list(self._metrics.values())
+
+    def add_collector(self, collector: Collector) -> None:
+        """
+        The collector runs before every scrape and sets its gauges
+        """
+        self._collectors.append(collector)
+
+    async def collect(self) -> None:
+        for collector in self._collectors:
+            try:
+                result = collector()
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                # the other metrics are still worth scraping
+                logger.warning(f"Metrics collector failed: {e}")
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, description: str, labels: tuple[str, ...] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, description, labels))
+
+
+def gauge(name: str, description: str, labels: tuple[str, ...] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, description, labels))
+
+
+def histogram(
+    name: str,
+    description: str,
+    labels: tuple[str, ...] = (),
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+) -> Histogram:
+    return REGISTRY.register(Histogram(name, description, labels, buckets))
+
+
+def render_text(registry: Registry = REGISTRY) -> str:
+    """
+    Prometheus text exposition format 0.0.4
+    """
+    lines = []
+    for metric in registry.metrics():
+        lines.append(f"# HELP {metric.name} {_escape(metric.description, quote=False)}")
+        lines.append(f"# TYPE {metric.name} {metric.type_}")
+        if isinstance(metric, Histogram):
+            for labels, counts, total in metric.histograms():
+                cumulative = 0
+                for bound, count in zip(
+                    (*metric.buckets, math.inf), counts, strict=True
+                ):
+                    cumulative += count
+                    bucket_labels = {**labels, "le": _format_value(bound)}
+                    lines.append(
+                        f"{metric.name}_bucket{_format_labels(bucket_labels)} "
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f"{metric.name}_sum{_format_labels(labels)} {_format_value(total)}"
+                )
+                lines.append(
+                    f"{metric.name}_count{_format_labels(labels)} {cumulative}"
+                )
+            continue
+        for labels, value in metric.samples():
+            lines.append(
+                f"{metric.name}{_format_labels(labels)} {_format_value(value)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isfinite(value) and value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str, quote: bool = True) -> str:
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quote else value
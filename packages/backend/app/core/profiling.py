@@ -0,0 +1,267 @@
+"""
+Sampled stack profiling of jobs and requests
+
+A share of the jobs and requests (PROFILING_RATE, or the admin toggle in Redis
+that overrides it until it expires) is profiled by a thread that samples the
+stack of the event loop thread every few milliseconds. A sample counts when the
+running task belongs to the profiled job or request, the tasks it spawned
+included, and is attributed to the stage of that task.
+
+The samples are written in the collapsed format of flamegraph.pl and speedscope,
+{id}.collapsed, next to {id}.json with the job id, the stage timings and the
+sample counts, to PROFILING_DIR or to the bucket under profiles/.
+"""
+
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import FrameType
+from typing import Any
+from uuid import uuid4
+
+import structlog
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.conf import settings
+from app.core.redis import get_redis
+from app.core.storage import upload_stream
+from app.core.telemetry import current_telemetry
+from app.core.timeouts import stage_of
+from app.models.base import utc_now
+
+logger = structlog.get_logger()
+
+CONFIG_KEY = "viralink:profiling"
+# seconds between the reads of the admin toggle
+CONFIG_REFRESH = 10
+# seconds between the samples
+SAMPLE_INTERVAL = 0.005
+STACK_LIMIT = 128
+
+_active_profile: ContextVar["StackSampler | None"] = ContextVar(
+    "active_profile", default=None
+)
+
+
+class ProfilingConfig(BaseModel):
+    # share of the jobs and requests profiled
+    rate: float = 0
+    # set by the admin toggle
+    until: datetime | None = None
+
+
+class StackSampler:
+    """
+    Samples the loop thread while a task of the profile runs on it
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._sample,
+            args=(asyncio.get_running_loop(), threading.get_ident()),
+            name="stack-sampler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+
+    def _sample(self, loop: asyncio.AbstractEventLoop, thread_id: int) -> None:
+        while not self._stopped.wait(self.interval):
+            self.samples += 1
+            task = asyncio.current_task(loop)
+            if task is None:
+                continue
+            context = task.get_context()
+            if context.get(_active_profile) is not self:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                return
+            stage = stage_of(context) or "-"
+            self.stacks[f"stage:{stage};{_collapse(frame)}"] += 1
+
+
+def _collapse(frame: FrameType) -> str:
+    names: list[str] = []
+    current: FrameType | None = frame
+    while current is not None and len(names) < STACK_LIMIT:
+        code = current.f_code
+        module = current.f_globals.get("__name__", code.co_filename)
+        names.append(f"{module}.{code.co_qualname}")
+        current = current.f_back
+    # root first, the asyncio machinery above the task is the same for every sample
+    names.reverse()
+    return ";".join(names)
+
+
+_config: tuple[float, ProfilingConfig] | None = None
+
+
+async def profiling_config() -> ProfilingConfig:
+    """
+    The admin toggle if it's set, PROFILING_RATE otherwise
+    """
+    global _config
+    now = time.monotonic()
+    if _config is not None and now - _config[0] < CONFIG_REFRESH:
+        return _config[1]
+    config = ProfilingConfig(rate=settings.PROFILING_RATE)
+    try:
+        if data := await get_redis().get(CONFIG_KEY):
+            config = ProfilingConfig.model_validate_json(data)
+    except RedisError as e:
+        logger.warning(f"Profiling toggle is unavailable: {e}")
+    _config = (now, config)
+    return config
+
+
+async def set_profiling(rate: float, seconds: int) -> ProfilingConfig:
+    config = ProfilingConfig(rate=rate, until=utc_now() + timedelta(seconds=seconds))
+    await get_redis().set(CONFIG_KEY, config.model_dump_json(), ex=seconds)
+    return config
+
+
+async def reset_profiling() -> None:
+    await get_redis().delete(CONFIG_KEY)
+
+
+@asynccontextmanager
+async def profile(
+    kind: str, name: str, **metadata: Any
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Profiles the block with the configured probability,
+    the metadata it yields can be completed by the block
+    """
+    metadata = {"kind": kind, "name": name, **metadata}
+    config = await profiling_config()
+    if random.random() >= config.rate or _active_profile.get() is not None:
+        yield metadata
+        return
+
+    sampler = StackSampler()
+    token = _active_profile.set(sampler)
+    started_at = utc_now()
+    sampler.start()
+    try:
+        yield metadata
+    finally:
+        sampler.stop()
+        _active_profile.reset(token)
+        telemetry = current_telemetry()
+        metadata.update(
+            started_at=started_at.isoformat(),
+            seconds=(utc_now() - started_at).total_seconds(),
+            interval=sampler.interval,
+            samples=sampler.samples,
+            task_samples=sum(sampler.stacks.values()),
+            stages=[stage.model_dump() for stage in telemetry.snapshot().stages]
+            if telemetry
+            else [],
+        )
+        await _save(sampler, metadata)
+
+
+async def _save(sampler: StackSampler, metadata: dict[str, Any]) -> None:
+    """
+    Best effort, the job result doesn't depend on it
+    """
+    name = f"{metadata['started_at'][:10]}/{metadata['kind']}-{uuid4()}"
+    collapsed = "".join(f"{stack} {count}\n" for stack, count in sampler.stacks.items())
+    files = {
+        f"{name}.collapsed": collapsed.encode(),
+        f"{name}.json": json.dumps(metadata, default=str).encode(),
+    }
+    try:
+        for path, data in files.items():
+            if settings.PROFILING_DIR is not None:
+                await asyncio.to_thread(_write, settings.PROFILING_DIR / path, data)
+            else:
+                await upload_stream(f"profiles/{path}", _chunks(data), "text/plain")
+    except Exception as e:
+        logger.warning(f"Can't save profile: {e}", name=name)
+    else:
+        logger.info(f"Profile saved: {name}", profile_name=metadata["name"])
+
+
+async def _chunks(data: bytes) -> AsyncGenerator[bytes, None]:
+    yield data
+
+
+def _write(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the sampled requests, the route is known only after the routing
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        async with profile("request", scope["path"], method=scope["method"]) as meta:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                if route := scope.get("route"):
+                    meta["name"] = route.path
+
+
+_snapshot: tracemalloc.Snapshot | None = None
+
+
+def tracemalloc_diff(limit: int = 20, stop: bool = False) -> str:
+    """
+    Starts tracing on the first call, then returns the allocations by line
+    that grew the most since the previous call
+    """
+    global _snapshot
+    if stop:
+        tracemalloc.stop()
+        _snapshot = None
+        return "tracemalloc stopped\n"
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _snapshot = tracemalloc.take_snapshot()
+        return "tracemalloc started, call again for the diff\n"
+
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    previous, _snapshot = _snapshot, snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    lines = [f"traced {current / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB"]
+    if previous is not None:
+        lines.extend(
+            str(diff) for diff in snapshot.compare_to(previous, "lineno")[:limit]
+        )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,145 @@
+"""
+Prometheus scraping of app.core.metrics
+
+The API serves /metrics from the FastAPI app, every worker from its own side
+HTTP port (WORKER_METRICS_PORT). A scrape runs the collectors and renders the
+registry, nothing leaves the process otherwise.
+"""
+
+import asyncio
+import hmac
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+from urllib.parse import parse_qsl
+
+import structlog
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.conf import settings
+from app.core.metrics import REGISTRY, histogram, render_text
+
+logger = structlog.get_logger()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds to read a request of the side port
+READ_TIMEOUT = 5
+
+# query parameters -> text body
+Route = Callable[[dict[str, str]], Awaitable[str]]
+
+HTTP_REQUEST_DURATION = histogram(
+    "http_request_duration_seconds",
+    "HTTP requests of the API by route template",
+    ("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware, the route is known only after the routing
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - started_at,
+                method=scope["method"],
+                # unmatched paths would make a label value per scanned URL
+                route=getattr(route, "path", "unmatched"),
+                status=str(status),
+            )
+
+
+def is_authorized(authorization: str | None, *, public: bool = False) -> bool:
+    """
+    The scrape needs "Authorization: Bearer <METRICS_TOKEN>", without the token
+    a public endpoint is closed and only the unexposed worker port is served
+    """
+    if settings.METRICS_TOKEN is None:
+        return not public
+    expected = f"Bearer {settings.METRICS_TOKEN.get_secret_value()}"
+    return authorization is not None and hmac.compare_digest(
+        authorization.encode(), expected.encode()
+    )
+
+
+async def scrape() -> str:
+    await REGISTRY.collect()
+    return render_text()
+
+
+async def start_metrics_server(
+    host: str, port: int, routes: dict[str, Route] | None = None
+) -> asyncio.Server:
+    """
+    Serves GET /metrics for processes without an HTTP server, e.g. arq workers,
+    and the extra debug routes behind the same token. A route raises ValueError
+    on the invalid query, it's answered with 400
+    """
+    routes = {"/metrics": lambda _: scrape(), **(routes or {})}
+
+    async def handle(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        await _handle_request(reader, writer, routes)
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Metrics are served on {host}:{port}/metrics")
+    return server
+
+
+async def _handle_request(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    routes: dict[str, Route],
+) -> None:
+    try:
+        async with asyncio.timeout(READ_TIMEOUT):
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers: dict[str, Any] = {}
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+        target = request_line[1] if len(request_line) > 1 else ""
+        path, _, query = target.partition("?")
+        route = routes.get(path)
+        if request_line[:1] != ["GET"] or route is None:
+            status, body = "404 Not Found", b"Not Found\n"
+        elif not is_authorized(headers.get("authorization")):
+            status, body = "401 Unauthorized", b"Unauthorized\n"
+        else:
+            try:
+                status, body = "200 OK", (await route(dict(parse_qsl(query)))).encode()
+            except ValueError as e:
+                status, body = "400 Bad Request", f"{e}\n".encode()
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
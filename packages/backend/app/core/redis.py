@@ -0,0 +1,15 @@
+from functools import lru_cache
+
+from redis.asyncio import Redis
+
+from app.conf import settings
+
+
+@lru_cache(maxsize=1)
+def get_redis() -> Redis:
+    """
+    Shared Redis client for the places that don't get a connection from the context
+    (LLM clients, tools)
+    """
+    redis: Redis = Redis.from_url(settings.REDIS_URL.get_secret_value())
+    return redis
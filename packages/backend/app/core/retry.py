@@ -0,0 +1,250 @@
+import asyncio
+import random
+import time
+from collections.abc import Awaitable, Callable, Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+from typing import NamedTuple
+
+import httpx
+import openai
+import structlog
+from duckduckgo_search.exceptions import (
+    RatelimitException as DuckDuckGoRatelimitError,
+)
+from duckduckgo_search.exceptions import (
+    TimeoutException as DuckDuckGoTimeoutError,
+)
+from googleapiclient.errors import HttpError as GoogleHttpError
+from pydantic import BaseModel
+from replicate.exceptions import ReplicateError
+from telegram import error as telegram_error
+
+from app.core.metrics import counter, histogram
+from app.core.telemetry import record_retry
+
+logger = structlog.get_logger()
+
+RETRIES = counter(
+    "external_call_retries_total",
+    "Retries of external provider calls",
+    ("provider", "error"),
+)
+RETRIES_GIVEN_UP = counter(
+    "external_call_retries_given_up_total",
+    "External provider calls failed with a retryable error but were not retried",
+    ("provider", "reason"),
+)
+
+EXTERNAL_CALL_DURATION = histogram(
+    "external_call_duration_seconds",
+    "Attempts of external provider calls",
+    ("provider", "result"),
+)
+
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# the request failed before it was sent, it's safe to repeat any call
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class RetryPolicy(BaseModel):
+    max_attempts: int = 4
+    # seconds
+    base_delay: float = 0.5
+    max_delay: float = 20
+    multiplier: float = 2
+    # don't wait for the provider longer than this, fail fast instead
+    max_retry_after: float = 60
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        """
+        Exponential backoff with full jitter, never shorter than Retry-After
+        """
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        delay = random.uniform(0, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class RetryDecision(NamedTuple):
+    retryable: bool
+    retry_after: float | None = None
+
+
+class RetryBudget:
+    """
+    Amount of retries that a single job may spend across all providers
+    """
+
+    def __init__(self, retries: int) -> None:
+        self.retries = retries
+        self.spent = 0
+
+    def take(self) -> bool:
+        if self.spent >= self.retries:
+            return False
+        self.spent += 1
+        return True
+
+
+_retry_budget: ContextVar[RetryBudget | None] = ContextVar("retry_budget", default=None)
+
+
+@contextmanager
+def retry_budget(retries: int) -> Generator[RetryBudget, None, None]:
+    budget = RetryBudget(retries)
+    token = _retry_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _retry_budget.reset(token)
+
+
+@contextmanager
+def external_call(provider: str) -> Generator[None, None, None]:
+    """
+    Observes the latency of a single attempt of a provider call
+    """
+    started_at = time.perf_counter()
+    result = "error"
+    try:
+        yield
+        result = "ok"
+    finally:
+        EXTERNAL_CALL_DURATION.observe(
+            time.perf_counter() - started_at, provider=provider, result=result
+        )
+
+
+def classify_error(error: BaseException, *, idempotent: bool = True) -> RetryDecision:
+    """
+    idempotent: False for the calls that must not be repeated once the provider
+    may have got them (e.g. sending a message), only the errors that guarantee
+    it didn't are retried then
+    """
+    decision = _classify_error(error)
+    if decision.retryable and not idempotent and not _was_not_sent(error):
+        return RetryDecision(False)
+    return decision
+
+
+def _was_not_sent(error: BaseException) -> bool:
+    # PTB wraps the httpx errors into TimedOut and NetworkError
+    return isinstance(error, telegram_error.RetryAfter) or isinstance(
+        error.__cause__ or error, NOT_SENT_ERRORS
+    )
+
+
+def _classify_error(error: BaseException) -> RetryDecision:
+    match error:
+        # Telegram, BadRequest and Forbidden are subclasses of NetworkError
+        case telegram_error.RetryAfter():
+            return RetryDecision(True, _seconds(error.retry_after))
+        case telegram_error.BadRequest() | telegram_error.Forbidden():
+            return RetryDecision(False)
+        case telegram_error.TimedOut() | telegram_error.NetworkError():
+            return RetryDecision(True)
+        # OpenAI
+        case openai.RateLimitError() | openai.InternalServerError():
+            return RetryDecision(True, _retry_after(error.response.headers))
+        case openai.APIConnectionError():
+            # includes openai.APITimeoutError
+            return RetryDecision(True)
+        case openai.APIStatusError():
+            return RetryDecision(
+                error.status_code in RETRYABLE_STATUSES,
+                _retry_after(error.response.headers),
+            )
+        # Replicate
+        case ReplicateError():
+            return RetryDecision(error.status in RETRYABLE_STATUSES)
+        # Google Custom Search
+        case GoogleHttpError():
+            return RetryDecision(
+                error.resp.status in RETRYABLE_STATUSES,
+                _retry_after(error.resp),
+            )
+        # DuckDuckGo
+        case DuckDuckGoRatelimitError() | DuckDuckGoTimeoutError():
+            return RetryDecision(True)
+        case httpx.TimeoutException() | httpx.NetworkError():
+            return RetryDecision(True)
+        case httpx.HTTPStatusError():
+            return RetryDecision(
+                error.response.status_code in RETRYABLE_STATUSES,
+                _retry_after(error.response.headers),
+            )
+    return RetryDecision(False)
+
+
+async def retry_call[T](
+    provider: str,
+    func: Callable[[], Awaitable[T]],
+    *,
+    policy: RetryPolicy = DEFAULT_RETRY_POLICY,
+    idempotent: bool = True,
+) -> T:
+    """
+    Calls the provider and retries transient errors with backoff.
+    Retries are limited by the policy and by the retry budget of the current job.
+    idempotent: see classify_error
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            with external_call(provider):
+                return await func()
+        except Exception as e:
+            decision = classify_error(e, idempotent=idempotent)
+            if not decision.retryable:
+                raise
+
+            if attempt >= policy.max_attempts:
+                RETRIES_GIVEN_UP.inc(provider=provider, reason="max_attempts")
+                raise
+            if (
+                decision.retry_after is not None
+                and decision.retry_after > policy.max_retry_after
+            ):
+                RETRIES_GIVEN_UP.inc(provider=provider, reason="retry_after")
+                raise
+            budget = _retry_budget.get()
+            if budget is not None and not budget.take():
+                RETRIES_GIVEN_UP.inc(provider=provider, reason="budget")
+                raise
+
+            delay = policy.backoff(attempt, decision.retry_after)
+            RETRIES.inc(provider=provider, error=type(e).__name__)
+            record_retry(provider)
+            logger.warning(
+                f"Retrying {provider} call in {delay:.2f}s after {type(e).__name__}",
+                provider=provider,
+                attempt=attempt,
+            )
+            await asyncio.sleep(delay)
+
+
+def _seconds(value: int | float | timedelta) -> float:
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+def _retry_after(headers: object) -> float | None:
+    get = getattr(headers, "get", None)
+    if get is None:
+        return None
+    value = get("retry-after") or get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        # HTTP-date form is not used by our providers
+        return None
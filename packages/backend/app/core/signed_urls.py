@@ -0,0 +1,73 @@
+"""
+Cache of presigned S3 URLs
+
+A URL is reused until SAFETY_MARGIN before it expires, so a client always gets
+at least that long to load it. Reusing the same URL also lets browsers cache
+the object. Misses are signed in one batch in a thread, off the event loop.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from collections.abc import Iterable
+
+from app.conf import settings
+from app.core.metrics import counter
+from app.core.utils import get_s3_client
+
+SIGNED_URL_CACHE = counter(
+    "signed_url_cache_total",
+    "Presigned URL lookups by result: hit or miss",
+    ("result",),
+)
+
+# seconds
+EXPIRES_IN = 10 * 60
+SAFETY_MARGIN = 2 * 60
+MAX_CACHED_URLS = 10_000
+
+# key -> (url, reuse until), least recently used first
+_cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+
+async def sign_urls(keys: Iterable[str]) -> dict[str, str]:
+    """
+    Returns GET URLs of the objects in the storage bucket by their keys
+    """
+    now = time.monotonic()
+    urls: dict[str, str] = {}
+    misses: list[str] = []
+    for key in dict.fromkeys(keys):
+        cached = _cache.get(key)
+        if cached and cached[1] > now:
+            _cache.move_to_end(key)
+            urls[key] = cached[0]
+        else:
+            misses.append(key)
+    SIGNED_URL_CACHE.inc(len(urls), result="hit")
+    if not misses:
+        return urls
+
+    SIGNED_URL_CACHE.inc(len(misses), result="miss")
+    # the URLs expire EXPIRES_IN after signing, start counting before it
+    reuse_until = time.monotonic() + EXPIRES_IN - SAFETY_MARGIN
+    signed = await asyncio.to_thread(_sign, misses)
+    for key, url in signed.items():
+        _cache[key] = (url, reuse_until)
+        _cache.move_to_end(key)
+        urls[key] = url
+    while len(_cache) > MAX_CACHED_URLS:
+        _cache.popitem(last=False)
+    return urls
+
+
+def _sign(keys: list[str]) -> dict[str, str]:
+    s3_client = get_s3_client()
+    return {
+        key: s3_client.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": settings.STORAGE_BUCKET, "Key": key},
+            ExpiresIn=EXPIRES_IN,
+        )
+        for key in keys
+    }
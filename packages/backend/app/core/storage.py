@@ -0,0 +1,105 @@
+"""
+Async access to the storage bucket
+
+boto3 is sync, the calls run in threads. Uploads read the body from an async
+iterator as boto3 consumes it, so a file is never fully buffered in memory,
+and boto3 switches to a multipart upload above MULTIPART_THRESHOLD.
+"""
+
+import asyncio
+import io
+from collections.abc import AsyncIterator, Buffer
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from app.conf import settings
+from app.core.retry import external_call
+from app.core.utils import get_s3_client
+
+# bytes
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+_transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=MULTIPART_THRESHOLD,
+    # parts are read from a single stream one by one
+    use_threads=False,
+)
+
+
+async def object_exists(key: str) -> bool:
+    def head() -> bool:
+        try:
+            get_s3_client().head_object(Bucket=settings.STORAGE_BUCKET, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
+        return True
+
+    with external_call("s3"):
+        return await asyncio.to_thread(head)
+
+
+async def delete_object(key: str) -> None:
+    def delete() -> None:
+        get_s3_client().delete_object(Bucket=settings.STORAGE_BUCKET, Key=key)
+
+    with external_call("s3"):
+        await asyncio.to_thread(delete)
+
+
+async def upload_stream(
+    key: str, chunks: AsyncIterator[bytes], content_type: str | None = None
+) -> None:
+    loop = asyncio.get_running_loop()
+    body = io.BufferedReader(_ChunksReader(chunks, loop), CHUNK_SIZE)
+    extra_args = {"ContentType": content_type} if content_type else None
+
+    def upload() -> None:
+        get_s3_client().upload_fileobj(
+            body,
+            settings.STORAGE_BUCKET,
+            key,
+            ExtraArgs=extra_args,
+            Config=_transfer_config,
+        )
+
+    with external_call("s3"):
+        await asyncio.to_thread(upload)
+
+
+class _ChunksReader(io.RawIOBase):
+    """
+    Sync file object for the upload thread, pulls the chunks on the event loop
+    """
+
+    def __init__(
+        self, chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop
+    ) -> None:
+        self._chunks = chunks
+        self._loop = loop
+        self._chunk = b""
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Buffer) -> int:
+        while not self._chunk and not self._eof:
+            try:
+                self._chunk = asyncio.run_coroutine_threadsafe(
+                    self._next_chunk(), self._loop
+                ).result()
+            except StopAsyncIteration:
+                self._eof = True
+        view = memoryview(buffer).cast("B")
+        size = min(len(view), len(self._chunk))
+        view[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    async def _next_chunk(self) -> bytes:
+        return await self._chunks.__anext__()
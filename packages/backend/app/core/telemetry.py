@@ -0,0 +1,112 @@
+"""
+Execution telemetry of a job: stage timings, tokens, retries and cache hits
+
+The worker collects it for every task (see app.worker.conf), the code on the way
+reports to the collector of the current task, if any. Reporting is a ContextVar
+lookup, so it is safe on hot paths.
+"""
+
+import time
+from collections import Counter
+from collections.abc import Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from pydantic import BaseModel
+
+from app.core.timeouts import observe_stages
+
+
+class StageTiming(BaseModel):
+    # repeated stages are numbered, e.g. llm, llm#2
+    name: str
+    seconds: float
+    failed: bool = False
+
+
+class TokenUsage(BaseModel):
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class JobTelemetry(BaseModel):
+    # wall time of the task
+    seconds: float = 0
+    stages: list[StageTiming] = []
+    # by model
+    tokens: dict[str, TokenUsage] = {}
+    # by provider
+    retries: dict[str, int] = {}
+    # by cache
+    cache_hits: dict[str, int] = {}
+    cache_misses: dict[str, int] = {}
+
+
+class TelemetryCollector:
+    def __init__(self) -> None:
+        self.telemetry = JobTelemetry()
+        self._started_at = time.perf_counter()
+        self._stages: Counter[str] = Counter()
+
+    def add_stage(self, name: str, seconds: float, failed: bool) -> None:
+        self._stages[name] += 1
+        if (count := self._stages[name]) > 1:
+            name = f"{name}#{count}"
+        self.telemetry.stages.append(
+            StageTiming(name=name, seconds=round(seconds, 4), failed=failed)
+        )
+
+    def snapshot(self) -> JobTelemetry:
+        telemetry = self.telemetry.model_copy(deep=True)
+        telemetry.seconds = round(time.perf_counter() - self._started_at, 4)
+        return telemetry
+
+
+_collector: ContextVar[TelemetryCollector | None] = ContextVar(
+    "telemetry_collector", default=None
+)
+
+
+@contextmanager
+def collect_telemetry() -> Generator[TelemetryCollector, None, None]:
+    collector = TelemetryCollector()
+    token = _collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _collector.reset(token)
+
+
+def current_telemetry() -> TelemetryCollector | None:
+    return _collector.get()
+
+
+def record_tokens(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    if collector := _collector.get():
+        usage = collector.telemetry.tokens.setdefault(model, TokenUsage())
+        usage.calls += 1
+        usage.prompt_tokens += prompt_tokens
+        usage.completion_tokens += completion_tokens
+
+
+def record_retry(provider: str) -> None:
+    if collector := _collector.get():
+        retries = collector.telemetry.retries
+        retries[provider] = retries.get(provider, 0) + 1
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    if collector := _collector.get():
+        results = (
+            collector.telemetry.cache_hits if hit else collector.telemetry.cache_misses
+        )
+        results[cache] = results.get(cache, 0) + 1
+
+
+def _observe_stage(name: str, seconds: float, failed: bool) -> None:
+    if collector := _collector.get():
+        collector.add_stage(name, seconds, failed)
+
+
+observe_stages(_observe_stage)
@@ -0,0 +1,102 @@
+import asyncio
+import time
+from collections.abc import AsyncGenerator, Callable
+from contextlib import asynccontextmanager
+from contextvars import Context, ContextVar
+
+from pydantic import BaseModel
+
+from app.core.errors import StageTimeoutError
+
+_current_stage: ContextVar[str | None] = ContextVar("current_stage", default=None)
+# the error that left a stage and the innermost stage it left
+_failed_stage: ContextVar[tuple[BaseException, str] | None] = ContextVar(
+    "failed_stage", default=None
+)
+
+# (stage, seconds, failed)
+StageObserver = Callable[[str, float, bool], None]
+_stage_observers: list[StageObserver] = []
+
+
+class StageTimeouts(BaseModel):
+    """
+    Timeout budgets (in seconds) for every stage of a job.
+    The stages of generate_post (db 4x, llm 2x, tool, image, telegram) add up
+    to 280s, within its 5 minute job timeout, so a stage fails before the job.
+    """
+
+    db: float = 5
+    llm: float = 60
+    tool: float = 30
+    image: float = 90
+    telegram: float = 20
+
+
+def current_stage() -> str | None:
+    """
+    Returns the innermost running stage
+    """
+    return _current_stage.get()
+
+
+def failed_stage(error: BaseException) -> str | None:
+    """
+    The innermost stage the error was raised in, so it can be recorded on the job
+    """
+    failed = _failed_stage.get()
+    if failed and failed[0] is error:
+        return failed[1]
+    return None
+
+
+def stage_of(context: Context) -> str | None:
+    """
+    The running stage of another task, e.g. for a sampling profiler
+    """
+    return context.get(_current_stage)
+
+
+def observe_stages(observer: StageObserver) -> None:
+    """
+    Calls the observer after every stage, it runs inline and must be cheap
+    """
+    _stage_observers.append(observer)
+
+
+@asynccontextmanager
+async def stage(name: str, timeout: float | None) -> AsyncGenerator[None, None]:
+    """
+    Runs the block as a named stage of the job with its own timeout budget.
+    Cancellation is propagated to everything awaited inside the block.
+    """
+    token = _current_stage.set(name)
+    started_at = time.perf_counter()
+    failed = True
+    timeout_cm = asyncio.timeout(timeout)
+    try:
+        try:
+            async with timeout_cm:
+                yield
+            failed = False
+        except TimeoutError as e:
+            # a timeout of an inner call is not the budget of this stage
+            if not timeout_cm.expired():
+                raise
+            raise StageTimeoutError(
+                f"Stage {name} timed out after {timeout}s",
+                code=StageTimeoutError.code,
+                stage=name,
+                timeout=timeout,
+            ) from e
+    except BaseException as e:
+        # the outer stages keep the innermost one
+        if failed_stage(e) is None:
+            _failed_stage.set((e, name))
+        raise
+    finally:
+        _current_stage.reset(token)
+        if _stage_observers:
+            elapsed = time.perf_counter() - started_at
+            for observer in _stage_observers:
+                observer(name, elapsed, failed)
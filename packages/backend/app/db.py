@@ -1,3 +1,4 @@
+import weakref
 from collections.abc import AsyncGenerator
 
 import logfire
@@ -6,11 +7,21 @@ from fastapi import Request
 from pydantic import SecretStr
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine as _create_async_engine
+from sqlalchemy.pool import QueuePool
 
 from app.conf import settings
+from app.core.metrics import REGISTRY, gauge
 
 type AsyncSessionMaker = async_sessionmaker[AsyncSession]
 
+POOL_SIZE = gauge("db_pool_size", "Connections kept by the pool", ("engine",))
+POOL_CHECKED_OUT = gauge("db_pool_checked_out", "Connections in use", ("engine",))
+POOL_OVERFLOW = gauge(
+    "db_pool_overflow", "Connections opened above the pool size", ("engine",)
+)
+
+_engines: weakref.WeakValueDictionary[str, AsyncEngine] = weakref.WeakValueDictionary()
+
 
 def create_async_engine(url: SecretStr, application_name: str) -> AsyncEngine:
     engine = _create_async_engine(
@@ -20,9 +31,24 @@ def create_async_engine(url: SecretStr, application_name: str) -> AsyncEngine:
     )
     if settings.LOGFIRE_TOKEN:
         logfire.instrument_sqlalchemy(engine)
+    _engines[application_name] = engine
     return engine
 
 
+def _collect_pool_metrics() -> None:
+    for name, engine in _engines.items():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        POOL_SIZE.set(pool.size(), engine=name)
+        POOL_CHECKED_OUT.set(pool.checkedout(), engine=name)
+        # negative until the pool is filled up
+        POOL_OVERFLOW.set(max(pool.overflow(), 0), engine=name)
+
+
+REGISTRY.add_collector(_collect_pool_metrics)
+
+
 def create_session_maker(engine: AsyncEngine) -> AsyncSessionMaker:
     return async_sessionmaker(
         engine,
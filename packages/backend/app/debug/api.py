@@ -0,0 +1,65 @@
+import asyncio
+from typing import Annotated
+
+from fastapi import APIRouter, Query, Response, status
+
+from app.auth.dependencies import AuthAdmin
+from app.core.http_errors import HTTPForbiddenError, HTTPUnauthorizedError
+from app.core.profiling import (
+    ProfilingConfig,
+    profiling_config,
+    reset_profiling,
+    set_profiling,
+    tracemalloc_diff,
+)
+from app.debug.schemas import EnableProfiling
+from app.openapi import generate_unique_id_function
+
+router = APIRouter(
+    prefix="/debug",
+    tags=["debug"],
+    generate_unique_id_function=generate_unique_id_function("debug"),
+    responses={
+        401: {"model": HTTPUnauthorizedError},
+        403: {"model": HTTPForbiddenError},
+    },
+)
+
+
+@router.get("/profiling", status_code=status.HTTP_200_OK)
+async def get_profiling(_: AuthAdmin) -> ProfilingConfig:
+    """
+    Profiling config as seen by this process, refreshed every few seconds
+    """
+    return await profiling_config()
+
+
+@router.put("/profiling", status_code=status.HTTP_200_OK)
+async def enable_profiling(_: AuthAdmin, data: EnableProfiling) -> ProfilingConfig:
+    """
+    Profiles the share of the jobs and requests of all processes until it expires
+    """
+    return await set_profiling(data.rate, data.minutes * 60)
+
+
+@router.delete("/profiling", status_code=status.HTTP_204_NO_CONTENT)
+async def disable_profiling(_: AuthAdmin) -> None:
+    """
+    Falls back to PROFILING_RATE
+    """
+    await reset_profiling()
+
+
+@router.get("/tracemalloc", status_code=status.HTTP_200_OK)
+async def tracemalloc(
+    _: AuthAdmin,
+    limit: Annotated[int, Query(gt=0, le=200)] = 20,
+    stop: bool = False,
+) -> Response:
+    """
+    Allocations of the API process that grew since the previous call,
+    the first call starts tracing. Workers serve it on WORKER_METRICS_PORT
+    when METRICS_TOKEN is set.
+    """
+    diff = await asyncio.to_thread(tracemalloc_diff, limit, stop)
+    return Response(diff, media_type="text/plain")
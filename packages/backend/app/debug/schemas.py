@@ -0,0 +1,8 @@
+from pydantic import BaseModel, Field
+
+
+class EnableProfiling(BaseModel):
+    # share of the jobs and requests profiled
+    rate: float = Field(gt=0, le=1)
+    # the toggle expires after this time
+    minutes: int = Field(default=30, gt=0, le=24 * 60)
@@ -143,3 +143,4 @@ class PydanticJSON(TypeDecorator[T]):
 class ErrorSchema(PydanticBaseModel):
     message: str
     code: str | None = None
+    details: dict[str, Any] | None = None
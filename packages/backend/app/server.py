@@ -1,15 +1,19 @@
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
-from typing import TypedDict
+from typing import Annotated, TypedDict
 
 import logfire
 from arq.connections import ArqRedis, create_pool
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 
 from app.auth.api import router as auth_router
 from app.conf import settings
+from app.core.loop_monitor import start_loop_monitor
+from app.core.profiling import ProfilingMiddleware
+from app.core.prometheus import CONTENT_TYPE, MetricsMiddleware, is_authorized, scrape
 from app.db import AsyncSessionMaker, create_async_engine, create_session_maker
+from app.debug.api import router as debug_router
 from app.logging import configure_logging
 from app.openapi import configure_openapi, generate_unique_id_function
 from app.tg.api import router as tg_router
@@ -33,11 +37,14 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[AppState, None]:
         WorkerSettings.redis_settings, default_queue_name=WorkerSettings.queue_name
     )
 
+    loop_monitor = start_loop_monitor("api")
+
     try:
         async with start_tg_app(session_maker) as tg_app:
             yield AppState(tg_app=tg_app, session_maker=session_maker, arq=arq)
     finally:
-        ...
+        if loop_monitor:
+            await loop_monitor.stop()
 
 
 app = FastAPI(
@@ -53,9 +60,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(auth_router)
 app.include_router(tg_router)
 app.include_router(tgbot_router)
+app.include_router(debug_router)
 
 
 @app.get("/")
@@ -63,6 +74,15 @@ async def root() -> dict[str, str]:
     return {"message": f"ViraLink v{settings.VERSION}"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics(
+    authorization: Annotated[str | None, Header()] = None,
+) -> Response:
+    if not is_authorized(authorization, public=True):
+        return Response(status_code=status.HTTP_401_UNAUTHORIZED)
+    return Response(await scrape(), media_type=CONTENT_TYPE)
+
+
 configure_logging(name="api")
 if settings.LOGFIRE_TOKEN:
     logfire.instrument_fastapi(app, capture_headers=False)
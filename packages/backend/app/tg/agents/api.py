@@ -1,33 +1,49 @@
-from typing import Annotated
-from uuid import UUID
+from datetime import datetime, timedelta
+from typing import Annotated, Literal
+from uuid import UUID, uuid4
 
 import structlog
 from arq.connections import ArqRedis
-from fastapi import APIRouter, Depends, HTTPException, status
-from telegram import Bot
+from arq.jobs import Job, JobResult, JobStatus
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from redis.exceptions import RedisError
 from telegram.error import TelegramError
 
+from app.auth.dependencies import AuthAdmin
 from app.conf import settings
-from app.core.errors import AppError, ForbiddenError, NotFoundError
+from app.core.errors import AppError, ForbiddenError
 from app.core.http_errors import (
+    HTTPError,
     HTTPForbiddenError,
     HTTPNotFoundError,
     HTTPUnauthorizedError,
 )
 from app.db import get_arq
+from app.models.base import utc_now
 from app.openapi import generate_unique_id_function
-from app.tg.agents.bot import check_agent_bot_permissions
+from app.tg.agents.bot import PERMISSIONS_CHECK_TTL, permissions_check_key
+from app.tg.agents.drafts import RELEVANT_POST_PROMPT
+from app.tg.agents.events import acquire_stream, stream_events
 from app.tg.agents.models import BotMetadata, TGAgentJobType, TGAgentStatus
 from app.tg.agents.schemas import (
     AddTGBotRequest,
+    CheckBotPermissionsJob,
+    CheckBotPermissionsResponse,
     CreateTGAgentRequest,
+    JobTelemetryStats,
     LinkTGBotRequest,
     UpdateChannelProfileRequest,
+    sign_agent,
+    sign_agents,
 )
 from app.tg.agents.schemas import TGAgent as TGAgentSchema
 from app.tg.agents.schemas import TGUserBot as TGUserBotSchema
 from app.tg.agents.services import TGAgentJobService, TGAgentService
+from app.tgbot.bot import Bot
 from app.tgbot.dependencies import AuthUser
+from app.tgbot.texts import TEXTS
+from app.tgbot.utils import cancel_job_markup, get_texts
 
 logger = structlog.get_logger()
 
@@ -49,7 +65,7 @@ async def list_agents(
     agent_svc: Annotated[TGAgentService, Depends(TGAgentService.inject)],
 ) -> list[TGAgentSchema]:
     agents = await agent_svc.list_agents(tg_user_id=user.tg_id)
-    return [TGAgentSchema.model_validate(agent).with_signed_urls() for agent in agents]
+    return await sign_agents([TGAgentSchema.model_validate(agent) for agent in agents])
 
 
 @router.put("/", status_code=status.HTTP_201_CREATED)
@@ -62,7 +78,7 @@ async def create(
         tg_user_id=user.tg_id,
         channel_username=data.channel_username.lstrip("@"),
     )
-    return TGAgentSchema.model_validate(agent).with_signed_urls()
+    return await sign_agent(TGAgentSchema.model_validate(agent))
 
 
 @router.get(
@@ -77,6 +93,61 @@ async def list_bots(
     return [TGUserBotSchema.model_validate(bot) for bot in bots]
 
 
+@router.get(
+    "/events",
+    status_code=status.HTTP_200_OK,
+    response_class=StreamingResponse,
+    responses={429: {"model": HTTPError}, 503: {"model": HTTPError}},
+)
+async def events(
+    user: AuthUser,
+    last_event_id: Annotated[str | None, Header()] = None,
+) -> StreamingResponse:
+    """
+    Server-Sent Events with job and agent status changes of the user,
+    reconnecting clients resume from the Last-Event-ID header
+    """
+    try:
+        stream_id = await acquire_stream(user.tg_id)
+    except RedisError as e:
+        logger.warning(f"Event streams are unavailable: {e}", tg_user_id=user.tg_id)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Events are temporarily unavailable",
+        ) from e
+    if not stream_id:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many open event streams",
+        )
+    return StreamingResponse(
+        stream_events(user.tg_id, stream_id, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/jobs/telemetry",
+    status_code=status.HTTP_200_OK,
+    generate_unique_id_function=lambda *_: "tg::agents::jobs_telemetry",
+)
+async def jobs_telemetry(
+    _: AuthAdmin,
+    agent_job_svc: Annotated[TGAgentJobService, Depends(TGAgentJobService.inject)],
+    group_by: Literal["model", "agent"] = "model",
+    since: datetime | None = None,
+    type_: Annotated[TGAgentJobType | None, Query(alias="type")] = None,
+) -> list[JobTelemetryStats]:
+    """
+    Stage timings, tokens and retries of the jobs by model or by agent,
+    for the last 7 days by default
+    """
+    return await agent_job_svc.telemetry_stats(
+        group_by, since or utc_now() - timedelta(days=7), type_
+    )
+
+
 @router.get(
     "/{agent_id}",
     status_code=status.HTTP_200_OK,
@@ -100,7 +171,7 @@ async def get(
             detail="You are not allowed to access the agent",
         )
 
-    return TGAgentSchema.model_validate(agent).with_signed_urls()
+    return await sign_agent(TGAgentSchema.model_validate(agent))
 
 
 @router.delete(
@@ -146,26 +217,65 @@ async def check_bot_permissions(
     user: AuthUser,
     agent_svc: Annotated[TGAgentService, Depends(TGAgentService.inject)],
     arq: Annotated[ArqRedis, Depends(get_arq)],
-) -> TGAgentSchema:
+) -> CheckBotPermissionsResponse:
     """
-    Long running endpoints that connects to the telegram and checks if the bot has sufficient permissions
+    Starts checking if the bot has sufficient permissions in the background,
+    returns the current state of the agent and the check job id
     """
-    try:
-        agent = await check_agent_bot_permissions(user.tg_id, agent_id, agent_svc)
-        if agent.channel_metadata and agent.channel_metadata.photo:
-            await arq.enqueue_job("fetch_channel_photo", agent.id)
-    except ForbiddenError as e:
-        logger.exception(e)
-        raise NotFoundError("Agent not found") from e
-    except NotFoundError as e:
-        raise NotFoundError("Agent not found") from e
-    except Exception as e:
-        logger.exception(e)
+    agent = await agent_svc.get(agent_id, with_bot=True)
+    if not agent or agent.tg_user_id != user.tg_id:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error checking bot permissions",
-        ) from e
-    return TGAgentSchema.model_validate(agent).with_signed_urls()
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Agent not found",
+        )
+
+    # the webapp re-checks while waiting, don't queue a check per request
+    job_id = uuid4().hex
+    check_key = permissions_check_key(agent_id)
+    if await arq.set(check_key, job_id, nx=True, ex=PERMISSIONS_CHECK_TTL):
+        await arq.enqueue_job(
+            "check_bot_permissions", user.tg_id, agent_id, _job_id=job_id
+        )
+    else:
+        job_id = (await arq.get(check_key) or job_id.encode()).decode()
+
+    agent_schema = await sign_agent(TGAgentSchema.model_validate(agent))
+    return CheckBotPermissionsResponse(**dict(agent_schema), job_id=job_id)
+
+
+@router.get(
+    "/{agent_id}/check-bot-permissions/{job_id}",
+    status_code=status.HTTP_200_OK,
+    responses={404: {"model": HTTPNotFoundError}},
+)
+async def get_check_bot_permissions_job(
+    agent_id: UUID,
+    job_id: str,
+    user: AuthUser,
+    agent_svc: Annotated[TGAgentService, Depends(TGAgentService.inject)],
+    arq: Annotated[ArqRedis, Depends(get_arq)],
+) -> CheckBotPermissionsJob:
+    agent = await agent_svc.get(agent_id)
+    if not agent or agent.tg_user_id != user.tg_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Agent not found",
+        )
+
+    job = Job(job_id, arq, _queue_name=arq.default_queue_name)
+    # the queued, running and finished job alike must be the check of this agent
+    info = await job.info()
+    if not info or info.args[:2] != (user.tg_id, agent_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Job not found",
+        )
+    job_status = await job.status()
+    if job_status == JobStatus.complete and not isinstance(info, JobResult):
+        # finished meanwhile
+        info = await job.result_info()
+    success = info.success if isinstance(info, JobResult) else None
+    return CheckBotPermissionsJob(job_id=job_id, status=job_status, success=success)
 
 
 @router.put(
@@ -207,7 +317,7 @@ async def createBot(
         data.bot_token,
         bot_metadata=BotMetadata.model_validate(bot_metadata),
     )
-    return TGAgentSchema.model_validate(agent).with_signed_urls()
+    return await sign_agent(TGAgentSchema.model_validate(agent))
 
 
 @router.post(
@@ -249,7 +359,7 @@ async def link_bot(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e)
         ) from e
 
-    return TGAgentSchema.model_validate(agent).with_signed_urls()
+    return await sign_agent(TGAgentSchema.model_validate(agent))
 
 
 @router.post(
@@ -291,7 +401,7 @@ async def update_channel_profile(
         and agent.channel_profile.persona_description
     ):
         agent = await agent_svc.activate(agent.id)
-    return TGAgentSchema.model_validate(agent).with_signed_urls()
+    return await sign_agent(TGAgentSchema.model_validate(agent))
 
 
 @router.post(
@@ -334,13 +444,18 @@ async def generate_post(
         agent_id=agent.id,
         type_=TGAgentJobType.POST_GENERATION,
         metadata={
-            "user_prompt": "Create relevant post, the length should be less 1000 symbols. Use language of the channel",
+            "user_prompt": RELEVANT_POST_PROMPT,
             "chat_id": agent.tg_user_id,
+            "use_draft": True,
         },
     )
     await Bot(settings.TGBOT_TOKEN.get_secret_value()).send_message(
-        chat_id=agent.tg_user_id, text="Generating post..."
+        chat_id=agent.tg_user_id,
+        text="Generating post...",
+        reply_markup=cancel_job_markup(
+            job.id, get_texts(TEXTS, user.language_code).jobs.cancel_button
+        ),
     )
     await arq.enqueue_job("generate_post", job.id, agent.tg_user_id, with_photo=True)
 
-    return TGAgentSchema.model_validate(agent).with_signed_urls()
+    return await sign_agent(TGAgentSchema.model_validate(agent))
@@ -1,13 +1,32 @@
+import asyncio
 from uuid import UUID
 
-from telegram import Bot
+import structlog
+from redis.exceptions import RedisError
+from telegram import ChatMember
 from telegram.constants import ChatType
 from telegram.error import BadRequest as TelegramBadRequest
 from telegram.error import Forbidden as TelegramForbiddenError
 
 from app.core.errors import AppError, ForbiddenError, NotFoundError
+from app.core.redis import get_redis
 from app.tg.agents.models import BotPermissions, ChannelMetadata, TGAgent, TGAgentStatus
 from app.tg.agents.services import TGAgentService
+from app.tgbot.bot import Bot
+
+logger = structlog.get_logger()
+
+# seconds, the webapp re-checks every few seconds while waiting for access
+CHANNEL_METADATA_TTL = 60
+# seconds, longer than the check_bot_permissions task may run
+PERMISSIONS_CHECK_TTL = 60
+
+
+def permissions_check_key(agent_id: UUID) -> str:
+    """
+    Holds the id of the queued or running check of the agent
+    """
+    return f"viralink:check_bot_permissions:{agent_id}"
 
 
 async def check_agent_bot_permissions(
@@ -34,20 +53,11 @@ async def check_agent_bot_permissions(
 
     bot = Bot(user_bot.api_token)
     try:
-        member = await bot.get_chat_member(
-            chat_id=f"@{agent.channel_username}", user_id=user_bot.tg_id
+        member, channel_metadata = await fetch_member_and_channel(
+            bot, agent.channel_username, user_bot.tg_id
         )
-        chat = await bot.get_chat(f"@{agent.channel_username}")
-
-        if chat.type != ChatType.CHANNEL:
-            raise AppError("Chat is not a channel")
-
-        member_count = await bot.get_chat_member_count(chat.id)
 
         async with agent_svc.tx():
-            channel_metadata = ChannelMetadata(
-                **{**chat.to_dict(), "member_count": member_count}
-            )
             await agent_svc.update_channel_metadata(
                 agent.id,
                 channel_metadata=channel_metadata,
@@ -68,7 +78,9 @@ async def check_agent_bot_permissions(
             return agent
 
         agent = await agent_svc.activate(agent.id)
-    except TelegramForbiddenError:
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        if not is_access_lost(e):
+            raise
         # still not a member
         if agent.status == TGAgentStatus.WAITING_BOT_ACCESS:
             return agent
@@ -76,18 +88,71 @@ async def check_agent_bot_permissions(
             agent = await agent_svc.waiting_bot_access(agent.id)
             return agent
         return agent
-    except TelegramBadRequest as e:
-        if "Chat not found" in str(e) or "Member list is inaccessible" in str(e):
-            # still not a member
-            if agent.status == TGAgentStatus.WAITING_BOT_ACCESS:
-                return agent
-            elif agent.bot_is_connected():
-                agent = await agent_svc.waiting_bot_access(agent.id)
-                return agent
-            return agent
-        raise
     except Exception as e:
         await agent_svc.save_status_error(agent_id, str(e))
         raise
 
     return agent
+
+
+def is_access_lost(error: Exception) -> bool:
+    """
+    The bot is not a member of the channel or the channel is gone
+    """
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and (
+        "Chat not found" in str(error) or "Member list is inaccessible" in str(error)
+    )
+
+
+async def fetch_member_and_channel(
+    bot: Bot, channel_username: str, bot_tg_id: int
+) -> tuple[ChatMember, ChannelMetadata]:
+    """
+    Runs the independent Telegram calls concurrently,
+    channel metadata is cached briefly, the membership is always checked.
+    The cache is per bot, the photo file_ids only work for the bot that got them
+    """
+    chat_id = f"@{channel_username}"
+    cache_key = f"viralink:channel_metadata:{bot_tg_id}:{channel_username}"
+    redis = get_redis()
+
+    cached = None
+    try:
+        cached = await redis.get(cache_key)
+    except RedisError as e:
+        logger.warning(f"Channel metadata cache is unavailable: {e}")
+    if cached:
+        return (
+            await bot.get_chat_member(chat_id=chat_id, user_id=bot_tg_id),
+            ChannelMetadata.model_validate_json(cached),
+        )
+
+    member, chat, member_count = await asyncio.gather(
+        bot.get_chat_member(chat_id=chat_id, user_id=bot_tg_id),
+        bot.get_chat(chat_id),
+        bot.get_chat_member_count(chat_id),
+        return_exceptions=True,
+    )
+    # the membership error explains the others (e.g. "Chat not found")
+    if isinstance(member, BaseException):
+        raise member
+    if isinstance(chat, BaseException):
+        raise chat
+    if isinstance(member_count, BaseException):
+        raise member_count
+
+    if chat.type != ChatType.CHANNEL:
+        raise AppError("Chat is not a channel")
+
+    channel_metadata = ChannelMetadata(
+        **{**chat.to_dict(), "member_count": member_count}
+    )
+    try:
+        await redis.set(
+            cache_key, channel_metadata.model_dump_json(), ex=CHANNEL_METADATA_TTL
+        )
+    except RedisError as e:
+        logger.warning(f"Channel metadata cache is unavailable: {e}")
+    return member, channel_metadata
@@ -0,0 +1,168 @@
+"""
+Pool of pre-generated posts per agent
+
+A generic "create a relevant post" request (POST /agents/{id}/generate-post)
+takes a ready draft instead of running the pipeline and triggers a refill.
+Drafts are generated by the low-priority refill_drafts task, scheduled in the
+off-peak DRAFT_POOL_HOURS and after every take, it yields to the user jobs when
+the queue is busy. The credits are spent when a draft is taken.
+
+Keys:
+    viralink:drafts:{agent_id}  list of drafts, the oldest first
+
+A draft is valid for the channel profile it was generated for and for
+DRAFT_POOL_MAX_AGE_HOURS, the stale ones are dropped with their image
+(drafts/{agent_id}/{draft_id} in the bucket) on the way.
+"""
+
+import hashlib
+from collections.abc import AsyncIterator
+from datetime import datetime, timedelta
+from uuid import UUID, uuid4
+
+import httpx
+import structlog
+from pydantic import BaseModel, Field, ValidationError
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.conf import settings
+from app.core.metrics import counter
+from app.core.storage import delete_object, upload_stream
+from app.models.base import utc_now
+from app.tg.agents.models import TGAgent
+from app.tg.credits.services import TGUserCreditsService
+
+logger = structlog.get_logger()
+
+DRAFTS_TAKEN = counter(
+    "draft_pool_taken_total",
+    "Generic post requests by result: hit, miss or stale drafts dropped",
+    ("result",),
+)
+
+# same as the generic request, so a draft is what the pipeline would generate
+RELEVANT_POST_PROMPT = "Create relevant post, the length should be less 1000 symbols. Use language of the channel"
+
+
+class Draft(BaseModel):
+    id: UUID = Field(default_factory=uuid4)
+    text: str
+    image_key: str | None = None
+    profile_version: str
+    created_at: datetime = Field(default_factory=utc_now)
+
+
+def profile_version(agent: TGAgent) -> str:
+    """
+    Changes with the channel profile and the generated one
+    """
+    data = (
+        f"{agent.channel_profile.model_dump_json()}\n{agent.channel_profile_generated}"
+    )
+    return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+
+def image_key(agent_id: UUID, draft_id: UUID) -> str:
+    return f"drafts/{agent_id}/{draft_id}"
+
+
+async def pool_size(db_session: AsyncSession, tg_user_id: int) -> int:
+    """
+    By the plan of the user, i.e. the package of the latest purchase
+    """
+    if not settings.DRAFT_POOL_SIZES:
+        return 0
+    package = await TGUserCreditsService(db_session).latest_package(tg_user_id)
+    return settings.DRAFT_POOL_SIZES.get(package or "", 0)
+
+
+class DraftPool:
+    def __init__(self, redis: Redis) -> None:
+        self.redis = redis
+        self.max_age = timedelta(hours=settings.DRAFT_POOL_MAX_AGE_HOURS)
+
+    async def take(self, agent: TGAgent) -> Draft | None:
+        """
+        The oldest valid draft, the stale ones before it are dropped
+        """
+        version = profile_version(agent)
+        while data := await self.redis.lpop(_key(agent.id)):  # type: ignore[misc]
+            draft = self._parse(data)
+            if draft and self._is_valid(draft, version):
+                DRAFTS_TAKEN.inc(result="hit")
+                return draft
+            DRAFTS_TAKEN.inc(result="stale")
+            await self._drop(draft)
+        DRAFTS_TAKEN.inc(result="miss")
+        return None
+
+    async def add(self, agent_id: UUID, draft: Draft) -> None:
+        key = _key(agent_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, draft.model_dump_json())
+            # all drafts are stale by then
+            pipe.expire(key, self.max_age)
+            await pipe.execute()
+
+    async def prune(self, agent: TGAgent) -> int:
+        """
+        Drops the stale drafts, returns the number of the valid ones
+        """
+        version = profile_version(agent)
+        valid = 0
+        for data in await self.redis.lrange(_key(agent.id), 0, -1):  # type: ignore[misc]
+            draft = self._parse(data)
+            if draft and self._is_valid(draft, version):
+                valid += 1
+            # by value, the list may be taken from concurrently
+            elif await self.redis.lrem(_key(agent.id), 1, data):  # type: ignore[misc]
+                await self._drop(draft)
+        return valid
+
+    def _is_valid(self, draft: Draft, version: str) -> bool:
+        return (
+            draft.profile_version == version
+            and utc_now() - draft.created_at < self.max_age
+        )
+
+    def _parse(self, data: bytes) -> Draft | None:
+        try:
+            return Draft.model_validate_json(data)
+        except ValidationError:
+            return None
+
+    async def _drop(self, draft: Draft | None) -> None:
+        if draft and draft.image_key:
+            await delete_image(draft.image_key)
+
+
+async def store_image(url: str, key: str) -> None:
+    """
+    Copies the generated image to the bucket, the provider URLs expire in hours
+    """
+    async with (
+        httpx.AsyncClient(timeout=httpx.Timeout(60, connect=10)) as client,
+        client.stream("GET", url) as response,
+    ):
+        response.raise_for_status()
+
+        async def chunks() -> AsyncIterator[bytes]:
+            async for chunk in response.aiter_bytes():
+                yield chunk
+
+        await upload_stream(key, chunks(), response.headers.get("content-type"))
+
+
+async def delete_image(key: str) -> None:
+    """
+    Best effort, an orphaned image only takes space
+    """
+    try:
+        await delete_object(key)
+    except Exception as e:
+        logger.warning(f"Can't delete draft image: {e}", key=key)
+
+
+def _key(agent_id: UUID) -> str:
+    return f"viralink:drafts:{agent_id}"
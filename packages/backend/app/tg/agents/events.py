@@ -0,0 +1,186 @@
+"""
+Job and agent status events for the webapp
+
+Events are appended to a Redis stream per user, XREAD BLOCK delivers them
+to the subscribers like pub/sub does, and the stream keeps a short history
+so a reconnecting client can resume from the Last-Event-ID.
+"""
+
+import re
+import time
+import uuid
+from collections.abc import AsyncGenerator
+from typing import Literal
+from uuid import UUID
+
+import structlog
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+
+from app.core.redis import get_redis
+from app.models.base import ErrorSchema
+from app.tg.agents.models import (
+    TGAgent,
+    TGAgentJob,
+    TGAgentJobStatus,
+    TGAgentJobType,
+    TGAgentStatus,
+)
+
+logger = structlog.get_logger()
+
+# events kept per user for resuming
+STREAM_MAXLEN = 100
+STREAM_TTL = 24 * 60 * 60
+# seconds
+HEARTBEAT_INTERVAL = 15
+MAX_STREAMS_PER_USER = 3
+
+_EVENT_ID_RE = re.compile(r"^\d+-\d+$")
+
+
+class JobStatusEvent(BaseModel):
+    type: Literal["job_status"] = "job_status"
+    job_id: UUID
+    job_type: TGAgentJobType
+    agent_id: UUID | None
+    status: TGAgentJobStatus
+    status_error: ErrorSchema | None = None
+
+
+class AgentStatusEvent(BaseModel):
+    type: Literal["agent_status"] = "agent_status"
+    agent_id: UUID
+    status: TGAgentStatus
+    status_error: ErrorSchema | None = None
+
+
+Event = JobStatusEvent | AgentStatusEvent
+
+
+def _events_key(tg_user_id: int) -> str:
+    return f"viralink:events:{tg_user_id}"
+
+
+def _streams_key(tg_user_id: int) -> str:
+    return f"viralink:events:{tg_user_id}:streams"
+
+
+async def publish_event(tg_user_id: int | None, event: Event) -> None:
+    """
+    Best effort, a lost event only makes the webapp refresh later
+    """
+    if tg_user_id is None:
+        return
+    key = _events_key(tg_user_id)
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.xadd(
+                key,
+                {"type": event.type, "data": event.model_dump_json()},
+                maxlen=STREAM_MAXLEN,
+                approximate=True,
+            )
+            pipe.expire(key, STREAM_TTL)
+            await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Can't publish event: {e}", tg_user_id=tg_user_id)
+
+
+async def publish_job_status(job: TGAgentJob) -> None:
+    await publish_event(
+        job.tg_user_id,
+        JobStatusEvent(
+            job_id=job.id,
+            job_type=job.type_,
+            agent_id=job.agent_id,
+            status=job.status,
+            status_error=job.status_error,
+        ),
+    )
+
+
+async def publish_agent_status(agent: TGAgent) -> None:
+    await publish_event(
+        agent.tg_user_id,
+        AgentStatusEvent(
+            agent_id=agent.id,
+            status=agent.status,
+            status_error=agent.status_error,
+        ),
+    )
+
+
+async def acquire_stream(tg_user_id: int) -> str | None:
+    """
+    Returns None if the user has too many open streams
+    """
+    key = _streams_key(tg_user_id)
+    stream_id = uuid.uuid4().hex
+    now = time.time()
+    async with get_redis().pipeline(transaction=True) as pipe:
+        # streams of crashed processes are dropped after missed heartbeats
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zadd(key, {stream_id: now + HEARTBEAT_INTERVAL * 3})
+        pipe.zcard(key)
+        pipe.expire(key, HEARTBEAT_INTERVAL * 3)
+        _, _, streams, _ = await pipe.execute()
+    if streams > MAX_STREAMS_PER_USER:
+        await release_stream(tg_user_id, stream_id)
+        return None
+    return stream_id
+
+
+async def _refresh_stream(tg_user_id: int, stream_id: str) -> None:
+    key = _streams_key(tg_user_id)
+    async with get_redis().pipeline(transaction=False) as pipe:
+        pipe.zadd(key, {stream_id: time.time() + HEARTBEAT_INTERVAL * 3}, xx=True)
+        pipe.expire(key, HEARTBEAT_INTERVAL * 3)
+        await pipe.execute()
+
+
+async def release_stream(tg_user_id: int, stream_id: str) -> None:
+    try:
+        await get_redis().zrem(_streams_key(tg_user_id), stream_id)
+    except RedisError as e:
+        logger.warning(f"Can't release event stream: {e}", tg_user_id=tg_user_id)
+
+
+async def stream_events(
+    tg_user_id: int, stream_id: str, last_event_id: str | None = None
+) -> AsyncGenerator[str, None]:
+    """
+    Yields Server-Sent Events until the client disconnects
+    """
+    redis = get_redis()
+    key = _events_key(tg_user_id)
+    try:
+        if last_event_id is None or not _EVENT_ID_RE.match(last_event_id):
+            latest = await redis.xrevrange(key, count=1)
+            last_event_id = latest[0][0].decode() if latest else "0-0"
+        # tell the client how fast to reconnect
+        yield "retry: 3000\n\n"
+
+        refreshed_at = time.monotonic()
+        while True:
+            result = await redis.xread(
+                {key: last_event_id},
+                count=STREAM_MAXLEN,
+                block=HEARTBEAT_INTERVAL * 1000,
+            )
+            if time.monotonic() - refreshed_at >= HEARTBEAT_INTERVAL:
+                await _refresh_stream(tg_user_id, stream_id)
+                refreshed_at = time.monotonic()
+            if not result:
+                yield ": heartbeat\n\n"
+                continue
+            for _, entries in result:
+                for entry_id, fields in entries:
+                    last_event_id = entry_id.decode()
+                    yield (
+                        f"id: {last_event_id}\n"
+                        f"event: {fields[b'type'].decode()}\n"
+                        f"data: {fields[b'data'].decode()}\n\n"
+                    )
+    finally:
+        await release_stream(tg_user_id, stream_id)
@@ -1,4 +1,5 @@
 import enum
+from collections.abc import Mapping
 from datetime import datetime
 from typing import TypedDict
 from uuid import UUID
@@ -13,7 +14,7 @@ from sqlalchemy_utils.types import StringEncryptedType
 
 from app.conf import settings
 from app.core.errors import AppError
-from app.core.utils import get_s3_client
+from app.core.telemetry import JobTelemetry
 from app.models.base import (
     ErrorSchema,
     PydanticJSON,
@@ -34,30 +35,37 @@ class TGAgentStatus(str, enum.Enum):
 
 class ChannelPhoto(BaseModel):
     small_file_id: str | None = None
+    small_file_unique_id: str | None = None
     small_file_path: str | None = None
     big_file_id: str | None = None
+    big_file_unique_id: str | None = None
     big_file_path: str | None = None
 
-    def with_signed_urls(self) -> "ChannelPhoto":
-        s3_client = get_s3_client()
-
-        def sign_url(file_path: str | None) -> str | None:
-            if not file_path:
-                return None
-            signed_url = s3_client.generate_presigned_url(
-                ClientMethod="get_object",
-                Params={
-                    "Bucket": settings.STORAGE_BUCKET,
-                    "Key": file_path,
-                },
-                ExpiresIn=60 * 10,
+    def is_same_photo(self, other: "ChannelPhoto") -> bool:
+        """
+        file_id differs between bots and over time, file_unique_id doesn't
+        """
+        if self.small_file_unique_id and other.small_file_unique_id:
+            return (
+                self.small_file_unique_id == other.small_file_unique_id
+                and self.big_file_unique_id == other.big_file_unique_id
             )
-            return signed_url
+        return (
+            self.small_file_id == other.small_file_id
+            and self.big_file_id == other.big_file_id
+        )
+
+    def file_paths(self) -> list[str]:
+        return [path for path in (self.small_file_path, self.big_file_path) if path]
 
+    def with_signed_urls(self, urls: Mapping[str, str]) -> "ChannelPhoto":
+        """
+        urls: signed URLs by file path, see app.core.signed_urls
+        """
         return self.model_copy(
             update={
-                "small_file_path": sign_url(self.small_file_path),
-                "big_file_path": sign_url(self.big_file_path),
+                "small_file_path": urls.get(self.small_file_path or ""),
+                "big_file_path": urls.get(self.big_file_path or ""),
             }
         )
 
@@ -70,9 +78,12 @@ class ChannelMetadata(BaseModel):
     member_count: int | None = None
     photo: ChannelPhoto | None = None
 
-    def with_signed_urls(self) -> "ChannelMetadata":
+    def file_paths(self) -> list[str]:
+        return self.photo.file_paths() if self.photo else []
+
+    def with_signed_urls(self, urls: Mapping[str, str]) -> "ChannelMetadata":
         return self.model_copy(
-            update={"photo": self.photo.with_signed_urls() if self.photo else None}
+            update={"photo": self.photo.with_signed_urls(urls) if self.photo else None}
         )
 
 
@@ -227,6 +238,7 @@ class TGAgentJobStatus(str, enum.Enum):
     IN_PROGRESS = "in_progress"
     COMPLETED = "completed"
     FAILED = "failed"
+    CANCELLED = "cancelled"
 
 
 class TGAgentJobType(str, enum.Enum):
@@ -244,6 +256,8 @@ class PostGenerationMetadata(BaseModel):
     chat_id: int
     photo_id: str | None = None
     photo_path: str | None = None
+    # a generic request, can be served from the pool of drafts
+    use_draft: bool = False
 
 
 class PostUpdateMetadata(BaseModel):
@@ -252,6 +266,26 @@ class PostUpdateMetadata(BaseModel):
     notify_message_id: int
     chat_id: int
     photo_id: str | None = None
+    photo_unique_id: str | None = None
+    # the post replied to, its image may be generated ahead
+    original_message_id: int | None = None
+
+
+class LLMCallUsage(BaseModel):
+    name: str
+    model: str
+    budget: int
+    # counted before the call
+    prompt_tokens: int
+    # reported by the provider
+    input_tokens: int | None = None
+    output_tokens: int | None = None
+    # by prompt section
+    trimmed_tokens: dict[str, int] = {}
+
+
+class LLMUsage(BaseModel):
+    calls: list[LLMCallUsage] = []
 
 
 class TGAgentJob(RecordModel):
@@ -291,6 +325,12 @@ class TGAgentJob(RecordModel):
         JSONB(none_as_null=True), nullable=True
     )
     data: Mapped[str] = string_column()
+    llm_usage: Mapped[LLMUsage | None] = mapped_column(
+        PydanticJSON(LLMUsage, none_as_null=True), nullable=True
+    )
+    telemetry: Mapped[JobTelemetry | None] = mapped_column(
+        PydanticJSON(JobTelemetry, none_as_null=True), nullable=True
+    )
 
     # Foreign keys
     tg_user_id: Mapped[int | None] = mapped_column(
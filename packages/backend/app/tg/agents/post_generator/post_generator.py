@@ -1,29 +1,37 @@
 import asyncio
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
 from datetime import timedelta
 from logging import debug
 from pathlib import Path
-from typing import Literal
-from uuid import UUID
+from typing import Literal, NamedTuple
 
 import structlog
-from bs4 import BeautifulSoup, Tag
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import AIMessage, BaseMessage
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.conf import settings
-from app.core.errors import AppError
+from app.core.errors import AppError, StageTimeoutError
 from app.core.llm import (
     ImageLLMModelName,
     LLMModelName,
-    get_llm,
+    get_llm_with_tools,
     load_prompts,
 )
+from app.core.telemetry import record_tokens
+from app.core.timeouts import StageTimeouts, stage
 
 # from app.db import AsyncSessionMaker
 from app.db import AsyncSessionMaker
 from app.models.base import utc_now
+from app.tg.agents.drafts import RELEVANT_POST_PROMPT, Draft
 from app.tg.agents.models import (
+    LLMCallUsage,
+    LLMUsage,
     PostGenerationMetadata,
     PostUpdateMetadata,
     TGAgent,
@@ -32,6 +40,13 @@ from app.tg.agents.models import (
     TGAgentJobType,
     TGAgentStatus,
 )
+from app.tg.agents.post_generator.prompt_budget import fit_prompt, fit_tool_messages
+from app.tg.agents.post_generator.recorder import (
+    JobRecorder,
+    JobRecording,
+    PostGeneratorCalls,
+    should_record,
+)
 from app.tg.agents.post_generator.tools.content_provider import ContentProvider
 from app.tg.agents.post_generator.tools.image_generator import (
     ImageGenerator,
@@ -41,9 +56,13 @@ from app.tg.agents.post_generator.tools.publisher import Publisher
 from app.tg.agents.post_generator.tools.scraper import Scraper
 from app.tg.agents.services import TGAgentJobService, TGAgentService
 from app.tg.credits.services import spend_credits
+from app.tgbot.formatting import sanitize_html
 
 logger = structlog.get_logger()
 
+# characters, the image is generated only for the shorter posts
+MAX_IMAGE_POST_LENGTH = 1000
+
 
 class MainPrompts(BaseModel):
     system_prompt: str
@@ -81,6 +100,40 @@ except:
     raise
 
 
+class PostGeneratorTemplates(NamedTuple):
+    generate_post: ChatPromptTemplate
+    update_post: ChatPromptTemplate
+
+
+def _build_templates(prompts: GeneratePrompts) -> PostGeneratorTemplates:
+    """
+    The user's request is a template variable, braces in it aren't parsed
+    """
+    return PostGeneratorTemplates(
+        generate_post=ChatPromptTemplate(
+            [
+                ("system", prompts.main.system_prompt),
+                ("system", prompts.define_action.system_prompt),
+                ("user", "{user_prompt}"),
+            ]
+        ),
+        update_post=ChatPromptTemplate(
+            [
+                ("system", prompts.main.system_prompt),
+                ("system", prompts.update_post.system_prompt),
+                ("user", prompts.update_post.user_prompt),
+                ("user", "{user_prompt}"),
+            ]
+        ),
+    )
+
+
+TEMPLATES = {
+    lang: _build_templates(getattr(PROMPTS, lang))
+    for lang in PostGeneratorPrompts.model_fields
+}
+
+
 class PostGenerator:
     def __init__(
         self,
@@ -89,17 +142,26 @@ class PostGenerator:
         lang: Literal["en", "ru"] = "ru",
         model: LLMModelName = "o4-mini",
         image_model: ImageLLMModelName = "recraft-ai/recraft-v3",
+        timeouts: StageTimeouts | None = None,
+        calls: PostGeneratorCalls | None = None,
     ) -> None:
         self.db_session_maker = db_session_maker
         self.db_session = db_session
 
         self.model: LLMModelName = model
         self.image_model: ImageLLMModelName = image_model
+        self.timeouts = timeouts or StageTimeouts()
 
         self.lang = lang
         self.prompts = getattr(PROMPTS, lang)
-
-    async def generate(self, job: TGAgentJob) -> str:
+        self.templates = TEMPLATES[lang]
+        self.llm_usage = LLMUsage()
+        self.calls = calls or PostGeneratorCalls()
+
+    async def generate(self, job: TGAgentJob, draft: Draft | None = None) -> str:
+        """
+        draft: taken from the pool, the credits are spent as for a generated post
+        """
         job = self._validate_job(job)
 
         agent_svc = TGAgentService(self.db_session)
@@ -107,19 +169,49 @@ class PostGenerator:
 
         if not job.agent_id:
             raise AppError("Job is detached from agent", job_id=job.id)
-        agent = await agent_svc.get(job.agent_id, with_bot=True)
+        async with stage("db", self.timeouts.db):
+            agent = await agent_svc.get(job.agent_id, with_bot=True)
         agent = self._validate_agent(agent, job)
 
         if not agent.tg_user_id:
             raise AppError("Agent is orphaned", agent_id=agent.id)
 
-        async with spend_credits(self.db_session, agent.tg_user_id, 1):
+        async with (
+            stage("db", self.timeouts.db),
+            spend_credits(self.db_session, agent.tg_user_id, 1),
+        ):
             job = await agent_job_svc.in_progress(job.id)
+        if draft:
+            return draft.text
+
+        async with self._recording(job, agent) as recording:
+            message_post = await self._generate_post(job, agent)
+            if recording:
+                recording.result = message_post
+        return sanitize_html(message_post)
+
+    async def generate_draft(self, agent: TGAgent) -> str:
+        """
+        Post for the pool of the agent, without a job and the credits
+        """
+        job = TGAgentJob(
+            tg_user_id=agent.tg_user_id,
+            agent_id=agent.id,
+            type_=TGAgentJobType.POST_GENERATION,
+            metadata_={
+                "user_prompt": RELEVANT_POST_PROMPT,
+                "chat_id": agent.tg_user_id,
+            },
+        )
+        agent = self._validate_agent(agent, job)
+        return sanitize_html(await self._generate_post(job, agent))
 
-        message_post = await self._generate_post(job, agent)
-        return keep_only_allowed_tags(message_post)
-
-    async def update(self, job: TGAgentJob) -> dict[str, str | None]:
+    async def update(
+        self, job: TGAgentJob, image: str | None = None
+    ) -> dict[str, str | None]:
+        """
+        image: generated ahead, attached instead of generating one if asked for
+        """
         job = self._validate_job(job)
 
         agent_svc = TGAgentService(self.db_session)
@@ -127,35 +219,37 @@ class PostGenerator:
 
         if not job.agent_id:
             raise AppError("Job is detached from agent", job_id=job.id)
-        agent = await agent_svc.get(job.agent_id, with_bot=True)
-        agent = self._validate_agent(agent, job)
-
-        job = await agent_job_svc.in_progress(job.id)
+        async with stage("db", self.timeouts.db):
+            agent = await agent_svc.get(job.agent_id, with_bot=True)
+            agent = self._validate_agent(agent, job)
+            job = await agent_job_svc.in_progress(job.id)
 
-        output = await self._update_post(job, agent)
+        async with self._recording(job, agent) as recording:
+            output = await self._update_post(job, agent, image)
+            if recording:
+                recording.result = output
         message_post = output.get("message")
         if message_post:
-            output["message"] = keep_only_allowed_tags(message_post)
+            output["message"] = sanitize_html(message_post)
         return output
 
     async def _generate_post(self, job: TGAgentJob, agent: TGAgent) -> str:
         metadata = PostGenerationMetadata.model_validate(job.metadata_)
-        tools = {
-            "content_provider": ContentProvider(**agent.get_summary()),
-            "web_page_scraper": Scraper(),
+        tools: dict[str, ContentProvider | Scraper] = {
+            "content_provider": ContentProvider(
+                **agent.get_summary(), timeout=self.timeouts.tool
+            ),
+            "web_page_scraper": Scraper(timeout=self.timeouts.tool),
         }
-        llm = get_llm(self.model).bind_tools(list(tools.values()))
+        llm = get_llm_with_tools(self.model, list(tools.values()))
 
-        prompt_template = ChatPromptTemplate(
-            [
-                ("system", self.prompts.main.system_prompt),
-                ("system", self.prompts.define_action.system_prompt),
-                ("user", metadata.user_prompt),
-            ]
+        messages, usage = fit_prompt(
+            "generate_post",
+            self.templates.generate_post,
+            {**agent.get_summary(), "user_prompt": metadata.user_prompt},
+            self.model,
         )
-
-        messages = prompt_template.format_messages(**agent.get_summary())
-        result = await llm.ainvoke(messages)
+        result = await self._ainvoke(llm, messages, usage)
 
         # how to build messages?
         if tool_calls := getattr(result, "tool_calls", []):
@@ -163,49 +257,48 @@ class PostGenerator:
             for tool_call in tool_calls:
                 tool = tools[tool_call["name"]]
                 tool_call["args"]["user_prompt"] = metadata.user_prompt
-                output = await tool.ainvoke(tool_call)
+                async with stage(f"tool:{tool.name}", tool.timeout):
+                    output = await self.calls.tool(tool, tool_call)
                 messages.append(output)
-            result = await llm.ainvoke(messages)
+            usage = fit_tool_messages("generate_post:tools", messages, self.model)
+            result = await self._ainvoke(llm, messages, usage)
 
         if not isinstance(result.content, str):
             raise AppError("result.content is not a string", job_id=job.id)
         return result.content
 
     async def _update_post(
-        self, job: TGAgentJob, agent: TGAgent
+        self, job: TGAgentJob, agent: TGAgent, ready_image: str | None = None
     ) -> dict[str, str | None]:
         tg_user_id = agent.tg_user_id
         if not tg_user_id:
             raise AppError("Agent is orphaned", agent_id=agent.id)
         metadata = PostUpdateMetadata.model_validate(job.metadata_)
-        tools = {
+        tools: dict[str, Publisher | ImageGenerator] = {
             "publish": Publisher(
                 chat_id=metadata.chat_id,
+                timeout=self.timeouts.telegram,
             ),
             "image_generator": ImageGenerator(
                 model=self.model,
                 image_model=self.image_model,
                 prompts=self.prompts.image_generator_query_builder,
+                timeout=self.timeouts.image,
             ),
         }
-        llm = get_llm(self.model).bind_tools(list(tools.values()))
+        llm = get_llm_with_tools(self.model, list(tools.values()))
 
-        prompt_template = ChatPromptTemplate(
-            [
-                ("system", self.prompts.main.system_prompt),
-                ("system", self.prompts.update_post.system_prompt),
-                ("user", self.prompts.update_post.user_prompt),
-                ("user", metadata.user_prompt),
-            ]
-        )
-
-        messages = prompt_template.format_messages(
-            **{
+        messages, usage = fit_prompt(
+            "update_post",
+            self.templates.update_post,
+            {
                 **agent.get_summary(),
                 "original_message": metadata.original_message,
-            }
+                "user_prompt": metadata.user_prompt,
+            },
+            self.model,
         )
-        result = await llm.ainvoke(messages)
+        result = await self._ainvoke(llm, messages, usage)
         debug(result)
 
         image = None
@@ -217,11 +310,12 @@ class PostGenerator:
                 if tool_call["name"] == "publish":
                     tool_call["args"]["post"] = metadata.original_message
                     tool_call["args"]["job_id"] = job.id
-                    await tool.ainvoke(tool_call)
+                    async with stage("telegram", tool.timeout):
+                        await self.calls.tool(tool, tool_call)
                     return {}
                 elif tool_call["name"] == "image_generator":
                     # TODO: refactor
-                    if len(metadata.original_message) > 1000:
+                    if len(metadata.original_message) > MAX_IMAGE_POST_LENGTH:
                         raise AppError(
                             "Message is too long for generating image",
                             job_id=job.id,
@@ -229,17 +323,25 @@ class PostGenerator:
                         )
                     tool_call["args"]["post"] = metadata.original_message
                     try:
-                        async with spend_credits(self.db_session, tg_user_id, 1):
-                            result = await tool.ainvoke(tool_call)
-                            image = (
-                                result.content
-                                if isinstance(result.content, str)
-                                else None
-                            )
+                        async with (
+                            spend_credits(self.db_session, tg_user_id, 1),
+                            stage("image", tool.timeout),
+                        ):
+                            if ready_image:
+                                image = ready_image
+                            else:
+                                result = await self.calls.tool(tool, tool_call)
+                                image = (
+                                    result.content
+                                    if isinstance(result.content, str)
+                                    else None
+                                )
                             if not image:
                                 raise AppError(
                                     "Could not generate image", job_id=job.id
                                 )
+                    except StageTimeoutError:
+                        raise
                     except Exception as e:
                         logger.exception(e)
                     message = metadata.original_message
@@ -248,6 +350,61 @@ class PostGenerator:
             raise AppError("result.content is not a string", job_id=job.id)
         return {"image": image, "message": message}
 
+    async def _ainvoke(
+        self,
+        llm: Runnable[LanguageModelInput, BaseMessage],
+        messages: list[BaseMessage],
+        usage: LLMCallUsage,
+    ) -> BaseMessage:
+        async with stage("llm", self.timeouts.llm):
+            result = await self.calls.llm(llm, messages, usage)
+        if isinstance(result, AIMessage) and result.usage_metadata:
+            usage.input_tokens = result.usage_metadata["input_tokens"]
+            usage.output_tokens = result.usage_metadata["output_tokens"]
+        record_tokens(
+            usage.model,
+            usage.input_tokens or usage.prompt_tokens,
+            usage.output_tokens or 0,
+        )
+        self.llm_usage.calls.append(usage)
+        return result
+
+    @asynccontextmanager
+    async def _recording(
+        self, job: TGAgentJob, agent: TGAgent
+    ) -> AsyncGenerator[JobRecording | None, None]:
+        """
+        Records the LLM and tool calls of the job for bench.replay when enabled
+        """
+        directory = settings.POST_GENERATOR_RECORD_DIR
+        if directory is None or not agent.tg_user_id or not should_record():
+            yield None
+            return
+
+        recording = JobRecording(
+            job_id=job.id,
+            job_type=job.type_,
+            job_metadata=job.metadata_,
+            agent=agent.get_summary(),
+            tg_user_id=agent.tg_user_id,
+            lang=self.lang,
+            model=self.model,
+            image_model=self.image_model,
+            recorded_at=utc_now(),
+        )
+        recorder = JobRecorder(recording, self.calls)
+        calls, self.calls = self.calls, recorder
+        recorder.start()
+        try:
+            yield recording
+        except BaseException as e:
+            recording.error = repr(e)
+            raise
+        finally:
+            recorder.stop()
+            self.calls = calls
+            await asyncio.shield(recorder.save(directory))
+
     def _validate_agent(self, agent: TGAgent | None, job: TGAgentJob) -> TGAgent:
         if not agent:
             raise AppError("Agent not found", job_id=job.id)
@@ -294,14 +451,3 @@ def check_if_job_staled(job: TGAgentJob, minutes: int = 30) -> None:
         and job.status_changed_at < (utc_now() - timedelta(minutes=minutes))
     ):
         raise AppError("Job is staled", job_id=job.id)
-
-
-def keep_only_allowed_tags(html: str) -> str:
-    allowed_tags = {"a", "b", "i", "pre", "u", "s", "code"}
-    soup = BeautifulSoup(html, "html.parser")
-
-    for tag in soup.find_all(True):
-        if isinstance(tag, Tag) and tag.name not in allowed_tags:
-            tag.unwrap()
-
-    return str(soup)
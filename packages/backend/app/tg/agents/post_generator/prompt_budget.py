@@ -0,0 +1,174 @@
+"""
+Token budget of the prompts
+
+The agent context sections are counted with the model's tokenizer and the
+lowest-priority sections are trimmed until the prompt fits the model's budget.
+The user's request and the post being updated are never trimmed.
+"""
+
+import functools
+import math
+from collections.abc import Mapping
+from typing import Any
+
+import structlog
+import tiktoken
+from langchain_core.messages import BaseMessage, ToolMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+from app.core.llm import LLMModelName
+from app.tg.agents.models import LLMCallUsage
+
+logger = structlog.get_logger()
+
+# tokens of the whole prompt including tool results, the rest of the context
+# window is left for the answer
+PROMPT_BUDGETS: dict[LLMModelName, int] = {
+    "gpt-4o": 12_000,
+    "o4-mini": 12_000,
+    "o3": 12_000,
+}
+# trimmed first to last, the other sections are never trimmed
+TRIM_ORDER = (
+    "channel_profile_generated",
+    "channel_description",
+    "content_description",
+    "persona_description",
+)
+# chat format overhead per message
+MESSAGE_TOKENS = 4
+# used when the tokenizer data can't be loaded, Cyrillic is about 3 chars a token
+CHARS_PER_TOKEN = 3
+TRIMMED_MARK = "…"
+
+
+@functools.cache
+def _encoding(model: str) -> tiktoken.Encoding | None:
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # the BPE file is downloaded on first use and cached in TIKTOKEN_CACHE_DIR
+        logger.warning(f"Tokenizer is unavailable, estimating tokens: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: list[BaseMessage], model: str) -> int:
+    return sum(
+        count_tokens(str(message.content), model) + MESSAGE_TOKENS
+        for message in messages
+    )
+
+
+def truncate(text: str, max_tokens: int, model: str) -> str:
+    """
+    Keeps the beginning, cut at a line break when there is one nearby
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = _encoding(model)
+    if encoding is None:
+        kept = text[: max_tokens * CHARS_PER_TOKEN]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        kept = encoding.decode(tokens[:max_tokens])
+    if len(kept) >= len(text):
+        return text
+    line_break = kept.rfind("\n")
+    if line_break > len(kept) * 0.8:
+        kept = kept[:line_break]
+    return kept.rstrip() + TRIMMED_MARK
+
+
+def fit_prompt(
+    name: str,
+    template: ChatPromptTemplate,
+    values: Mapping[str, Any],
+    model: LLMModelName,
+) -> tuple[list[BaseMessage], LLMCallUsage]:
+    """
+    Formats the template, trimming the context sections to the model's budget
+    """
+    budget = PROMPT_BUDGETS[model]
+    values = dict(values)
+    sections = {
+        section: count_tokens(str(values[section] or ""), model)
+        for section in TRIM_ORDER
+        if section in values
+    }
+    fixed_tokens = count_message_tokens(
+        template.format_messages(**{**values, **dict.fromkeys(sections, "")}),
+        model,
+    )
+
+    excess = fixed_tokens + sum(sections.values()) - budget
+    trimmed: dict[str, int] = {}
+    for section, tokens in sections.items():
+        if excess <= 0:
+            break
+        cut = min(excess, tokens)
+        values[section] = truncate(str(values[section] or ""), tokens - cut, model)
+        trimmed[section] = cut
+        excess -= cut
+    if trimmed:
+        logger.info(f"Prompt {name} is trimmed to the budget", trimmed=trimmed)
+
+    messages = template.format_messages(**values)
+    return messages, LLMCallUsage(
+        name=name,
+        model=model,
+        budget=budget,
+        prompt_tokens=count_message_tokens(messages, model),
+        trimmed_tokens=trimmed,
+    )
+
+
+def fit_tool_messages(
+    name: str, messages: list[BaseMessage], model: LLMModelName
+) -> LLMCallUsage:
+    """
+    Trims the tool results in place to what is left of the budget
+    """
+    budget = PROMPT_BUDGETS[model]
+    tool_messages = [m for m in messages if isinstance(m, ToolMessage)]
+    used = count_message_tokens(
+        [m for m in messages if not isinstance(m, ToolMessage)], model
+    )
+    tool_tokens = [count_tokens(str(m.content), model) for m in tool_messages]
+
+    trimmed = 0
+    if tool_messages and used + sum(tool_tokens) > budget:
+        # share the rest evenly, a short result leaves its share to the others
+        available = max(budget - used - MESSAGE_TOKENS * len(tool_messages), 0)
+        by_size = sorted(
+            zip(tool_tokens, tool_messages, strict=True), key=lambda t: t[0]
+        )
+        for i, (tokens, message) in enumerate(by_size):
+            share = available // (len(by_size) - i)
+            if tokens > share:
+                message.content = truncate(str(message.content), share, model)
+                trimmed += tokens - share
+                tokens = share
+            available -= tokens
+        logger.info(
+            f"Tool results of {name} are trimmed to the budget", trimmed=trimmed
+        )
+
+    return LLMCallUsage(
+        name=name,
+        model=model,
+        budget=budget,
+        prompt_tokens=count_message_tokens(messages, model),
+        trimmed_tokens={"tool_results": trimmed} if trimmed else {},
+    )
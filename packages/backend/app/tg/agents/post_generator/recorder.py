@@ -0,0 +1,201 @@
+import asyncio
+import functools
+import gzip
+import random
+import re
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+from uuid import UUID
+
+import structlog
+from langchain_community.tools import BaseTool
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import BaseMessage, ToolCall, message_to_dict
+from langchain_core.runnables import Runnable
+from pydantic import BaseModel, SecretStr
+
+from app.conf import settings
+from app.core.timeouts import observe_stages
+from app.tg.agents.models import AgentSummary, LLMCallUsage, TGAgentJobType
+
+logger = structlog.get_logger()
+
+REDACTED = "[REDACTED]"
+# bot tokens and provider keys that aren't in the settings, e.g. of the user bots
+SECRET_PATTERN = re.compile(
+    r"\b\d{6,12}:[\w-]{30,}|\bsk-[\w-]{20,}|\br8_\w{20,}|\bAIza[\w-]{30,}"
+)
+
+_current_recorder: ContextVar["JobRecorder | None"] = ContextVar(
+    "current_recorder", default=None
+)
+
+
+class RecordedLLMCall(BaseModel):
+    usage: LLMCallUsage
+    messages: list[dict[str, Any]]
+    response: dict[str, Any]
+    seconds: float
+
+
+class RecordedToolCall(BaseModel):
+    name: str
+    args: dict[str, Any]
+    output: dict[str, Any]
+    seconds: float
+
+
+class RecordedStage(BaseModel):
+    name: str
+    seconds: float
+    failed: bool
+
+
+class JobRecording(BaseModel):
+    """
+    Everything a post generation or update depends on besides the database
+    """
+
+    job_id: UUID
+    job_type: TGAgentJobType
+    job_metadata: dict[str, str | int]
+    agent: AgentSummary
+    tg_user_id: int
+    lang: str
+    model: str
+    image_model: str
+    recorded_at: datetime
+    llm_calls: list[RecordedLLMCall] = []
+    tool_calls: list[RecordedToolCall] = []
+    stages: list[RecordedStage] = []
+    seconds: float | None = None
+    result: str | dict[str, str | None] | None = None
+    error: str | None = None
+
+
+class PostGeneratorCalls:
+    """
+    The LLM and tool calls of PostGenerator, recorded or replayed by the subclasses
+    """
+
+    async def llm(
+        self,
+        llm: Runnable[LanguageModelInput, BaseMessage],
+        messages: list[BaseMessage],
+        usage: LLMCallUsage,
+    ) -> BaseMessage:
+        return await llm.ainvoke(messages)
+
+    async def tool(self, tool: BaseTool, tool_call: ToolCall) -> BaseMessage:
+        output: BaseMessage = await tool.ainvoke(tool_call)
+        return output
+
+
+class JobRecorder(PostGeneratorCalls):
+    def __init__(self, recording: JobRecording, calls: PostGeneratorCalls) -> None:
+        self.recording = recording
+        self.calls = calls
+
+    async def llm(
+        self,
+        llm: Runnable[LanguageModelInput, BaseMessage],
+        messages: list[BaseMessage],
+        usage: LLMCallUsage,
+    ) -> BaseMessage:
+        sent = [message_to_dict(message) for message in messages]
+        started_at = time.perf_counter()
+        response = await self.calls.llm(llm, messages, usage)
+        self.recording.llm_calls.append(
+            RecordedLLMCall(
+                usage=usage.model_copy(),
+                messages=sent,
+                response=message_to_dict(response),
+                seconds=time.perf_counter() - started_at,
+            )
+        )
+        return response
+
+    async def tool(self, tool: BaseTool, tool_call: ToolCall) -> BaseMessage:
+        args = dict(tool_call["args"])
+        started_at = time.perf_counter()
+        output = await self.calls.tool(tool, tool_call)
+        self.recording.tool_calls.append(
+            RecordedToolCall(
+                name=tool.name,
+                args=args,
+                output=message_to_dict(output),
+                seconds=time.perf_counter() - started_at,
+            )
+        )
+        return output
+
+    def start(self) -> None:
+        """
+        Stages of the current task are recorded until stop()
+        """
+        self._started_at = time.perf_counter()
+        self._token = _current_recorder.set(self)
+
+    def stop(self) -> None:
+        _current_recorder.reset(self._token)
+        self.recording.seconds = time.perf_counter() - self._started_at
+
+    async def save(self, directory: Path) -> None:
+        """
+        Best effort, the job result doesn't depend on it
+        """
+        path = directory / f"{self.recording.job_id}.json.gz"
+        try:
+            data = redact(self.recording.model_dump_json())
+            await asyncio.to_thread(_write, path, gzip.compress(data.encode()))
+        except Exception as e:
+            logger.warning(
+                f"Can't save job recording: {e}", job_id=self.recording.job_id
+            )
+
+
+def should_record() -> bool:
+    return (
+        settings.POST_GENERATOR_RECORD_DIR is not None
+        and random.random() < settings.POST_GENERATOR_RECORD_RATE
+    )
+
+
+def redact(data: str) -> str:
+    for secret in _secrets():
+        data = data.replace(secret, REDACTED)
+    return SECRET_PATTERN.sub(REDACTED, data)
+
+
+def load_recording(path: Path) -> JobRecording:
+    return JobRecording.model_validate_json(gzip.decompress(path.read_bytes()))
+
+
+@functools.cache
+def _secrets() -> list[str]:
+    secrets = []
+    for name in type(settings).model_fields:
+        value = getattr(settings, name)
+        if isinstance(value, SecretStr) and len(value.get_secret_value()) >= 8:
+            secrets.append(value.get_secret_value())
+    # the longest first, a key may contain a shorter one
+    return sorted(secrets, key=len, reverse=True)
+
+
+def _write(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def _observe_stage(name: str, seconds: float, failed: bool) -> None:
+    if recorder := _current_recorder.get():
+        recorder.recording.stages.append(
+            RecordedStage(name=name, seconds=seconds, failed=failed)
+        )
+
+
+if settings.POST_GENERATOR_RECORD_DIR is not None:
+    observe_stages(_observe_stage)
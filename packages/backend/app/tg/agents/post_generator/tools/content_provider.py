@@ -7,12 +7,19 @@ from langchain_core.tools import BaseTool
 from langchain_google_community import GoogleSearchAPIWrapper
 
 from app.conf import settings
-from app.core.errors import AppError
+from app.core.circuit_breaker import call_provider
+from app.core.errors import AppError, CircuitOpenError
+from app.core.timeouts import stage
 from app.tg.agents.post_generator.tools.scraper import Scraper
 from app.tg.agents.post_generator.tools.search_query_builder import SearchQueryBulder
 
 logger = structlog.get_logger()
 
+NO_WEB_CONTENT: dict[str, Any] = {
+    "data": "",
+    "message": "Web search is temporarily unavailable, answer without web content",
+}
+
 
 class ContentProvider(BaseTool):
     name: str = "content_provider"
@@ -24,6 +31,9 @@ class ContentProvider(BaseTool):
     content_description: str
     persona_description: str
 
+    # seconds, covers query building, search and scraping
+    timeout: float = 60
+
     def __init__(self, *arg: Any, **kwargs: Any) -> None:
         super().__init__(*arg, **kwargs)
 
@@ -43,12 +53,24 @@ class ContentProvider(BaseTool):
 
         logger.debug(f"Generated search queries: {queries}")
 
-        results = await self._search_google(queries[0])
+        try:
+            results = await self._search_google(queries[0])
+        except CircuitOpenError:
+            logger.warning("Google search is unavailable, falling back to DuckDuckGo")
+            try:
+                results = await self._search_duckduckgo(queries[0])
+            except CircuitOpenError:
+                logger.warning("Web search is unavailable, skipping web content")
+                return NO_WEB_CONTENT
 
         logger.debug(f"Search result: {results}")
 
+        if not results:
+            return NO_WEB_CONTENT
         result = results[0]
-        result["data"] = await Scraper().ainvoke(result["link"])
+        scraper = Scraper()
+        async with stage(f"tool:{scraper.name}", scraper.timeout):
+            result["data"] = await scraper.ainvoke(result["link"])
         return result
 
     async def _search_duckduckgo(
@@ -60,7 +82,10 @@ class ContentProvider(BaseTool):
         search = DuckDuckGoSearchResults(
             num_results=num_results, output_format="list", **kwargs
         )
-        return cast(list[dict[str, Any]], await search.ainvoke(query))
+        return cast(
+            list[dict[str, Any]],
+            await call_provider("duckduckgo", lambda: search.ainvoke(query)),
+        )
 
     async def _search_google(
         self,
@@ -78,7 +103,10 @@ class ContentProvider(BaseTool):
                 list[dict[str, Any]], api_wrapper.results(query, num_results, **kwargs)
             )
 
-        result = await asyncio.get_running_loop().run_in_executor(
-            None, sync_search, query
+        result = await call_provider(
+            "google",
+            lambda: asyncio.get_running_loop().run_in_executor(
+                None, sync_search, query
+            ),
         )
         return result
@@ -1,3 +1,4 @@
+import functools
 from logging import debug
 
 from langchain_community.tools import BaseTool
@@ -12,6 +13,16 @@ class ImageGeneratorQueryBuilderPrompts(BaseModel):
     system_prompt: str
 
 
+@functools.cache
+def _get_prompt_template(system_prompt: str) -> ChatPromptTemplate:
+    return ChatPromptTemplate(
+        [
+            ("system", system_prompt),
+            ("user", "{post}"),
+        ]
+    )
+
+
 class ImageGenerator(BaseTool):
     """
     Generates image for the post
@@ -24,17 +35,16 @@ class ImageGenerator(BaseTool):
     model: LLMModelName
     image_model: ImageLLMModelName
 
+    # seconds, covers prompt building and the image prediction
+    timeout: float = 120
+
     def _run(self) -> None:
         raise AppError("This tool is not designed to be run synchronously.")
 
     async def _arun(self, post: str) -> str:
-        prompt_template = ChatPromptTemplate(
-            [
-                ("system", self.prompts.system_prompt),
-                ("user", post),
-            ]
+        messages = _get_prompt_template(self.prompts.system_prompt).format_messages(
+            post=post
         )
-        messages = prompt_template.format_messages()
         debug(messages)
 
         llm = get_llm(self.model)
@@ -1,10 +1,11 @@
 from uuid import UUID
 
 from langchain_core.tools import BaseTool
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from app.conf import settings
 from app.core.errors import AppError
+from app.tgbot.bot import Bot
 
 
 class Publisher(BaseTool):
@@ -17,6 +18,9 @@ class Publisher(BaseTool):
 
     chat_id: int
 
+    # seconds
+    timeout: float = 30
+
     def _run(self) -> None:
         raise AppError("This tool is not designed to be run synchronously.")
 
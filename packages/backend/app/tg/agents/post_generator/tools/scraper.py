@@ -1,15 +1,21 @@
 import asyncio
 from typing import Any
+from urllib.parse import urlsplit
 
 import structlog
 import trafilatura
 from langchain_core.tools import BaseTool
 
-from app.core.errors import AppError
+from app.core.circuit_breaker import circuit_breaker
+from app.core.errors import AppError, CircuitOpenError
 
 logger = structlog.get_logger()
 
 
+class ScrapeError(AppError):
+    pass
+
+
 class Scraper(BaseTool):
     name: str = "web_page_scraper"
     description: str = (
@@ -17,9 +23,14 @@ class Scraper(BaseTool):
         "Returns the content in markdown format."
     )
 
+    # seconds
+    timeout: float = 30
+
     async def scrape(self, url: str) -> Any:
         def sync_scrape(url: str) -> str:
             response = trafilatura.fetch_url(url)
+            if response is None:
+                raise ScrapeError("Failed to fetch the page", url=url)
             data = trafilatura.extract(
                 response,
                 output_format="markdown",
@@ -30,7 +41,18 @@ class Scraper(BaseTool):
             return data or ""
 
         logger.debug(f"Scraping URL: {url}")
-        return await asyncio.get_running_loop().run_in_executor(None, sync_scrape, url)
+        # a site that is down shouldn't cost every job the full scraper timeout
+        breaker = circuit_breaker(f"scraper:{urlsplit(url).netloc}", kind="scraper")
+        try:
+            return await breaker.call(
+                lambda: asyncio.get_running_loop().run_in_executor(
+                    None, sync_scrape, url
+                ),
+                is_failure=lambda _: True,
+            )
+        except (ScrapeError, CircuitOpenError) as e:
+            logger.warning(f"Skipping web content: {e}", url=url)
+            return ""
 
     def _run(self, url: str) -> Any:
         raise AppError("This tool is not designed to be run synchronously.")
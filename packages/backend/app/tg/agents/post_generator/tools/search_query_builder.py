@@ -1,8 +1,11 @@
+import functools
 from pathlib import Path
-from typing import Annotated, Any, Literal, TypedDict, cast
+from typing import Any, Literal, TypedDict, cast
 
 import structlog
+from langchain_core.language_models import LanguageModelInput
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
 from langchain_core.tools import BaseTool
 from pydantic import BaseModel
 
@@ -33,6 +36,42 @@ except:
     raise
 
 
+class SearchQueries(TypedDict):
+    queries: list[str]
+
+
+@functools.cache
+def _get_runnables(
+    lang: Literal["en", "ru"],
+) -> tuple[
+    ChatPromptTemplate, Runnable[LanguageModelInput, dict[str, Any] | BaseModel]
+]:
+    """
+    Built once per language, with_structured_output converts the schema on every call
+    """
+    prompts: ContentProviderPrompts = getattr(PROMPTS, lang)
+    prompt_template = ChatPromptTemplate(
+        [
+            ("system", prompts.system_prompt),
+            ("user", "{user_prompt}"),
+        ]
+    )
+    schema = {
+        "title": "SearchQueries",
+        "description": prompts.structured_output,
+        "type": "object",
+        "properties": {
+            "queries": {
+                "type": "array",
+                "items": {"type": "string"},
+                "description": "List of search queries",
+            }
+        },
+        "required": ["queries"],
+    }
+    return prompt_template, get_llm().with_structured_output(schema)
+
+
 class SearchQueryBulder(BaseTool):
     name: str = "search_query_builder"
     description: str = (
@@ -52,7 +91,7 @@ class SearchQueryBulder(BaseTool):
         *args: Any,
         **kwargs: Any,
     ) -> None:
-        super().__init__(prompts=getattr(PROMPTS, lang), *args, **kwargs)
+        super().__init__(lang=lang, prompts=getattr(PROMPTS, lang), *args, **kwargs)
 
     def _run(self) -> None:
         raise AppError("This tool is not designed to be run synchronously.")
@@ -69,21 +108,10 @@ class SearchQueryBulder(BaseTool):
             "user_prompt": user_prompt,
         }
 
-        class SearchQueries(TypedDict):
-            queries: Annotated[list[str], "List of search queries"]
-
-        SearchQueries.__doc__ = self.prompts.structured_output
-
-        prompt_template = ChatPromptTemplate(
-            [
-                ("system", self.prompts.system_prompt),
-                ("user", user_prompt),
-            ]
-        )
+        prompt_template, llm = _get_runnables(self.lang)
         messages = prompt_template.format_messages(**context)
         logger.debug(f"Generated messages {messages}")
 
-        llm = get_llm().with_structured_output(SearchQueries)
         response = cast(SearchQueries, await llm.ainvoke(messages))
 
         return response["queries"]
@@ -0,0 +1,212 @@
+"""
+Scheduled refresh of bot permissions and channel metadata
+
+Connected agents are walked in keyset-paginated batches. All user bots share
+one connection pool, the number of concurrent checks and the request rate to
+Telegram are bounded, and only the agents whose state actually changed are
+written back, with one bulk UPDATE per batch.
+A run that doesn't fit its window leaves a cursor, the next run continues from it.
+"""
+
+import asyncio
+import enum
+import time
+from uuid import UUID
+
+import structlog
+from arq.connections import ArqRedis
+from pydantic import BaseModel
+from redis.exceptions import RedisError
+from telegram.constants import ChatMemberStatus
+from telegram.request import HTTPXRequest
+
+from app.core.metrics import counter
+from app.tg.agents.bot import fetch_member_and_channel, is_access_lost
+from app.tg.agents.models import BotPermissions, ChannelMetadata, TGAgent
+from app.tg.agents.services import TGAgentService
+from app.tgbot.bot import Bot
+
+logger = structlog.get_logger()
+
+AGENTS_REFRESHED = counter(
+    "agents_refreshed_total",
+    "Agents checked by the scheduled refresh of bot permissions and channel metadata",
+    ("result",),
+)
+
+CURSOR_KEY = "viralink:agents_refresh:cursor"
+# getChatMember, getChat and getChatMemberCount
+REQUESTS_PER_AGENT = 3
+
+
+class AgentsRefreshConfig(BaseModel):
+    batch_size: int = 200
+    concurrency: int = 20
+    # across all user bots, Telegram allows about 30 per second per bot
+    requests_per_second: float = 25
+    # a bit less than the schedule interval
+    window_seconds: float = 55 * 60
+
+
+class RefreshResult(str, enum.Enum):
+    UNCHANGED = "unchanged"
+    UPDATED = "updated"
+    LOST_ACCESS = "lost_access"
+    ERROR = "error"
+
+
+class RateLimiter:
+    """
+    Spaces out requests evenly, shared by all concurrent checks
+    """
+
+    def __init__(self, requests_per_second: float) -> None:
+        self.interval = 1 / requests_per_second
+        self._next_at = 0.0
+
+    async def acquire(self, requests: int = 1) -> None:
+        now = time.monotonic()
+        wait = self._next_at - now
+        self._next_at = max(self._next_at, now) + self.interval * requests
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class AgentsRefresher:
+    def __init__(
+        self,
+        agent_svc: TGAgentService,
+        redis: ArqRedis,
+        config: AgentsRefreshConfig | None = None,
+    ) -> None:
+        self.agent_svc = agent_svc
+        self.redis = redis
+        self.config = config or AgentsRefreshConfig()
+        self._semaphore = asyncio.Semaphore(self.config.concurrency)
+        self._rate_limiter = RateLimiter(self.config.requests_per_second)
+        # the token is a part of the URL, so one pool serves all user bots
+        self._request = HTTPXRequest(connection_pool_size=self.config.concurrency)
+        self._bots: dict[str, Bot] = {}
+
+    async def run(self) -> dict[RefreshResult, int]:
+        deadline = time.monotonic() + self.config.window_seconds
+        stats = dict.fromkeys(RefreshResult, 0)
+        cursor = await self._load_cursor()
+        try:
+            while time.monotonic() < deadline:
+                agents = await self.agent_svc.list_connected(
+                    after_id=cursor, limit=self.config.batch_size
+                )
+                if agents:
+                    for result in await self._refresh_batch(agents):
+                        stats[result] += 1
+                        AGENTS_REFRESHED.inc(result=result.value)
+                if len(agents) < self.config.batch_size:
+                    cursor = None
+                    break
+                cursor = agents[-1].id
+            else:
+                logger.warning("Agents refresh didn't fit its window", cursor=cursor)
+        finally:
+            await self._save_cursor(cursor)
+            await self._request.shutdown()
+        logger.info("Agents refreshed", **{k.value: v for k, v in stats.items()})
+        return stats
+
+    async def _refresh_batch(self, agents: list[TGAgent]) -> list[RefreshResult]:
+        checked = await asyncio.gather(*(self._check(agent) for agent in agents))
+
+        updates: list[tuple[UUID, BotPermissions, ChannelMetadata]] = []
+        lost_access: list[UUID] = []
+        new_photos: list[UUID] = []
+        results: list[RefreshResult] = []
+        for agent, state in zip(agents, checked, strict=True):
+            if isinstance(state, RefreshResult):
+                if state == RefreshResult.LOST_ACCESS:
+                    lost_access.append(agent.id)
+                results.append(state)
+                continue
+
+            bot_permissions, channel_metadata = state
+            old_photo = agent.channel_metadata and agent.channel_metadata.photo
+            new_photo = channel_metadata.photo
+            if old_photo and new_photo and old_photo.is_same_photo(new_photo):
+                # keep the uploaded files
+                channel_metadata.photo = new_photo.model_copy(
+                    update={
+                        "small_file_path": old_photo.small_file_path,
+                        "big_file_path": old_photo.big_file_path,
+                    }
+                )
+            elif new_photo:
+                new_photos.append(agent.id)
+
+            if bot_permissions == agent.bot_permissions and _same_channel(
+                agent.channel_metadata, channel_metadata
+            ):
+                results.append(RefreshResult.UNCHANGED)
+                continue
+            updates.append((agent.id, bot_permissions, channel_metadata))
+            results.append(RefreshResult.UPDATED)
+
+        await self.agent_svc.bulk_update_channel_state(updates)
+        await self.agent_svc.bulk_waiting_bot_access(lost_access)
+        for agent_id in new_photos:
+            await self.redis.enqueue_job("fetch_channel_photo", agent_id)
+        return results
+
+    async def _check(
+        self, agent: TGAgent
+    ) -> tuple[BotPermissions, ChannelMetadata] | RefreshResult:
+        async with self._semaphore:
+            await self._rate_limiter.acquire(REQUESTS_PER_AGENT)
+            try:
+                member, channel_metadata = await fetch_member_and_channel(
+                    self._bot(agent.user_bot.api_token),
+                    agent.channel_username,
+                    agent.user_bot.tg_id,
+                )
+            except Exception as e:
+                if is_access_lost(e):
+                    return RefreshResult.LOST_ACCESS
+                logger.warning(f"Can't refresh agent: {e}", agent_id=agent.id)
+                return RefreshResult.ERROR
+
+        if member.status in (ChatMemberStatus.LEFT, ChatMemberStatus.BANNED):
+            return RefreshResult.LOST_ACCESS
+        return BotPermissions(**member.to_dict()), channel_metadata
+
+    def _bot(self, token: str) -> Bot:
+        bot = self._bots.get(token)
+        if bot is None:
+            bot = self._bots[token] = Bot(
+                token, request=self._request, get_updates_request=self._request
+            )
+        return bot
+
+    async def _load_cursor(self) -> UUID | None:
+        try:
+            cursor = await self.redis.get(CURSOR_KEY)
+        except RedisError as e:
+            logger.warning(f"Can't load agents refresh cursor: {e}")
+            return None
+        return UUID(cursor.decode()) if cursor else None
+
+    async def _save_cursor(self, cursor: UUID | None) -> None:
+        try:
+            if cursor is None:
+                await self.redis.delete(CURSOR_KEY)
+            else:
+                # forget it if the schedule stops
+                await self.redis.set(CURSOR_KEY, str(cursor), ex=24 * 60 * 60)
+        except RedisError as e:
+            logger.warning(f"Can't save agents refresh cursor: {e}")
+
+
+def _same_channel(old: ChannelMetadata | None, new: ChannelMetadata) -> bool:
+    """
+    The member count changes all the time, it's only written with other changes
+    """
+    if old is None:
+        return False
+    return old.model_copy(update={"member_count": new.member_count}) == new
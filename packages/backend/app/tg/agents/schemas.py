@@ -1,8 +1,11 @@
+from collections.abc import Mapping
 from datetime import datetime
 from uuid import UUID
 
+from arq.jobs import JobStatus
 from pydantic import BaseModel, ConfigDict, Field
 
+from app.core.signed_urls import sign_urls
 from app.tg.agents.models import (
     BotMetadata,
     ChannelMetadata,
@@ -37,16 +40,47 @@ class TGAgent(BaseModel):
 
     user_bot: TGUserBot | None = None
 
-    def with_signed_urls(self) -> "TGAgent":
+    def file_paths(self) -> list[str]:
+        return self.channel_metadata.file_paths() if self.channel_metadata else []
+
+    def with_signed_urls(self, urls: Mapping[str, str]) -> "TGAgent":
         return self.model_copy(
             update={
-                "channel_metadata": self.channel_metadata.with_signed_urls()
+                "channel_metadata": self.channel_metadata.with_signed_urls(urls)
                 if self.channel_metadata
                 else None,
             }
         )
 
 
+async def sign_agents(agents: list[TGAgent]) -> list[TGAgent]:
+    """
+    Signs the photo URLs of all agents in one batch
+    """
+    urls = await sign_urls(path for agent in agents for path in agent.file_paths())
+    return [agent.with_signed_urls(urls) for agent in agents]
+
+
+async def sign_agent(agent: TGAgent) -> TGAgent:
+    (agent,) = await sign_agents([agent])
+    return agent
+
+
+class CheckBotPermissionsResponse(TGAgent):
+    """
+    Current state of the agent, the check result arrives as an agent status event
+    """
+
+    job_id: str
+
+
+class CheckBotPermissionsJob(BaseModel):
+    job_id: str
+    status: JobStatus
+    # None until the job is complete
+    success: bool | None = None
+
+
 class CreateTGAgentRequest(BaseModel):
     channel_username: str
 
@@ -62,3 +96,24 @@ class AddTGBotRequest(BaseModel):
 
 class LinkTGBotRequest(BaseModel):
     bot_id: UUID
+
+
+class Percentiles(BaseModel):
+    p50: float | None = None
+    p95: float | None = None
+    p99: float | None = None
+
+
+class JobTelemetryStats(BaseModel):
+    """
+    Finished jobs of a model or an agent, seconds and tokens are per job
+    """
+
+    key: str
+    jobs: int
+    seconds: Percentiles
+    prompt_tokens: Percentiles
+    completion_tokens: Percentiles
+    retries: int
+    # by stage, repeated stages are numbered, e.g. llm#2 is the second LLM call
+    stages: dict[str, Percentiles] = {}
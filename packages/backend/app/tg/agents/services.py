@@ -1,18 +1,23 @@
+from datetime import datetime
 from typing import Any, Literal, overload
 from uuid import UUID
 
-from sqlalchemy import sql
+from sqlalchemy import Float, Integer, String, sql
+from sqlalchemy.dialects.postgresql import JSONB, array
 from sqlalchemy.orm import selectinload
 from telegram import ChatFullInfo
 
 from app.core.errors import AppError, ForbiddenError, NotFoundError
+from app.core.telemetry import JobTelemetry
 from app.models.base import ErrorSchema, utc_now
 from app.services import BaseService
+from app.tg.agents.events import publish_agent_status, publish_job_status
 from app.tg.agents.models import (
     BotMetadata,
     BotPermissions,
     ChannelMetadata,
     ChannelProfile,
+    LLMUsage,
     TGAgent,
     TGAgentJob,
     TGAgentJobStatus,
@@ -20,6 +25,11 @@ from app.tg.agents.models import (
     TGAgentStatus,
     TGUserBot,
 )
+from app.tg.agents.schemas import JobTelemetryStats, Percentiles
+
+# see TGAgent.bot_is_connected
+CONNECTED_STATUSES = (TGAgentStatus.WAITING_CHANNEL_PROFILE, TGAgentStatus.ACTIVE)
+PERCENTILES = (0.5, 0.95, 0.99)
 
 
 class TGAgentService(BaseService):
@@ -68,6 +78,29 @@ class TGAgentService(BaseService):
             )
         return list(result.scalars().all())
 
+    async def list_connected(
+        self, *, after_id: UUID | None = None, limit: int = 100
+    ) -> list[TGAgent]:
+        """
+        Agents with a connected bot ordered by id, keyset-paginated by after_id
+        """
+        query = (
+            sql.select(TGAgent)
+            .options(selectinload(TGAgent.user_bot))
+            .filter(
+                TGAgent.status.in_(CONNECTED_STATUSES),
+                TGAgent.user_bot_id.is_not(None),
+                TGAgent.deleted_at.is_(None),
+            )
+            .order_by(TGAgent.id)
+            .limit(limit)
+        )
+        if after_id is not None:
+            query = query.filter(TGAgent.id > after_id)
+        async with self.tx():
+            result = await self.db_session.execute(query)
+        return list(result.scalars().all())
+
     async def list_bots(self, tg_user_id: int) -> list[TGUserBot]:
         async with self.tx():
             result = await self.db_session.execute(
@@ -92,7 +125,9 @@ class TGAgentService(BaseService):
                 )
                 .returning(TGAgent)
             )
-        return result.scalar_one()
+        agent = result.scalar_one()
+        await publish_agent_status(agent)
+        return agent
 
     async def delete(self, agent_id: UUID, tg_user_id: int) -> TGAgent:
         async with self.tx():
@@ -131,6 +166,7 @@ class TGAgentService(BaseService):
 
             agent.user_bot = bot
             agent.status = TGAgentStatus.WAITING_BOT_ACCESS
+        await publish_agent_status(agent)
         return agent
 
     async def link_bot(self, agent_id: UUID, tg_user_id: int, bot_id: UUID) -> TGAgent:
@@ -157,6 +193,7 @@ class TGAgentService(BaseService):
 
             agent.user_bot = bot
             agent.status = TGAgentStatus.WAITING_BOT_ACCESS
+        await publish_agent_status(agent)
         return agent
 
     async def waiting_bot_attach(self, agent_id: UUID) -> TGAgent:
@@ -172,7 +209,9 @@ class TGAgentService(BaseService):
                 )
                 .returning(TGAgent)
             )
-        return result.scalar_one()
+        agent = result.scalar_one()
+        await publish_agent_status(agent)
+        return agent
 
     async def waiting_bot_access(self, agent_id: UUID) -> TGAgent:
         async with self.tx():
@@ -187,7 +226,9 @@ class TGAgentService(BaseService):
                 )
                 .returning(TGAgent)
             )
-        return result.scalar_one()
+        agent = result.scalar_one()
+        await publish_agent_status(agent)
+        return agent
 
     async def waiting_channel_profile(self, agent_id: UUID) -> TGAgent:
         async with self.tx():
@@ -202,7 +243,9 @@ class TGAgentService(BaseService):
                 )
                 .returning(TGAgent)
             )
-        return result.scalar_one()
+        agent = result.scalar_one()
+        await publish_agent_status(agent)
+        return agent
 
     async def activate(self, agent_id: UUID) -> TGAgent:
         async with self.tx():
@@ -227,6 +270,7 @@ class TGAgentService(BaseService):
             agent.status_changed_at = utc_now()
             agent.status_error = None
             agent.status_errored_at = None
+        await publish_agent_status(agent)
         return agent
 
     async def update_bot_permissions(
@@ -274,6 +318,54 @@ class TGAgentService(BaseService):
             agent = result.scalar_one()
         return agent
 
+    async def bulk_update_channel_state(
+        self, updates: list[tuple[UUID, BotPermissions, ChannelMetadata]]
+    ) -> None:
+        """
+        Writes refreshed permissions and metadata in one UPDATE by primary key
+        """
+        if not updates:
+            return
+        async with self.tx():
+            await self.db_session.execute(
+                sql.update(TGAgent),
+                [
+                    {
+                        "id": agent_id,
+                        "bot_permissions": bot_permissions,
+                        "channel_id": channel_metadata.id,
+                        "channel_metadata": channel_metadata,
+                    }
+                    for agent_id, bot_permissions, channel_metadata in updates
+                ],
+            )
+
+    async def bulk_waiting_bot_access(self, agent_ids: list[UUID]) -> list[TGAgent]:
+        """
+        Agents that are no longer connected are skipped
+        """
+        if not agent_ids:
+            return []
+        async with self.tx():
+            result = await self.db_session.execute(
+                sql.update(TGAgent)
+                .filter(
+                    TGAgent.id.in_(agent_ids),
+                    TGAgent.status.in_(CONNECTED_STATUSES),
+                )
+                .values(
+                    status=TGAgentStatus.WAITING_BOT_ACCESS,
+                    status_changed_at=utc_now(),
+                    status_error=None,
+                    status_errored_at=None,
+                )
+                .returning(TGAgent)
+            )
+        agents = list(result.scalars().all())
+        for agent in agents:
+            await publish_agent_status(agent)
+        return agents
+
     async def update_channel_profile(
         self,
         agent_id: UUID,
@@ -323,7 +415,9 @@ class TGAgentService(BaseService):
                 )
                 .returning(TGAgent)
             )
-        return result.scalar_one()
+        agent = result.scalar_one()
+        await publish_agent_status(agent)
+        return agent
 
 
 class TGAgentJobService(BaseService):
@@ -346,7 +440,9 @@ class TGAgentJobService(BaseService):
                 )
                 .returning(TGAgentJob)
             )
-        return result.scalar_one()
+        job = result.scalar_one()
+        await publish_job_status(job)
+        return job
 
     @overload
     async def get(
@@ -402,9 +498,56 @@ class TGAgentJobService(BaseService):
                 )
                 .returning(TGAgentJob)
             )
-        return result.scalar_one()
+        job = result.scalar_one()
+        await publish_job_status(job)
+        return job
+
+    async def append_user_prompt(
+        self, job_id: UUID, tg_user_id: int, user_prompt: str
+    ) -> TGAgentJob | None:
+        """
+        Returns None if the worker has already started the job
+        """
+        merged_user_prompt = (
+            TGAgentJob.metadata_["user_prompt"].astext + "\n" + user_prompt
+        )
+        async with self.tx():
+            result = await self.db_session.execute(
+                sql.update(TGAgentJob)
+                .filter_by(
+                    id=job_id,
+                    tg_user_id=tg_user_id,
+                    type_=TGAgentJobType.POST_GENERATION,
+                    status=TGAgentJobStatus.INITIAL,
+                    deleted_at=None,
+                )
+                .values(
+                    metadata_=TGAgentJob.metadata_.op("||")(
+                        sql.func.jsonb_build_object("user_prompt", merged_user_prompt)
+                    )
+                )
+                .returning(TGAgentJob)
+            )
+        return result.scalar_one_or_none()
+
+    async def save_telemetry(
+        self, job_id: UUID, telemetry: JobTelemetry, llm_usage: LLMUsage | None
+    ) -> None:
+        """
+        Written once when the task has finished, with the LLM usage if there was any
+        """
+        values: dict[str, Any] = {"telemetry": telemetry}
+        if llm_usage:
+            values["llm_usage"] = llm_usage
+        async with self.tx():
+            await self.db_session.execute(
+                sql.update(TGAgentJob).filter_by(id=job_id).values(**values)
+            )
 
-    async def complete(self, job_id: UUID, data: str) -> TGAgentJob:
+    async def complete(self, job_id: UUID, data: str) -> TGAgentJob | None:
+        """
+        Returns None if the job is no longer in progress (e.g. it was replaced)
+        """
         async with self.tx():
             result = await self.db_session.execute(
                 sql.update(TGAgentJob)
@@ -420,4 +563,177 @@ class TGAgentJobService(BaseService):
                 )
                 .returning(TGAgentJob)
             )
-        return result.scalar_one()
+        job = result.scalar_one_or_none()
+        if job:
+            await publish_job_status(job)
+        return job
+
+    async def cancel(self, job_id: UUID) -> TGAgentJob | None:
+        """
+        Returns None if the job has already finished
+        """
+        async with self.tx():
+            result = await self.db_session.execute(
+                sql.update(TGAgentJob)
+                .filter(
+                    TGAgentJob.id == job_id,
+                    TGAgentJob.status.in_(
+                        [TGAgentJobStatus.INITIAL, TGAgentJobStatus.IN_PROGRESS]
+                    ),
+                    TGAgentJob.deleted_at.is_(None),
+                )
+                .values(
+                    status=TGAgentJobStatus.CANCELLED,
+                    status_changed_at=utc_now(),
+                )
+                .returning(TGAgentJob)
+            )
+        job = result.scalar_one_or_none()
+        if job:
+            await publish_job_status(job)
+        return job
+
+    async def fail(self, job_id: UUID, error: AppError) -> TGAgentJob | None:
+        """
+        Returns None if the job has already finished
+        """
+        async with self.tx():
+            result = await self.db_session.execute(
+                sql.update(TGAgentJob)
+                .filter(
+                    TGAgentJob.id == job_id,
+                    TGAgentJob.status.in_(
+                        [TGAgentJobStatus.INITIAL, TGAgentJobStatus.IN_PROGRESS]
+                    ),
+                    TGAgentJob.deleted_at.is_(None),
+                )
+                .values(
+                    status=TGAgentJobStatus.FAILED,
+                    status_changed_at=utc_now(),
+                    status_error=ErrorSchema(
+                        message=error.message,
+                        code=str(error.code) if error.code is not None else None,
+                        details=error.kwargs or None,
+                    ),
+                    status_errored_at=utc_now(),
+                )
+                .returning(TGAgentJob)
+            )
+        job = result.scalar_one_or_none()
+        if job:
+            await publish_job_status(job)
+        return job
+
+    async def telemetry_stats(
+        self,
+        group_by: Literal["model", "agent"],
+        since: datetime,
+        type_: TGAgentJobType | None = None,
+    ) -> list[JobTelemetryStats]:
+        """
+        Percentiles over the jobs with telemetry, computed by the database.
+        A job that called several models counts for each of them.
+        """
+        telemetry = sql.type_coerce(TGAgentJob.telemetry, JSONB)
+        tokens = (
+            sql.func.jsonb_each(telemetry["tokens"])
+            .table_valued(sql.column("key", String), sql.column("value", JSONB))
+            .lateral("tokens")
+        )
+        retries = sql.func.jsonb_each_text(telemetry["retries"]).table_valued(
+            sql.column("value", String)
+        )
+        stages = (
+            sql.func.jsonb_array_elements(telemetry["stages"])
+            .table_valued(sql.column("value", JSONB))
+            .lateral("stages")
+        )
+
+        key: sql.ColumnElement[str]
+        if group_by == "model":
+            key = tokens.c.key
+            prompt_tokens = tokens.c.value["prompt_tokens"].astext.cast(Float)
+            completion_tokens = tokens.c.value["completion_tokens"].astext.cast(Float)
+        else:
+            key = sql.cast(TGAgentJob.agent_id, String)
+            job_tokens = (
+                sql.func.jsonb_each(telemetry["tokens"])
+                .table_valued(sql.column("value", JSONB))
+                .alias("job_tokens")
+            )
+            prompt_tokens, completion_tokens = (
+                sql.select(
+                    sql.func.coalesce(
+                        sql.func.sum(job_tokens.c.value[field].astext.cast(Float)),
+                        0,
+                    )
+                ).scalar_subquery()
+                for field in ("prompt_tokens", "completion_tokens")
+            )
+        filters = [
+            TGAgentJob.telemetry.is_not(None),
+            TGAgentJob.created_at >= since,
+            TGAgentJob.deleted_at.is_(None),
+        ]
+        if type_:
+            filters.append(TGAgentJob.type_ == type_)
+
+        job_rows = sql.select(
+            key.label("key"),
+            sql.func.count().label("jobs"),
+            _percentiles(telemetry["seconds"].astext.cast(Float)).label("seconds"),
+            _percentiles(prompt_tokens).label("prompt_tokens"),
+            _percentiles(completion_tokens).label("completion_tokens"),
+            sql.func.coalesce(
+                sql.func.sum(
+                    sql.select(
+                        sql.func.sum(retries.c.value.cast(Integer))
+                    ).scalar_subquery()
+                ),
+                0,
+            ).label("retries"),
+        )
+        stage_rows = sql.select(
+            key.label("key"),
+            stages.c.value["name"].astext.label("stage"),
+            _percentiles(stages.c.value["seconds"].astext.cast(Float)).label("seconds"),
+        ).join(stages, sql.true())
+        job_rows = job_rows.select_from(TGAgentJob)
+        stage_rows = stage_rows.select_from(TGAgentJob)
+        if group_by == "model":
+            job_rows = job_rows.join(tokens, sql.true())
+            stage_rows = stage_rows.join(tokens, sql.true())
+
+        async with self.tx():
+            job_result = await self.db_session.execute(
+                job_rows.where(*filters).group_by(key)
+            )
+            stage_result = await self.db_session.execute(
+                stage_rows.where(*filters).group_by(key, "stage")
+            )
+
+        stats = {
+            row.key: JobTelemetryStats(
+                key=row.key,
+                jobs=row.jobs,
+                seconds=_to_percentiles(row.seconds),
+                prompt_tokens=_to_percentiles(row.prompt_tokens),
+                completion_tokens=_to_percentiles(row.completion_tokens),
+                retries=row.retries,
+            )
+            for row in job_result
+            if row.key is not None
+        }
+        for row in stage_result:
+            if row.key in stats:
+                stats[row.key].stages[row.stage] = _to_percentiles(row.seconds)
+        return sorted(stats.values(), key=lambda s: s.jobs, reverse=True)
+
+
+def _percentiles(value: sql.ColumnElement[Any]) -> sql.ColumnElement[Any]:
+    return sql.func.percentile_cont(array(PERCENTILES)).within_group(value)
+
+
+def _to_percentiles(values: list[float | None] | None) -> Percentiles:
+    p50, p95, p99 = values or (None, None, None)
+    return Percentiles(p50=p50, p95=p95, p99=p99)
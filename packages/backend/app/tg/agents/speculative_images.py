@@ -0,0 +1,89 @@
+"""
+Speculative images of the generated posts
+
+When the user opted in, the image of a post sent without one is generated by
+the low-priority speculate_image task right after the text. A reply asking for
+the image (update_post) gets it attached without the round trip to the image
+model, the credits are spent then, as for a generated image.
+
+Keys:
+    viralink:speculative_image:{chat_id}:{message_id}  image of the sent post
+    viralink:speculative_image:budget:{tg_user_id}:{date}  images of the UTC day
+
+An image is kept as the provider URL, it expires in an hour. The daily budget
+per user bounds the provider spend on the images nobody asks for.
+"""
+
+from uuid import UUID
+
+import structlog
+from pydantic import BaseModel
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.conf import settings
+from app.core.metrics import counter
+from app.models.base import utc_now
+
+logger = structlog.get_logger()
+
+SPECULATIVE_IMAGES = counter(
+    "speculative_images_total",
+    "Speculative images by result: generated, used, over_budget, busy or failed",
+    ("result",),
+)
+
+# seconds, the provider URLs expire in an hour
+TTL = 50 * 60
+
+
+class SpeculativeImage(BaseModel):
+    job_id: UUID
+    # the sent post
+    chat_id: int
+    message_id: int
+    url: str
+
+
+class SpeculativeImages:
+    def __init__(self, redis: Redis) -> None:
+        self.redis = redis
+
+    async def reserve(self, tg_user_id: int) -> bool:
+        """
+        Counts the image against the daily budget of the user, False if it's spent
+        """
+        key = f"viralink:speculative_image:budget:{tg_user_id}:{utc_now().date()}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.incr(key)
+            pipe.expire(key, 24 * 60 * 60)
+            used, _ = await pipe.execute()
+        if used > settings.SPECULATIVE_IMAGES_DAILY_BUDGET:
+            SPECULATIVE_IMAGES.inc(result="over_budget")
+            return False
+        return True
+
+    async def save(self, image: SpeculativeImage) -> None:
+        await self.redis.set(
+            _key(image.chat_id, image.message_id), image.model_dump_json(), ex=TTL
+        )
+        SPECULATIVE_IMAGES.inc(result="generated")
+
+    async def get(self, chat_id: int, message_id: int) -> SpeculativeImage | None:
+        """
+        Best effort, the image is generated on request without it
+        """
+        try:
+            data = await self.redis.get(_key(chat_id, message_id))
+        except RedisError as e:
+            logger.warning(f"Speculative images are unavailable: {e}")
+            return None
+        return SpeculativeImage.model_validate_json(data) if data else None
+
+    async def used(self, image: SpeculativeImage) -> None:
+        SPECULATIVE_IMAGES.inc(result="used")
+        await self.redis.delete(_key(image.chat_id, image.message_id))
+
+
+def _key(chat_id: int, message_id: int) -> str:
+    return f"viralink:speculative_image:{chat_id}:{message_id}"
@@ -1,38 +1,91 @@
+import asyncio
 import tempfile
 import urllib.request
 from typing import TypeGuard
 from uuid import UUID
 
+import httpx
 import structlog
-from telegram import Bot
-from telegram.constants import ParseMode
 
 from app.conf import settings
-from app.core.errors import AppError
-from app.tg.agents.models import TGAgentJobStatus, TGAgentJobType
+from app.core.errors import (
+    AppError,
+    CircuitOpenError,
+    JobCancelledError,
+    StageTimeoutError,
+)
+from app.core.signed_urls import sign_urls
+from app.core.telemetry import current_telemetry
+from app.core.timeouts import failed_stage, stage
+from app.tg.agents.bot import (
+    PERMISSIONS_CHECK_TTL,
+    check_agent_bot_permissions,
+    permissions_check_key,
+)
+from app.tg.agents.drafts import (
+    Draft,
+    DraftPool,
+    delete_image,
+    image_key,
+    pool_size,
+    profile_version,
+    store_image,
+)
+from app.tg.agents.models import (
+    LLMUsage,
+    PostGenerationMetadata,
+    PostUpdateMetadata,
+    TGAgent,
+    TGAgentJob,
+    TGAgentJobStatus,
+    TGAgentJobType,
+    TGAgentStatus,
+)
 from app.tg.agents.post_generator.post_generator import (
+    MAX_IMAGE_POST_LENGTH,
     PostGenerator,
     check_if_job_staled,
 )
 from app.tg.agents.post_generator.tools.image_generator import ImageGenerator
+from app.tg.agents.refresher import AgentsRefresher, RefreshResult
 from app.tg.agents.services import TGAgentJobService, TGAgentService
+from app.tg.agents.speculative_images import (
+    SPECULATIVE_IMAGES,
+    SpeculativeImage,
+    SpeculativeImages,
+)
 from app.tg.credits.services import spend_credits
-from app.worker.conf import JobContext, task
+from app.tgbot.admission import release_job
+from app.tgbot.auth.services import TGUserService
+from app.tgbot.bot import Bot, send_post
+from app.tgbot.texts import TEXTS
+from app.tgbot.utils import get_texts
+from app.worker.cancellation import cancellable
+from app.worker.conf import JobContext, WorkerSettings, cron_task, task
 
 logger = structlog.get_logger()
 
+# queued jobs, including the running ones
+BUSY_QUEUE_DEPTH = 5
+
 
-@task("generate_post")
+@task("generate_post", timeout=5 * 60)
 async def generate_post(
     ctx: JobContext, job_id: UUID, from_chat_id: int, *, with_photo: bool = False
 ) -> None:
     agent_svc = TGAgentService(ctx.db_session)
     agent_job_svc = TGAgentJobService(ctx.db_session)
 
-    job = await agent_job_svc.get(
-        job_id, required=True, type_=TGAgentJobType.POST_GENERATION
-    )
+    async with stage("db", None):
+        job = await agent_job_svc.get(
+            job_id, required=True, type_=TGAgentJobType.POST_GENERATION
+        )
 
+    if job.status == TGAgentJobStatus.CANCELLED:
+        logger.info("Job was cancelled before it started", job_id=job_id)
+        if job.tg_user_id:
+            await release_job(ctx.redis, job.tg_user_id, job.id)
+        return
     check_if_job_staled(job)
     if job.status != TGAgentJobStatus.INITIAL:
         raise AppError(
@@ -43,46 +96,92 @@ async def generate_post(
     if not job.tg_user_id:
         raise AppError("Job is detached from user", job_id=job_id)
 
-    agent = await agent_svc.get(job.agent_id, required=True, with_bot=True)
+    async with stage("db", None):
+        agent = await agent_svc.get(job.agent_id, required=True, with_bot=True)
     if not agent.tg_user_id:
         raise AppError(
             "Agent is detached from user", job_id=job_id, agent_id=job.agent_id
         )
 
-    async with spend_credits(ctx.db_session, agent.tg_user_id, 1):
-        post_generator = PostGenerator(ctx.db_session_maker, ctx.db_session)
-        post_text = await post_generator.generate(job)
-
-        if with_photo:
-            image_generator = ImageGenerator(
-                model=post_generator.model,
-                image_model=post_generator.image_model,
-                prompts=post_generator.prompts.image_generator_query_builder,
+    draft = None
+    if PostGenerationMetadata.model_validate(job.metadata_).use_draft:
+        draft = await DraftPool(ctx.redis).take(agent)
+        if settings.DRAFT_POOL_SIZES:
+            await ctx.redis.enqueue_job(
+                "refill_drafts", agent.id, _job_id=f"refill_drafts:{agent.id}"
             )
-            image = await image_generator.ainvoke(post_text)
-            image_path = await download_image(image)
 
-            await agent_job_svc.complete(job.id, post_text)
-            await Bot(settings.TGBOT_TOKEN.get_secret_value()).send_photo(
-                from_chat_id,
-                photo=image_path,
-                caption=post_text,
-                parse_mode=ParseMode.HTML,
-            )
-            return
-    await agent_job_svc.complete(job.id, post_text)
+    post_generator = PostGenerator(ctx.db_session_maker, ctx.db_session)
+    timeouts = post_generator.timeouts
+    try:
+        async with (
+            cancellable(ctx.redis, job.id),
+            spend_credits(ctx.db_session, agent.tg_user_id, 1),
+        ):
+            post_text = await post_generator.generate(job, draft)
 
-    await Bot(settings.TGBOT_TOKEN.get_secret_value()).send_message(
-        from_chat_id, post_text, parse_mode=ParseMode.HTML
-    )
+            if with_photo:
+                image_generator = _image_generator(post_generator)
+                try:
+                    async with stage("image", image_generator.timeout):
+                        if draft and draft.image_key:
+                            urls = await sign_urls([draft.image_key])
+                            image_path = urls[draft.image_key]
+                        else:
+                            image = await image_generator.ainvoke(post_text)
+                            image_path = await download_image(image)
+                except CircuitOpenError as e:
+                    # the post text is ready, send it without the image
+                    logger.warning(f"Skipping image: {e}", job_id=job.id)
+                else:
+                    if not await agent_job_svc.complete(job.id, post_text):
+                        raise JobCancelledError(
+                            code=JobCancelledError.code, job_id=job.id
+                        )
+                    async with stage("telegram", timeouts.telegram):
+                        await send_post(
+                            Bot(settings.TGBOT_TOKEN.get_secret_value()),
+                            from_chat_id,
+                            post_text,
+                            photo=image_path,
+                        )
+                    return
+            # inside spend_credits to release the credits if the job was cancelled
+            if not await agent_job_svc.complete(job.id, post_text):
+                raise JobCancelledError(code=JobCancelledError.code, job_id=job.id)
 
+        async with stage("telegram", timeouts.telegram):
+            messages = await send_post(
+                Bot(settings.TGBOT_TOKEN.get_secret_value()), from_chat_id, post_text
+            )
+        if len(messages) == 1 and len(post_text) <= MAX_IMAGE_POST_LENGTH:
+            await _speculate_image(ctx, job, from_chat_id, messages[0].message_id)
+    except StageTimeoutError as e:
+        await _job_failed_fast(agent_job_svc, job, from_chat_id, e)
+    except CircuitOpenError as e:
+        await _job_failed_fast(agent_job_svc, job, from_chat_id, e)
+    except JobCancelledError as e:
+        # the result is not needed anymore, the credits are released
+        logger.info(str(e), job_id=job.id)
+        await agent_job_svc.cancel(job.id)
+    except asyncio.CancelledError as e:
+        await _job_cancelled(agent_job_svc, job.id, e)
+        raise
+    finally:
+        await release_job(ctx.redis, job.tg_user_id, job.id)
+        await _save_telemetry(agent_job_svc, job.id, post_generator.llm_usage)
+        # taken from the pool either way, Telegram has fetched it by now
+        if draft and draft.image_key:
+            await delete_image(draft.image_key)
 
-@task("update_post")
+
+@task("update_post", timeout=5 * 60)
 async def update_post(ctx: JobContext, job_id: UUID, from_chat_id: int) -> None:
     agent_svc = TGAgentService(ctx.db_session)
     agent_job_svc = TGAgentJobService(ctx.db_session)
 
-    job = await agent_job_svc.get(job_id)
+    async with stage("db", None):
+        job = await agent_job_svc.get(job_id)
     if not job:
         raise AppError("Job not found", job_id=job_id)
 
@@ -92,6 +191,11 @@ async def update_post(ctx: JobContext, job_id: UUID, from_chat_id: int) -> None:
             job_id=job_id,
         )
 
+    if job.status == TGAgentJobStatus.CANCELLED:
+        logger.info("Job was cancelled before it started", job_id=job_id)
+        if job.tg_user_id:
+            await release_job(ctx.redis, job.tg_user_id, job.id)
+        return
     check_if_job_staled(job)
     if job.status != TGAgentJobStatus.INITIAL:
         raise AppError(
@@ -101,15 +205,55 @@ async def update_post(ctx: JobContext, job_id: UUID, from_chat_id: int) -> None:
     if not job.agent_id:
         raise AppError("Job is detached from agent", job_id=job_id)
 
-    agent = await agent_svc.get(job.agent_id, with_bot=True)
+    async with stage("db", None):
+        agent = await agent_svc.get(job.agent_id, with_bot=True)
     if not agent:
         raise AppError("Agent not found", job_id=job_id, agent_id=job.agent_id)
 
+    image = None
+    metadata = PostUpdateMetadata.model_validate(job.metadata_)
+    if metadata.original_message_id:
+        image = await SpeculativeImages(ctx.redis).get(
+            metadata.chat_id, metadata.original_message_id
+        )
+
     post_generator = PostGenerator(ctx.db_session_maker, ctx.db_session)
+    try:
+        await _update_post(ctx, agent_job_svc, job, from_chat_id, post_generator, image)
+    finally:
+        await _save_telemetry(agent_job_svc, job.id, post_generator.llm_usage)
+
+
+async def _update_post(
+    ctx: JobContext,
+    agent_job_svc: TGAgentJobService,
+    job: TGAgentJob,
+    from_chat_id: int,
+    post_generator: PostGenerator,
+    speculative_image: SpeculativeImage | None = None,
+) -> None:
+    timeouts = post_generator.timeouts
     data = None
     try:
-        data = await post_generator.update(job)
+        async with cancellable(ctx.redis, job.id):
+            data = await post_generator.update(
+                job, speculative_image.url if speculative_image else None
+            )
+    except JobCancelledError as e:
+        logger.info(str(e), job_id=job.id)
+        await agent_job_svc.cancel(job.id)
+        return
+    except StageTimeoutError as e:
+        await _job_failed_fast(agent_job_svc, job, from_chat_id, e)
+        return
+    except CircuitOpenError as e:
+        await _job_failed_fast(agent_job_svc, job, from_chat_id, e)
+        return
+    except asyncio.CancelledError as e:
+        await _job_cancelled(agent_job_svc, job.id, e)
+        raise
     except AppError as e:
+        await agent_job_svc.complete(job.id, "")
         if e.code == 2200:
             await Bot(settings.TGBOT_TOKEN.get_secret_value()).send_message(
                 from_chat_id,
@@ -121,30 +265,271 @@ async def update_post(ctx: JobContext, job_id: UUID, from_chat_id: int) -> None:
     except Exception as e:
         logger.exception(e)
     finally:
-        post_text = data.get("message", "") if data else ""
-        await agent_job_svc.complete(job.id, "")
+        if job.tg_user_id:
+            await release_job(ctx.redis, job.tg_user_id, job.id)
+    post_text = data.get("message", "") if data else ""
+    if not await agent_job_svc.complete(job.id, ""):
+        logger.info("Job was cancelled", job_id=job.id)
+        return
 
     image = data and data.get("image")
+    if speculative_image and image == speculative_image.url:
+        await SpeculativeImages(ctx.redis).used(speculative_image)
     image_path: str | None = None
-    if image:
-        image_path = await download_image(image)
     try:
+        if image:
+            async with stage("image", timeouts.image):
+                image_path = await download_image(image)
         if from_chat_id and post_text:
-            if image_path:
-                await Bot(settings.TGBOT_TOKEN.get_secret_value()).send_photo(
+            async with stage("telegram", timeouts.telegram):
+                await send_post(
+                    Bot(settings.TGBOT_TOKEN.get_secret_value()),
                     from_chat_id,
+                    post_text,
                     photo=image_path,
-                    caption=post_text,
-                    parse_mode=ParseMode.HTML,
-                )
-            else:
-                await Bot(settings.TGBOT_TOKEN.get_secret_value()).send_message(
-                    from_chat_id, post_text, parse_mode=ParseMode.HTML
                 )
     except Exception as e:
         logger.exception(e)
 
 
+@task("check_bot_permissions", timeout=PERMISSIONS_CHECK_TTL, keep_result=5 * 60)
+async def check_bot_permissions(
+    ctx: JobContext, tg_user_id: int, agent_id: UUID
+) -> TGAgentStatus:
+    """
+    The new agent status is also pushed to the webapp by TGAgentService
+    """
+    agent_svc = TGAgentService(ctx.db_session)
+    try:
+        agent = await check_agent_bot_permissions(tg_user_id, agent_id, agent_svc)
+        if agent.channel_metadata and agent.channel_metadata.photo:
+            await ctx.redis.enqueue_job("fetch_channel_photo", agent.id)
+    finally:
+        await ctx.redis.delete(permissions_check_key(agent_id))
+    return agent.status
+
+
+@cron_task("refresh_agents", minute=0, timeout=60 * 60)
+async def refresh_agents(ctx: JobContext) -> dict[RefreshResult, int]:
+    """
+    Keeps bot permissions and channel metadata of connected agents up to date
+    """
+    refresher = AgentsRefresher(TGAgentService(ctx.db_session), ctx.redis)
+    return await refresher.run()
+
+
+@task("refill_drafts", timeout=10 * 60, keep_result=0)
+async def refill_drafts(ctx: JobContext, agent_id: UUID) -> int:
+    """
+    Tops up the pool of the agent after a draft was taken
+    """
+    async with stage("db", None):
+        agent = await TGAgentService(ctx.db_session).get(agent_id, with_bot=True)
+    if not agent or agent.status != TGAgentStatus.ACTIVE:
+        return 0
+    added, _ = await _refill_drafts(ctx, agent)
+    return added
+
+
+@cron_task(
+    "fill_draft_pools", hour=settings.DRAFT_POOL_HOURS, minute=30, timeout=50 * 60
+)
+async def fill_draft_pools(ctx: JobContext) -> int:
+    """
+    Tops up the pools of all active agents in the off-peak hours,
+    one agent at a time to leave the workers to the user jobs
+    """
+    if not settings.DRAFT_POOL_SIZES:
+        return 0
+    agent_svc = TGAgentService(ctx.db_session)
+    added = 0
+    after_id = None
+    while agents := await agent_svc.list_connected(after_id=after_id):
+        after_id = agents[-1].id
+        for agent in agents:
+            if agent.status != TGAgentStatus.ACTIVE:
+                continue
+            agent_added, done = await _refill_drafts(ctx, agent)
+            added += agent_added
+            if not done:
+                # continues in the next run
+                return added
+    return added
+
+
+@task("speculate_image", timeout=3 * 60, keep_result=0)
+async def speculate_image(
+    ctx: JobContext, job_id: UUID, chat_id: int, message_id: int
+) -> None:
+    """
+    Generates the image of the sent post before the user asks for it
+    """
+    if await _queue_is_busy(ctx):
+        SPECULATIVE_IMAGES.inc(result="busy")
+        return
+    async with stage("db", None):
+        job = await TGAgentJobService(ctx.db_session).get(job_id, required=True)
+    if not job.tg_user_id or not job.data:
+        return
+    images = SpeculativeImages(ctx.redis)
+    if not await images.reserve(job.tg_user_id):
+        return
+
+    post_generator = PostGenerator(ctx.db_session_maker, ctx.db_session)
+    image_generator = _image_generator(post_generator)
+    try:
+        async with stage("image", image_generator.timeout):
+            url = await image_generator.ainvoke(job.data)
+    except AppError as e:
+        SPECULATIVE_IMAGES.inc(result="failed")
+        logger.warning(f"Speculative image failed: {e}", job_id=job_id)
+        return
+    await images.save(
+        SpeculativeImage(job_id=job.id, chat_id=chat_id, message_id=message_id, url=url)
+    )
+
+
+async def _speculate_image(
+    ctx: JobContext, job: TGAgentJob, chat_id: int, message_id: int
+) -> None:
+    """
+    For the opted-in users, the credits are spent only if the image is used.
+    Best effort, the post is sent already
+    """
+    if not settings.SPECULATIVE_IMAGES_DAILY_BUDGET or not job.tg_user_id:
+        return
+    try:
+        user = await TGUserService(ctx.db_session).get_user(job.tg_user_id)
+        if user and user.speculative_images:
+            await ctx.redis.enqueue_job("speculate_image", job.id, chat_id, message_id)
+    except Exception as e:
+        logger.warning(f"Can't speculate image: {e}", job_id=job.id)
+
+
+async def _refill_drafts(ctx: JobContext, agent: TGAgent) -> tuple[int, bool]:
+    """
+    Returns the number of the added drafts and False if it stopped early
+    because the queue is busy or the provider is down
+    """
+    if not agent.tg_user_id:
+        return 0, True
+    # per agent, the generator accumulates the LLM usage of its calls
+    post_generator = PostGenerator(ctx.db_session_maker, ctx.db_session)
+    pool = DraftPool(ctx.redis)
+    size = await pool_size(ctx.db_session, agent.tg_user_id)
+    missing = size - await pool.prune(agent) if size else 0
+    added = 0
+    for _ in range(missing):
+        if await _queue_is_busy(ctx):
+            logger.info("Queue is busy, postponing drafts", agent_id=agent.id)
+            return added, False
+        try:
+            draft = Draft(
+                text=await post_generator.generate_draft(agent),
+                profile_version=profile_version(agent),
+            )
+            draft.image_key = await _draft_image(post_generator, agent, draft)
+        except CircuitOpenError as e:
+            logger.warning(f"Postponing drafts: {e}", agent_id=agent.id)
+            return added, False
+        await pool.add(agent.id, draft)
+        added += 1
+    return added, True
+
+
+async def _draft_image(
+    post_generator: PostGenerator, agent: TGAgent, draft: Draft
+) -> str | None:
+    """
+    The draft is still useful without the image, it's generated on taking
+    """
+    image_generator = _image_generator(post_generator)
+    key = image_key(agent.id, draft.id)
+    try:
+        async with stage("image", image_generator.timeout):
+            await store_image(await image_generator.ainvoke(draft.text), key)
+    except (AppError, httpx.HTTPError) as e:
+        logger.warning(f"Draft without image: {e}", agent_id=agent.id)
+        return None
+    return key
+
+
+def _image_generator(post_generator: PostGenerator) -> ImageGenerator:
+    return ImageGenerator(
+        model=post_generator.model,
+        image_model=post_generator.image_model,
+        prompts=post_generator.prompts.image_generator_query_builder,
+        timeout=post_generator.timeouts.image,
+    )
+
+
+async def _queue_is_busy(ctx: JobContext) -> bool:
+    """
+    The background work (drafts, speculative images) yields to the user jobs
+    """
+    depth: int = await ctx.redis.zcard(WorkerSettings.queue_name)
+    return depth > BUSY_QUEUE_DEPTH
+
+
+async def _job_failed_fast(
+    agent_job_svc: TGAgentJobService,
+    job: TGAgentJob,
+    chat_id: int,
+    error: StageTimeoutError | CircuitOpenError,
+) -> None:
+    """
+    Expected failure (timeout, provider is down), fail the job and tell the user
+    """
+    logger.warning(str(error), job_id=job.id, **error.kwargs)
+    await agent_job_svc.fail(job.id, error)
+    user = (
+        await TGUserService(agent_job_svc.db_session).get_user(job.tg_user_id)
+        if job.tg_user_id
+        else None
+    )
+    texts = get_texts(TEXTS, user.language_code if user else "").jobs
+    text = (
+        texts.timed_out_text
+        if isinstance(error, StageTimeoutError)
+        else texts.unavailable_text
+    )
+    await Bot(settings.TGBOT_TOKEN.get_secret_value()).send_message(chat_id, text)
+
+
+async def _save_telemetry(
+    agent_job_svc: TGAgentJobService, job_id: UUID, llm_usage: LLMUsage
+) -> None:
+    """
+    Best effort, the job result doesn't depend on it
+    """
+    collector = current_telemetry()
+    if collector is None:
+        return
+    try:
+        await asyncio.shield(
+            agent_job_svc.save_telemetry(
+                job_id, collector.snapshot(), llm_usage if llm_usage.calls else None
+            )
+        )
+    except Exception as e:
+        logger.warning(f"Can't save job telemetry: {e}", job_id=job_id)
+
+
+async def _job_cancelled(
+    agent_job_svc: TGAgentJobService, job_id: UUID, cancelled: asyncio.CancelledError
+) -> None:
+    """
+    The whole job was cancelled (e.g. arq job timeout), record the stage it was in
+    """
+    error = StageTimeoutError(
+        "Job was cancelled", code=StageTimeoutError.code, stage=failed_stage(cancelled)
+    )
+    try:
+        await asyncio.shield(agent_job_svc.fail(job_id, error))
+    except Exception as e:
+        logger.exception(e)
+
+
 async def download_image(url: str) -> str:
     # Create temp file in /tmp with .jpg suffix
     with tempfile.NamedTemporaryFile(delete=False, dir="/tmp") as tmp_file:
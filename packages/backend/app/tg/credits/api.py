@@ -3,13 +3,14 @@ from typing import Annotated
 
 import structlog
 from fastapi import APIRouter, Depends, HTTPException
-from telegram import Bot, LabeledPrice
+from telegram import LabeledPrice
 
 from app.conf import settings
 from app.core.http_errors import HTTPUnauthorizedError
 from app.openapi import generate_unique_id_function
 from app.tg.credits.schemas import BuyCreditsRequest, CreditsPackage
 from app.tg.credits.services import TGUserCreditsService
+from app.tgbot.bot import Bot
 from app.tgbot.dependencies import AuthUser
 
 logger = structlog.get_logger()
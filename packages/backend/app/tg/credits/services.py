@@ -1,3 +1,4 @@
+import asyncio
 from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 from uuid import UUID
@@ -6,6 +7,7 @@ from sqlalchemy import sql
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.errors import AppError
+from app.core.timeouts import stage
 from app.services import BaseService
 from app.tg.credits.models import (
     CreditsPurchaseStatus,
@@ -21,11 +23,13 @@ async def spend_credits(
     db_session: AsyncSession, tg_user_id: int, amount: int
 ) -> AsyncGenerator[None, None]:
     tg_user_svc = TGUserService(db_session)
-    lock_tx_id = await tg_user_svc.lock_credits(tg_user_id, amount)
+    async with stage("credits", None):
+        lock_tx_id = await tg_user_svc.lock_credits(tg_user_id, amount)
     try:
         yield
-    except Exception:
-        await tg_user_svc.unlock_credits(tg_user_id, lock_tx_id)
+    except BaseException:
+        # asyncio.CancelledError (job timeout or cancellation) must release the lock too
+        await asyncio.shield(tg_user_svc.unlock_credits(tg_user_id, lock_tx_id))
         raise
     await tg_user_svc.confirm_locked_credits(tg_user_id, lock_tx_id)
 
@@ -38,6 +42,21 @@ class TGUserCreditsService(BaseService):
             )
         return result.scalar_one()
 
+    async def latest_package(self, tg_user_id: int) -> str | None:
+        """
+        Package of the latest completed purchase, the plan of the user
+        """
+        async with self.tx():
+            result = await self.db_session.execute(
+                sql.select(TGUserCreditsPurchase.package_name)
+                .filter_by(
+                    tg_user_id=tg_user_id, status=CreditsPurchaseStatus.COMPLETED
+                )
+                .order_by(TGUserCreditsPurchase.created_at.desc())
+                .limit(1)
+            )
+        return result.scalar_one_or_none()
+
     async def init_credits_purchase(
         self, tg_user_id: int, package: CreditsPackage
     ) -> TGUserCreditsPurchase:
@@ -0,0 +1,135 @@
+"""
+Admission control for the bot entry path
+
+Requests are rejected before a job is created when the user can't pay for it,
+already has too many jobs in flight or the queue is too deep to serve it in time.
+"""
+
+import enum
+import math
+import time
+from typing import NamedTuple
+from uuid import UUID
+
+import structlog
+from pydantic import BaseModel
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.core.metrics import counter
+from app.tgbot.auth.models import TGUser
+
+logger = structlog.get_logger()
+
+ADMISSION_REJECTED = counter(
+    "admission_rejected_total",
+    "Bot requests rejected before a job was created",
+    ("reason",),
+)
+
+# credits spent by a single generation job
+JOB_COST = 1
+
+
+class AdmissionConfig(BaseModel):
+    max_user_jobs: int = 2
+    max_queue_depth: int = 200
+    # rough throughput of all workers, used to tell the user when to come back
+    jobs_per_second: float = 0.5
+    min_retry_after: int = 10
+    max_retry_after: int = 5 * 60
+    # in-flight jobs are forgotten after this even if a worker never released them
+    job_ttl_seconds: int = 10 * 60
+
+
+class Rejection(str, enum.Enum):
+    NO_CREDITS = "no_credits"
+    USER_BUSY = "user_busy"
+    QUEUE_FULL = "queue_full"
+
+
+class Admission(NamedTuple):
+    rejection: Rejection | None = None
+    # seconds
+    retry_after: int | None = None
+
+
+def _user_jobs_key(tg_user_id: int) -> str:
+    return f"viralink:admission:jobs:{tg_user_id}"
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        redis: Redis,
+        queue_name: str,
+        config: AdmissionConfig | None = None,
+    ) -> None:
+        self.redis = redis
+        self.queue_name = queue_name
+        self.config = config or AdmissionConfig()
+
+    async def admit(self, user: TGUser, *, replaces: UUID | None = None) -> Admission:
+        """
+        user: loaded by requires_auth, so the balance check costs no extra query.
+            The balance is checked again when the worker locks the credits.
+        replaces: the in-flight job the new one replaces, it isn't counted
+        """
+        if user.credits_balance < JOB_COST:
+            return self._reject(Rejection.NO_CREDITS)
+
+        key = _user_jobs_key(user.tg_id)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zremrangebyscore(key, "-inf", time.time())
+                pipe.zcard(key)
+                pipe.zcard(self.queue_name)
+                pipe.zscore(key, str(replaces))
+                _, user_jobs, queue_depth, replaced = await pipe.execute()
+        except RedisError as e:
+            # the queue is on the same Redis, enqueueing will fail loudly anyway
+            logger.warning(f"Admission control is unavailable: {e}")
+            return Admission()
+
+        if replaces and replaced is not None:
+            user_jobs -= 1
+        if user_jobs >= self.config.max_user_jobs:
+            return self._reject(Rejection.USER_BUSY)
+        if queue_depth >= self.config.max_queue_depth:
+            excess = queue_depth - self.config.max_queue_depth + 1
+            retry_after = math.ceil(excess / self.config.jobs_per_second)
+            return self._reject(
+                Rejection.QUEUE_FULL,
+                min(
+                    max(retry_after, self.config.min_retry_after),
+                    self.config.max_retry_after,
+                ),
+            )
+        return Admission()
+
+    async def track(self, tg_user_id: int, job_id: UUID) -> None:
+        """
+        Counts the job as in flight until the worker releases it
+        """
+        key = _user_jobs_key(tg_user_id)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(key, {str(job_id): time.time() + self.config.job_ttl_seconds})
+                pipe.expire(key, self.config.job_ttl_seconds)
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Can't track in-flight job: {e}", job_id=job_id)
+
+    def _reject(self, reason: Rejection, retry_after: int | None = None) -> Admission:
+        ADMISSION_REJECTED.inc(reason=reason.value)
+        return Admission(reason, retry_after)
+
+
+async def release_job(redis: Redis, tg_user_id: int, job_id: UUID) -> None:
+    """
+    Called by the worker when the job is finished
+    """
+    try:
+        await redis.zrem(_user_jobs_key(tg_user_id), str(job_id))
+    except RedisError as e:
+        logger.warning(f"Can't release in-flight job: {e}", job_id=job_id)
@@ -8,6 +8,7 @@ from telegram.ext import (
 )
 
 from app.conf import settings
+from app.tgbot.bot import BASE_FILE_URL, BASE_URL, RetryRateLimiter
 from app.tgbot.context import Context
 
 TGApp = Application[
@@ -19,7 +20,10 @@ builder = (
     ApplicationBuilder()
     .context_types(ContextTypes(context=Context))
     .job_queue(None)
+    .rate_limiter(RetryRateLimiter())
     .token(settings.TGBOT_TOKEN.get_secret_value())
+    .base_url(BASE_URL)
+    .base_file_url(BASE_FILE_URL)
 )
 
 
@@ -5,10 +5,10 @@ from fastapi import APIRouter, Depends, status
 from app.auth.dependencies import AuthAdmin
 from app.openapi import generate_unique_id_function
 from app.tgbot.auth.models import TGUser
-from app.tgbot.auth.schemas import CreateTGInviteCodes
+from app.tgbot.auth.schemas import CreateTGInviteCodes, TGUserSettings
 from app.tgbot.auth.schemas import TGInviteCode as TGInviteCodeSchema
 from app.tgbot.auth.schemas import TGUser as TGUserSchema
-from app.tgbot.auth.services import TGInviteCodesService
+from app.tgbot.auth.services import TGInviteCodesService, TGUserService
 from app.tgbot.dependencies import AuthUser
 
 router = APIRouter(
@@ -28,6 +28,19 @@ async def me(
     return TGUserSchema.model_validate(user)
 
 
+@router.put(
+    "/settings",
+    status_code=status.HTTP_200_OK,
+)
+async def update_settings(
+    user: AuthUser,
+    data: TGUserSettings,
+    tg_user_svc: Annotated[TGUserService, Depends(TGUserService.inject)],
+) -> TGUserSchema:
+    tg_user = await tg_user_svc.update_settings(user.tg_id, **data.model_dump())
+    return TGUserSchema.model_validate(tg_user)
+
+
 # disabled routes
 if False:
 
@@ -23,6 +23,10 @@ class TGUser(TimestampModel):
     is_admin: Mapped[bool] = mapped_column(nullable=False, default=False)
 
     credits_balance: Mapped[int] = mapped_column(default=0, server_default="0")
+    # generate the image of a post ahead, before the user asks for it
+    speculative_images: Mapped[bool] = mapped_column(
+        default=False, server_default="false"
+    )
 
     # Foreign keys
     user = mapped_column(
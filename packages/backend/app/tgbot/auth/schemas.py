@@ -25,3 +25,8 @@ class TGUser(BaseModel):
     is_admin: bool = False
 
     credits_balance: int
+    speculative_images: bool = False
+
+
+class TGUserSettings(BaseModel):
+    speculative_images: bool
@@ -72,6 +72,17 @@ class TGUserService(BaseService):
 
         return tg_user
 
+    async def update_settings(self, tg_user_id: int, **values: bool) -> TGUser:
+        async with self.tx():
+            result = await self.db_session.execute(
+                sql.update(TGUser)
+                .filter_by(tg_id=tg_user_id)
+                .values(**values)
+                .returning(TGUser)
+            )
+            tg_user = result.scalar_one()
+        return tg_user
+
     async def add_credits(self, tg_user_id: int, amount: int) -> TGUser:
         async with self.tx():
             result = await self.db_session.execute(
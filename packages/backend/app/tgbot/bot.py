@@ -0,0 +1,140 @@
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Coroutine
+from contextlib import asynccontextmanager
+from typing import Any
+
+import httpx
+import telegram
+from telegram._utils.defaultvalue import DEFAULT_NONE
+from telegram._utils.types import FileInput, JSONDict, ODVInput
+from telegram.constants import ParseMode
+from telegram.ext import BaseRateLimiter
+
+from app.conf import settings
+from app.core.errors import AppError
+from app.core.retry import retry_call
+from app.tgbot.formatting import CAPTION_LIMIT, split_html
+
+# bytes
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+BASE_URL = f"{settings.TGBOT_API_URL}/bot"
+BASE_FILE_URL = f"{settings.TGBOT_API_URL}/file/bot"
+
+
+class Bot(telegram.Bot):
+    """
+    Telegram bot that retries flood control (RetryAfter) and network errors
+    Use it instead of telegram.Bot for all sends outside the bot application
+    """
+
+    def __init__(self, token: str, **kwargs: Any) -> None:
+        kwargs.setdefault("base_url", BASE_URL)
+        kwargs.setdefault("base_file_url", BASE_FILE_URL)
+        super().__init__(token, **kwargs)
+
+    async def _do_post(
+        self,
+        endpoint: str,
+        data: JSONDict,
+        *,
+        read_timeout: ODVInput[float] = DEFAULT_NONE,
+        write_timeout: ODVInput[float] = DEFAULT_NONE,
+        connect_timeout: ODVInput[float] = DEFAULT_NONE,
+        pool_timeout: ODVInput[float] = DEFAULT_NONE,
+    ) -> bool | JSONDict | list[JSONDict]:
+        do_post = super()._do_post
+        return await retry_call(
+            "telegram",
+            lambda: do_post(
+                endpoint,
+                data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            ),
+            idempotent=is_read_only(endpoint),
+        )
+
+
+class RetryRateLimiter(BaseRateLimiter[None]):
+    """
+    Applies the same retry policy to the requests of the bot application (ExtBot)
+    """
+
+    async def initialize(self) -> None: ...
+
+    async def shutdown(self) -> None: ...
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, bool | JSONDict | list[JSONDict]]],
+        args: Any,
+        kwargs: dict[str, Any],
+        endpoint: str,
+        data: dict[str, Any],
+        rate_limit_args: None,
+    ) -> bool | JSONDict | list[JSONDict]:
+        return await retry_call(
+            "telegram",
+            lambda: callback(*args, **kwargs),
+            idempotent=is_read_only(endpoint),
+        )
+
+
+def is_read_only(endpoint: str) -> bool:
+    """
+    A timed out getFile or getChatMember can be repeated,
+    a timed out sendMessage may have been delivered and would be duplicated
+    """
+    return endpoint.startswith("get")
+
+
+async def send_post(
+    bot: telegram.Bot, chat_id: int | str, text: str, photo: FileInput | None = None
+) -> list[telegram.Message]:
+    """
+    Sends the post as a message or as a photo with the caption,
+    the text beyond the Telegram limits follows in more messages
+    """
+    messages = []
+    if photo is None:
+        parts = split_html(text)
+    else:
+        parts = split_html(text, first_limit=CAPTION_LIMIT)
+        messages.append(
+            await bot.send_photo(
+                chat_id,
+                photo=photo,
+                caption=parts.pop(0) if parts else None,
+                parse_mode=ParseMode.HTML,
+            )
+        )
+    for part in parts:
+        messages.append(
+            await bot.send_message(chat_id, part, parse_mode=ParseMode.HTML)
+        )
+    return messages
+
+
+@asynccontextmanager
+async def stream_file(
+    file: telegram.File,
+) -> AsyncGenerator[AsyncIterator[bytes], None]:
+    """
+    Downloads the file in chunks instead of into memory
+    """
+    if not file.file_path:
+        raise AppError("File can't be downloaded", file_id=file.file_id)
+    async with (
+        httpx.AsyncClient(timeout=httpx.Timeout(30, connect=10)) as client,
+        client.stream("GET", file.file_path) as response,
+    ):
+        if response.is_error:
+            # the URL contains the bot token, don't let it into the logs
+            raise AppError(
+                "Telegram file download failed",
+                file_id=file.file_id,
+                status_code=response.status_code,
+            )
+        yield response.aiter_bytes(DOWNLOAD_CHUNK_SIZE)
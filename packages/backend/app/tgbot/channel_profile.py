@@ -0,0 +1,162 @@
+"""
+Incremental summarization of published posts into channel_profile_generated
+
+Published posts are queued per agent and a deferred worker task folds all
+posts published since its last run into the profile with one LLM call.
+A per-agent lock serializes the runs, so concurrent updates aren't lost.
+"""
+
+import functools
+from pathlib import Path
+from uuid import UUID
+
+import structlog
+from arq.connections import ArqRedis
+from langchain_core.prompts import ChatPromptTemplate
+from pydantic import BaseModel
+
+from app.core.errors import AppError
+from app.core.llm import get_llm, load_prompts
+from app.tg.agents.services import TGAgentService
+from app.tgbot.auth.services import TGUserService
+from app.tgbot.utils import get_texts
+
+logger = structlog.get_logger()
+
+# seconds, posts published within it are summarized together
+DEBOUNCE_SECONDS = 60
+UPDATE_TIMEOUT = 4 * 60
+# outlives a run that hits its timeout
+LOCK_TIMEOUT = UPDATE_TIMEOUT + 60
+# posts wait this long for a run, e.g. while the workers are down
+POSTS_TTL = 24 * 60 * 60
+POSTS_SEPARATOR = "\n\n---\n\n"
+
+
+class GenerateChannelProfilePrompts(BaseModel):
+    system_prompt: str
+    channel_profile_generated: str
+    post_message: str
+
+
+class LangPrompts(BaseModel):
+    generate_channel_profile: GenerateChannelProfilePrompts
+
+
+class Prompts(BaseModel):
+    ru: LangPrompts
+
+
+try:
+    PROMPTS = load_prompts(
+        Path(__file__).parent / "texts.yaml",
+        Prompts,
+        key="prompts",
+    )
+except:
+    logger.error("Failed to load channel profile prompts")
+    raise
+
+
+@functools.cache
+def _get_prompt_template(
+    system_prompt: str, channel_profile_generated: str, post_message: str
+) -> ChatPromptTemplate:
+    return ChatPromptTemplate(
+        [
+            ("system", system_prompt),
+            ("system", channel_profile_generated),
+            ("user", post_message),
+        ]
+    )
+
+
+def _posts_key(agent_id: UUID) -> str:
+    return f"viralink:channel_profile:{agent_id}:posts"
+
+
+def _scheduled_key(agent_id: UUID) -> str:
+    return f"viralink:channel_profile:{agent_id}:scheduled"
+
+
+def lock_key(agent_id: UUID) -> str:
+    return f"viralink:channel_profile:{agent_id}:lock"
+
+
+async def schedule_channel_profile_update(
+    redis: ArqRedis, agent_id: UUID, post_message: str
+) -> None:
+    """
+    Queues the post, the first post after a run schedules the next run
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.rpush(_posts_key(agent_id), post_message)
+        pipe.expire(_posts_key(agent_id), POSTS_TTL)
+        pipe.set(_scheduled_key(agent_id), 1, nx=True, ex=POSTS_TTL)
+        *_, is_first = await pipe.execute()
+    if is_first:
+        await redis.enqueue_job(
+            "update_channel_profile", agent_id, _defer_by=DEBOUNCE_SECONDS
+        )
+
+
+async def take_posts(redis: ArqRedis, agent_id: UUID) -> list[str]:
+    """
+    Called under the agent lock, posts queued from now on schedule another run
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.delete(_scheduled_key(agent_id))
+        pipe.lrange(_posts_key(agent_id), 0, -1)
+        pipe.delete(_posts_key(agent_id))
+        _, posts, _ = await pipe.execute()
+    return [post.decode() for post in posts]
+
+
+async def return_posts(redis: ArqRedis, agent_id: UUID, posts: list[str]) -> None:
+    """
+    Puts the posts of a failed run back in front of the queue
+    """
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.lpush(_posts_key(agent_id), *reversed(posts))
+        pipe.expire(_posts_key(agent_id), POSTS_TTL)
+        await pipe.execute()
+
+
+async def summarize_posts(
+    agent_svc: TGAgentService,
+    tg_user_svc: TGUserService,
+    agent_id: UUID,
+    posts: list[str],
+) -> None:
+    agent = await agent_svc.get(agent_id)
+    if not agent:
+        raise AppError("Agent not found", agent_id=agent_id)
+    if not agent.tg_user_id:
+        raise AppError("Agent is orphaned", agent_id=agent_id)
+
+    user = await tg_user_svc.get_user(agent.tg_user_id)
+    if not user:
+        raise AppError("User not found", tg_user_id=agent.tg_user_id)
+
+    prompts = get_texts(PROMPTS, user.language_code)
+
+    llm = get_llm("o4-mini")
+
+    messages = _get_prompt_template(
+        **prompts.generate_channel_profile.model_dump()
+    ).format_messages(
+        channel_profile_generated=agent.channel_profile_generated,
+        post_message=POSTS_SEPARATOR.join(posts),
+    )
+    result = await llm.ainvoke(messages)
+
+    channel_profile_generated = result.content
+    if channel_profile_generated:
+        if not isinstance(channel_profile_generated, str):
+            raise AppError(
+                "channel_profile_generated is not a string", agent_id=agent_id
+            )
+
+        await agent_svc.update_channel_profile_generated(
+            agent_id, channel_profile_generated=channel_profile_generated
+        )
@@ -0,0 +1,54 @@
+"""
+Per-chat debounce of post generation requests
+
+A new job is deferred by the window, so follow-up messages that arrive meanwhile
+are merged into its user_prompt instead of creating another job.
+A message that arrives after the worker has started the job (within the same
+window once more) replaces it with a job for all messages.
+"""
+
+from uuid import UUID
+
+import structlog
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+logger = structlog.get_logger()
+
+
+def _pending_job_key(chat_id: int) -> str:
+    return f"viralink:debounce:{chat_id}"
+
+
+class ChatDebouncer:
+    def __init__(self, redis: Redis, window_seconds: float) -> None:
+        self.redis = redis
+        # 0 disables debouncing
+        self.window_seconds = window_seconds
+
+    @property
+    def defer_by(self) -> float | None:
+        return self.window_seconds or None
+
+    async def pending_job(self, chat_id: int) -> UUID | None:
+        if not self.window_seconds:
+            return None
+        try:
+            job_id = await self.redis.get(_pending_job_key(chat_id))
+        except RedisError as e:
+            logger.warning(f"Debounce is unavailable: {e}", chat_id=chat_id)
+            return None
+        return UUID(job_id.decode()) if job_id else None
+
+    async def set_pending_job(self, chat_id: int, job_id: UUID) -> None:
+        if not self.window_seconds:
+            return
+        try:
+            # merge while the job is deferred, replace during the next window
+            await self.redis.set(
+                _pending_job_key(chat_id),
+                str(job_id),
+                px=int(self.window_seconds * 2 * 1000),
+            )
+        except RedisError as e:
+            logger.warning(f"Debounce is unavailable: {e}", chat_id=chat_id)
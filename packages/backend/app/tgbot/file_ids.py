@@ -0,0 +1,113 @@
+"""
+file_ids of photos republished through user bots
+
+A file_id is only valid for the bot that received the file, so publishing
+a photo from the platform bot through a user bot takes a download and an upload.
+The file_id the user bot gets back is cached, later publishes of the same photo
+send it by file_id without any transfer.
+"""
+
+import asyncio
+import tempfile
+from uuid import UUID
+
+import structlog
+import telegram
+from redis.exceptions import RedisError
+from telegram.error import BadRequest as TelegramBadRequest
+
+from app.core.metrics import counter
+from app.core.redis import get_redis
+from app.core.telemetry import record_cache
+from app.tgbot.bot import Bot, stream_file
+
+logger = structlog.get_logger()
+
+FILE_ID_CACHE = counter(
+    "file_id_cache_total",
+    "Photos republished through user bots by file_id cache result: hit or miss",
+    ("result",),
+)
+
+FILE_ID_TTL = 30 * 24 * 60 * 60
+# bytes, larger downloads are spooled to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def _file_id_key(user_bot_id: UUID, file_unique_id: str) -> str:
+    return f"viralink:file_ids:{user_bot_id}:{file_unique_id}"
+
+
+async def republish_photo(
+    source_bot: telegram.Bot,
+    target_bot: Bot,
+    target_bot_id: UUID,
+    *,
+    chat_id: int,
+    file_id: str,
+    file_unique_id: str | None,
+    caption: str,
+    parse_mode: str,
+) -> telegram.Message:
+    """
+    Sends the photo received by source_bot to the chat through target_bot
+
+    file_unique_id: saves a getFile call when known, it's the same for all bots
+    """
+    source_file = None
+    if not file_unique_id:
+        source_file = await source_bot.get_file(file_id)
+        file_unique_id = source_file.file_unique_id
+    redis = get_redis()
+    key = _file_id_key(target_bot_id, file_unique_id)
+
+    try:
+        cached_file_id = await redis.get(key)
+    except RedisError as e:
+        logger.warning(f"file_id cache is unavailable: {e}")
+        cached_file_id = None
+    if cached_file_id:
+        try:
+            message = await target_bot.send_photo(
+                chat_id=chat_id,
+                photo=cached_file_id.decode(),
+                caption=caption,
+                parse_mode=parse_mode,
+            )
+        except TelegramBadRequest as e:
+            if "file" not in str(e).lower():
+                raise
+            # the file is gone from Telegram, upload it again
+            logger.warning(f"Cached file_id is rejected: {e}", key=key)
+        else:
+            FILE_ID_CACHE.inc(result="hit")
+            record_cache("file_id", hit=True)
+            return message
+
+    FILE_ID_CACHE.inc(result="miss")
+    record_cache("file_id", hit=False)
+    source_file = source_file or await source_bot.get_file(file_id)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as buffer:
+        size = 0
+        async with stream_file(source_file) as chunks:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > SPOOL_MAX_SIZE:
+                    # rolled over to disk, keep the file I/O off the event loop
+                    await asyncio.to_thread(buffer.write, chunk)
+                else:
+                    buffer.write(chunk)
+        buffer.seek(0)
+        message = await target_bot.send_photo(
+            chat_id=chat_id,
+            photo=buffer,
+            caption=caption,
+            parse_mode=parse_mode,
+        )
+
+    if message.photo:
+        try:
+            await redis.set(key, message.photo[-1].file_id, ex=FILE_ID_TTL)
+        except RedisError as e:
+            logger.warning(f"file_id cache is unavailable: {e}")
+    return message
@@ -0,0 +1,239 @@
+"""
+Telegram HTML of the generated posts
+
+sanitize_html() keeps only the tags and attributes of the Telegram HTML parse
+mode, balances the tags and escapes the text, in a single pass of the stdlib
+HTMLParser tokenizer. split_html() also cuts the result into messages of the
+Telegram length limits, the entities open at a cut are closed and reopened in
+the next message.
+
+https://core.telegram.org/bots/api#html-style
+"""
+
+from html import escape
+from html.parser import HTMLParser
+from typing import NamedTuple
+
+# UTF-16 code units of the text after the entities parsing
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+ALLOWED_TAGS = {
+    *("b", "strong", "i", "em", "u", "ins", "s", "strike", "del"),
+    *("a", "code", "pre", "blockquote", "span", "tg-spoiler", "tg-emoji"),
+}
+LINK_SCHEMES = ("http://", "https://", "tg://", "mailto:")
+# tags without the end tag
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link"}
+VOID_TAGS |= {"meta", "source", "track", "wbr"}
+# tags whose content isn't text
+SKIPPED_TAGS = {"script", "style", "head", "title"}
+
+
+class _Open(NamedTuple):
+    name: str
+    markup: str
+
+
+class _Close(NamedTuple):
+    name: str
+
+
+type _Token = str | _Open | _Close
+
+
+class _Element(NamedTuple):
+    name: str
+    # None when the tag is dropped and only its content is kept
+    open: _Open | None
+
+
+class _Sanitizer(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.tokens: list[_Token] = []
+        self._stack: list[_Element] = []
+        self._skipped = 0
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag in SKIPPED_TAGS:
+            self._skipped += 1
+            return
+        if self._skipped:
+            return
+        if tag == "br":
+            self.tokens.append("\n")
+            return
+        if tag in VOID_TAGS:
+            return
+        open_ = self._open(tag, dict(attrs))
+        self._stack.append(_Element(tag, open_))
+        if open_:
+            self.tokens.append(open_)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in SKIPPED_TAGS:
+            self._skipped = max(self._skipped - 1, 0)
+            return
+        if self._skipped:
+            return
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index].name == tag:
+                break
+        else:
+            # stray end tag
+            return
+        # misnested tags are closed before the end tag and reopened after it
+        reopened = self._stack[index + 1 :]
+        for element in reversed(reopened):
+            self._close(element)
+        self._close(self._stack[index])
+        del self._stack[index:]
+        for element in reopened:
+            self._stack.append(element)
+            if element.open:
+                self.tokens.append(element.open)
+
+    def handle_data(self, data: str) -> None:
+        if data and not self._skipped:
+            self.tokens.append(data)
+
+    def close(self) -> None:
+        super().close()
+        for element in reversed(self._stack):
+            self._close(element)
+        self._stack.clear()
+
+    def _close(self, element: _Element) -> None:
+        if element.open:
+            self.tokens.append(_Close(element.name))
+
+    def _open(self, tag: str, attrs: dict[str, str | None]) -> _Open | None:
+        if tag not in ALLOWED_TAGS:
+            return None
+        opened = {element.name for element in self._stack if element.open}
+        # pre and code can't contain entities besides the code of a pre block
+        if "code" in opened or ("pre" in opened and tag != "code"):
+            return None
+        if tag in opened and tag in ("a", "blockquote", "pre"):
+            return None
+
+        markup = ""
+        match tag:
+            case "a":
+                href = (attrs.get("href") or "").strip()
+                if not href.lower().startswith(LINK_SCHEMES):
+                    return None
+                markup = f' href="{escape(href)}"'
+            case "span":
+                if attrs.get("class") != "tg-spoiler":
+                    return None
+                markup = ' class="tg-spoiler"'
+            case "tg-emoji":
+                emoji_id = attrs.get("emoji-id") or ""
+                if not emoji_id.isdigit():
+                    return None
+                markup = f' emoji-id="{emoji_id}"'
+            case "code":
+                language = attrs.get("class") or ""
+                if "pre" in opened and language.startswith("language-"):
+                    markup = f' class="{escape(language)}"'
+            case "blockquote":
+                if "expandable" in attrs:
+                    markup = " expandable"
+        return _Open(tag, f"<{tag}{markup}>")
+
+
+def _tokens(html: str) -> list[_Token]:
+    parser = _Sanitizer()
+    parser.feed(html)
+    parser.close()
+    return parser.tokens
+
+
+def _render(token: _Token) -> str:
+    match token:
+        case _Open():
+            return token.markup
+        case _Close():
+            return f"</{token.name}>"
+    return escape(token, quote=False)
+
+
+def sanitize_html(html: str) -> str:
+    """
+    Telegram HTML of the text, the disallowed tags are unwrapped
+    """
+    return "".join(_render(token) for token in _tokens(html))
+
+
+def text_length(text: str) -> int:
+    """
+    Length as Telegram counts it, in UTF-16 code units
+    """
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_html(
+    html: str, limit: int = MESSAGE_LIMIT, first_limit: int | None = None
+) -> list[str]:
+    """
+    Sanitizes the text and splits it into messages of at most limit characters,
+    preferably at paragraphs, lines or words
+
+    first_limit: of the first message, e.g. CAPTION_LIMIT for a photo caption
+    """
+    parts: list[str] = []
+    current: list[str] = []
+    opened: list[_Open] = []
+    size = 0
+    part_limit = first_limit or limit
+
+    for token in _tokens(html):
+        if not isinstance(token, str):
+            if isinstance(token, _Open):
+                opened.append(token)
+            else:
+                opened.pop()
+            current.append(_render(token))
+            continue
+
+        text = token
+        while text_length(text) > part_limit - size:
+            cut = _cut(text, part_limit - size) or (0 if size else 1)
+            head, text = text[:cut], text[cut:].lstrip()
+            current.append(escape(head, quote=False))
+            size += text_length(head)
+            if not text:
+                break
+            # the entities continue in the next message
+            current.extend(f"</{element.name}>" for element in reversed(opened))
+            parts.append("".join(current))
+            current = [element.markup for element in opened]
+            size = 0
+            part_limit = limit
+        current.append(escape(text, quote=False))
+        size += text_length(text)
+
+    if size:
+        parts.append("".join(current))
+    return parts
+
+
+def _cut(text: str, room: int) -> int:
+    """
+    Number of characters of the text to keep in room UTF-16 code units
+    """
+    fits = 0
+    units = 0
+    for char in text:
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > room:
+            break
+        fits += 1
+    # not in the first half, the messages would be too short
+    for separator in ("\n\n", "\n", " "):
+        index = text.rfind(separator, 0, fits)
+        if index > fits // 2:
+            return index + len(separator)
+    return fits
@@ -1,85 +1,46 @@
-import asyncio
-import io
 from pathlib import Path
 from uuid import UUID
 
 import structlog
-from langchain_core.prompts import ChatPromptTemplate
 from pydantic import BaseModel
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update, WebAppInfo
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, WebAppInfo
 from telegram.constants import ParseMode
+from telegram.error import TelegramError
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, filters
 from telethon.errors import re
 
 from app.conf import settings
 from app.core.errors import AppError
-from app.core.llm import get_llm, load_prompts
-from app.db import AsyncSessionMaker
 from app.tg.agents.models import (
+    PostGenerationMetadata,
     PostUpdateMetadata,
     TGAgentJobStatus,
     TGAgentJobType,
     TGAgentStatus,
 )
 from app.tg.agents.services import TGAgentJobService, TGAgentService
+from app.tgbot.admission import AdmissionController, Rejection
 from app.tgbot.auth.errors import InvalidInviteCodeError
 from app.tgbot.auth.services import TGInviteCodesService, TGUserService
+from app.tgbot.bot import Bot, send_post
+from app.tgbot.channel_profile import schedule_channel_profile_update
 from app.tgbot.context import Context
+from app.tgbot.debounce import ChatDebouncer
 from app.tgbot.decorators import db_session, requires_auth
+from app.tgbot.file_ids import republish_photo
+from app.tgbot.formatting import CAPTION_LIMIT, split_html
+from app.tgbot.texts import TEXTS
 from app.tgbot.utils import (
-    LocalizedTexts,
+    cancel_job_markup,
     extract_user_data,
     get_invite_code,
     get_texts,
 )
+from app.worker.cancellation import request_cancel
 
 logger = structlog.get_logger()
 
 
-class StartTexts(BaseModel):
-    welcome_text: str
-    welcome_back_text: str
-
-
-class HandlersTexts(BaseModel):
-    start: StartTexts
-
-
-class Texts(LocalizedTexts[HandlersTexts]):
-    en: HandlersTexts
-    ru: HandlersTexts
-
-
-class GenerateChannelProfilePrompts(BaseModel):
-    system_prompt: str
-    channel_profile_generated: str
-    post_message: str
-
-
-class LangPrompts(BaseModel):
-    generate_channel_profile: GenerateChannelProfilePrompts
-
-
-class Prompts(BaseModel):
-    ru: LangPrompts
-
-
-try:
-    TEXTS = load_prompts(
-        Path(__file__).parent / "texts.yaml",
-        Texts,
-        key="handlers",
-    )
-    PROMPTS = load_prompts(
-        Path(__file__).parent / "texts.yaml",
-        Prompts,
-        key="prompts",
-    )
-except:
-    logger.error("Failed to load PostGenerator prompts")
-    raise
-
-
 @db_session
 async def start(update: Update, context: Context) -> None:
     user_data = extract_user_data(update)
@@ -181,6 +142,52 @@ async def process_request(update: Update, context: Context) -> None:
     if not update.effective_chat:
         raise ValueError("context.effective_chat is None")
 
+    debouncer = ChatDebouncer(context.arq, settings.TGBOT_DEBOUNCE_SECONDS)
+    pending_job_id = None
+    if not message.reply_to_message:
+        pending_job_id = await debouncer.pending_job(update.effective_chat.id)
+        if pending_job_id and await agent_job_svc.append_user_prompt(
+            pending_job_id, agent.tg_user_id, message_text
+        ):
+            logger.info("Merged into pending job", job_id=pending_job_id)
+            await message.reply_text(
+                text=get_texts(TEXTS, user_data.language_code).jobs.merged_text
+            )
+            return
+
+    # reject before spending a job row and worker time on a job that would fail
+    admission_ctrl = AdmissionController(context.arq, context.arq.default_queue_name)
+    # a started pending job is replaced below, it doesn't hold the user back
+    admission = await admission_ctrl.admit(user, replaces=pending_job_id)
+    if admission.rejection:
+        logger.info(
+            f"Request rejected: {admission.rejection.value}",
+            tg_user_id=user.tg_id,
+            retry_after=admission.retry_after,
+        )
+        texts = get_texts(TEXTS, user_data.language_code).admission
+        if admission.rejection == Rejection.NO_CREDITS:
+            await message.reply_text(
+                text=texts.no_credits_text,
+                reply_markup=InlineKeyboardMarkup(
+                    [
+                        [
+                            InlineKeyboardButton(
+                                texts.top_up_button,
+                                web_app=WebAppInfo(settings.WEBAPP_URL),
+                            )
+                        ]
+                    ]
+                ),
+            )
+        elif admission.rejection == Rejection.USER_BUSY:
+            await message.reply_text(text=texts.user_busy_text)
+        else:
+            await message.reply_text(
+                text=texts.queue_full_text.format(seconds=admission.retry_after)
+            )
+        return
+
     if message.reply_to_message:
         notify_message = await message.reply_text(text="Updating the post...")
         replied_message = (
@@ -193,26 +200,78 @@ async def process_request(update: Update, context: Context) -> None:
             metadata={
                 "user_prompt": message_text,
                 "original_message": replied_message,
+                "original_message_id": message.reply_to_message.message_id,
                 "notify_message_id": notify_message.message_id,
                 "chat_id": update.effective_chat.id,
                 "photo_id": photos[-1].file_id if photos else None,
+                "photo_unique_id": photos[-1].file_unique_id if photos else None,
             },
             type_=TGAgentJobType.POST_UPDATE,
         )
+        await notify_message.edit_reply_markup(
+            reply_markup=cancel_job_markup(
+                job.id,
+                get_texts(TEXTS, user_data.language_code).jobs.cancel_button,
+            )
+        )
+        await admission_ctrl.track(agent.tg_user_id, job.id)
         await context.arq.enqueue_job("update_post", job.id, update.effective_chat.id)
     else:
+        user_prompt = message_text
+        if pending_job_id:
+            # the worker has already started the pending job, replace it
+            replaced_job = await agent_job_svc.cancel(pending_job_id)
+            if replaced_job:
+                await request_cancel(context.arq, pending_job_id)
+                replaced_metadata = PostGenerationMetadata.model_validate(
+                    replaced_job.metadata_
+                )
+                user_prompt = f"{replaced_metadata.user_prompt}\n{message_text}"
+                await _remove_cancel_button(context, replaced_metadata)
+
         notify_message = await message.reply_text(text="Generating post...")
         job = await agent_job_svc.create(
             tg_user_id=agent.tg_user_id,
             agent_id=agent.id,
             metadata={
-                "user_prompt": message_text,
+                "user_prompt": user_prompt,
                 "notify_message_id": notify_message.message_id,
                 "chat_id": update.effective_chat.id,
             },
             type_=TGAgentJobType.POST_GENERATION,
         )
-        await context.arq.enqueue_job("generate_post", job.id, update.effective_chat.id)
+        await notify_message.edit_reply_markup(
+            reply_markup=cancel_job_markup(
+                job.id,
+                get_texts(TEXTS, user_data.language_code).jobs.cancel_button,
+            )
+        )
+        await admission_ctrl.track(agent.tg_user_id, job.id)
+        await debouncer.set_pending_job(update.effective_chat.id, job.id)
+        await context.arq.enqueue_job(
+            "generate_post",
+            job.id,
+            update.effective_chat.id,
+            _defer_by=debouncer.defer_by,
+        )
+
+
+async def _remove_cancel_button(
+    context: Context, metadata: PostGenerationMetadata
+) -> None:
+    """
+    Best effort, the button of a replaced job only answers it's finished
+    """
+    if not metadata.notify_message_id:
+        return
+    try:
+        await context.bot.edit_message_reply_markup(
+            chat_id=metadata.chat_id,
+            message_id=metadata.notify_message_id,
+            reply_markup=None,
+        )
+    except TelegramError as e:
+        logger.warning(f"Can't remove the cancel button: {e}")
 
 
 @db_session
@@ -278,38 +337,101 @@ async def publish_post(update: Update, context: Context) -> None:
     )
 
     # post in channel
+    user_bot = Bot(agent.user_bot.api_token)
     if metadata.photo_id:
-        buffer = io.BytesIO()
-        photo = await context.bot.get_file(metadata.photo_id)
-        await photo.download_to_memory(buffer)
-        buffer.seek(0)
-
-        await Bot(agent.user_bot.api_token).send_photo(
+        parts = split_html(metadata.original_message, first_limit=CAPTION_LIMIT)
+        await republish_photo(
+            context.bot,
+            user_bot,
+            agent.user_bot.id,
             chat_id=agent.channel_id,
-            photo=buffer,
-            caption=metadata.original_message,
+            file_id=metadata.photo_id,
+            file_unique_id=metadata.photo_unique_id,
+            caption=parts.pop(0) if parts else "",
             parse_mode=ParseMode.HTML,
         )
+        for part in parts:
+            await user_bot.send_message(
+                chat_id=agent.channel_id, text=part, parse_mode=ParseMode.HTML
+            )
     else:
-        await Bot(agent.user_bot.api_token).send_message(
-            chat_id=agent.channel_id,
-            text=metadata.original_message,
-            parse_mode=ParseMode.HTML,
-        )
+        await send_post(user_bot, agent.channel_id, metadata.original_message)
 
     # update channel_profile_generated
-    asyncio.create_task(
-        _update_channel_profile_generated(
-            context.db_session_maker,
-            agent.id,
-            metadata.original_message,
-        )
+    await schedule_channel_profile_update(
+        context.arq, agent.id, metadata.original_message
     )
 
 
 @db_session
+@requires_auth
 async def cancel_publish_post(update: Update, context: Context) -> None:
-    print("cancel_publish_post")
+    if not context.db_session:
+        raise ValueError("DB session is None")
+    if not context.tg_user:
+        raise ValueError("TG user is None")
+
+    callback_query = update.callback_query
+    if not callback_query:
+        raise ValueError("update.callback_query is None")
+    match = re.match(
+        rf"^/cancel-publish-post/({UUID_PATTERN})", callback_query.data or ""
+    )
+    if not match:
+        raise ValueError("Callback query data is None")
+    job_id = UUID(match.group(1))
+
+    agent_job_svc = TGAgentJobService(context.db_session)
+    job = await agent_job_svc.get(job_id)
+    if not job or job.tg_user_id != context.tg_user.tg_id:
+        raise AppError(
+            "Job is not created by the user",
+            job_id=job_id,
+            tg_user_id=context.tg_user.tg_id,
+        )
+
+    # the post stays in the chat, only the publish buttons are removed
+    texts = get_texts(TEXTS, context.tg_user.language_code).jobs
+    await callback_query.answer(text=texts.cancelled_text)
+    await callback_query.edit_message_reply_markup(reply_markup=None)
+
+
+@db_session
+@requires_auth
+async def cancel_job(update: Update, context: Context) -> None:
+    if not context.db_session:
+        raise ValueError("DB session is None")
+    if not context.tg_user:
+        raise ValueError("TG user is None")
+
+    callback_query = update.callback_query
+    if not callback_query:
+        raise ValueError("update.callback_query is None")
+    match = re.match(rf"^/cancel-job/({UUID_PATTERN})", callback_query.data or "")
+    if not match:
+        raise ValueError("Callback query data is None")
+    job_id = UUID(match.group(1))
+
+    agent_job_svc = TGAgentJobService(context.db_session)
+    job = await agent_job_svc.get(job_id)
+    if not job or job.tg_user_id != context.tg_user.tg_id:
+        raise AppError(
+            "Job is not created by the user",
+            job_id=job_id,
+            tg_user_id=context.tg_user.tg_id,
+        )
+
+    texts = get_texts(TEXTS, context.tg_user.language_code).jobs
+    if not await agent_job_svc.cancel(job_id):
+        await callback_query.answer(text=texts.already_finished_text)
+        await callback_query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    # the worker releases the credits when it stops the job
+    await request_cancel(context.arq, job_id)
+    logger.info("Job cancelled by user", job_id=job_id)
+    await callback_query.answer(text=texts.cancelled_text)
+    await callback_query.edit_message_text(text=texts.cancelled_job_text)
 
 
 @db_session
@@ -406,60 +528,9 @@ async def generate_invite(uses: int, update: Update, context: Context) -> None:
     )
 
 
-async def _update_channel_profile_generated(
-    db_session_maker: AsyncSessionMaker,
-    agent_id: UUID,
-    post_message: str,
-) -> None:
-    async with db_session_maker() as db_session:
-        agent_svc = TGAgentService(db_session)
-        tg_user_svc = TGUserService(db_session)
-
-        agent = await agent_svc.get(agent_id)
-        if not agent:
-            raise AppError("Agent not found", agent_id=agent_id)
-        if not agent.tg_user_id:
-            raise AppError("Agent is orphaned", agent_id=agent_id)
-
-        user = await tg_user_svc.get_user(agent.tg_user_id)
-        if not user:
-            raise AppError("User not found", tg_user_id=agent.tg_user_id)
-
-        prompts = get_texts(PROMPTS, user.language_code)
-
-        llm = get_llm("o4-mini")
-
-        prompt_template = ChatPromptTemplate(
-            [
-                ("system", prompts.generate_channel_profile.system_prompt),
-                (
-                    "system",
-                    prompts.generate_channel_profile.channel_profile_generated,
-                ),
-                ("user", prompts.generate_channel_profile.post_message),
-            ]
-        )
-
-        messages = prompt_template.format_messages(
-            channel_profile_generated=agent.channel_profile_generated,
-            post_message=post_message,
-        )
-        result = await llm.ainvoke(messages)
-
-        channel_profile_generated = result.content
-        if channel_profile_generated:
-            if not isinstance(channel_profile_generated, str):
-                raise AppError(
-                    "channel_profile_generated is not a string", agent_id=agent_id
-                )
-
-            await agent_svc.update_channel_profile_generated(
-                agent_id, channel_profile_generated=channel_profile_generated
-            )
-
-
 UUID_PATTERN = r"[a-fA-F0-9]{8}-[a-fA-F0-9]{4}-[1-5][a-fA-F0-9]{3}-[89abAB][a-fA-F0-9]{3}-[a-fA-F0-9]{12}"
 
+
 handlers = [
     CommandHandler("start", start),
     CommandHandler("generate_invites", generate_invites),
@@ -470,5 +541,6 @@ handlers = [
     CallbackQueryHandler(
         cancel_publish_post, pattern=f"^/cancel-publish-post/({UUID_PATTERN})"
     ),
+    CallbackQueryHandler(cancel_job, pattern=f"^/cancel-job/({UUID_PATTERN})"),
     MessageHandler(filters.TEXT & ~filters.COMMAND, process_request),
 ]
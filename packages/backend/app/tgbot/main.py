@@ -1,22 +1,34 @@
-from collections.abc import AsyncGenerator
+import functools
+import time
+from collections.abc import AsyncGenerator, Sequence
 from contextlib import asynccontextmanager
+from typing import Any
 
 import structlog
 from arq.connections import create_pool
 from telegram import BotCommand, Update
+from telegram.ext import BaseHandler
 
 from app.conf import settings
 from app.core.errors import ForbiddenError
+from app.core.metrics import histogram
 from app.db import AsyncSessionMaker
 from app.tg.credits.handlers import handlers as credits_handlers
 from app.tgbot.app import TGApp, tg_app
 from app.tgbot.context import Context
-from app.tgbot.handlers import TEXTS, handlers
+from app.tgbot.handlers import handlers
+from app.tgbot.texts import TEXTS
 from app.tgbot.utils import extract_user_data, get_texts
 from app.worker.conf import WorkerSettings
 
 logger = structlog.get_logger()
 
+HANDLER_DURATION = histogram(
+    "tgbot_handler_duration_seconds",
+    "Updates handled by the bot handlers",
+    ("handler", "result"),
+)
+
 
 async def error_handler(update: object, context: Context) -> None:
     error = context.error
@@ -34,10 +46,39 @@ async def error_handler(update: object, context: Context) -> None:
     logger.exception("Exception while handling update:", exc_info=error)
 
 
+def _timed[H: BaseHandler[Any, Any, Any]](handlers: Sequence[H]) -> Sequence[H]:
+    for handler in handlers:
+        callback = handler.callback
+        if getattr(callback, "__timed__", False):
+            continue
+        handler.callback = _timed_callback(callback)
+    return handlers
+
+
+def _timed_callback(callback: Any) -> Any:
+    name = getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update: Any, context: Any) -> Any:
+        started_at = time.perf_counter()
+        result = "error"
+        try:
+            output = await callback(update, context)
+            result = "ok"
+            return output
+        finally:
+            HANDLER_DURATION.observe(
+                time.perf_counter() - started_at, handler=name, result=result
+            )
+
+    wrapper.__timed__ = True  # type: ignore[attr-defined]
+    return wrapper
+
+
 @asynccontextmanager
 async def start_tg_app(session_maker: AsyncSessionMaker) -> AsyncGenerator[TGApp, None]:
-    tg_app.add_handlers(handlers)
-    tg_app.add_handlers(credits_handlers)
+    tg_app.add_handlers(_timed(handlers))
+    tg_app.add_handlers(_timed(credits_handlers))
     tg_app.add_error_handler(error_handler)
     if settings.TGBOT_SETUP_COMMANDS:
         await setup_commands(tg_app)
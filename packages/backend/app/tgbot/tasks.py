@@ -1,16 +1,24 @@
 import asyncio
-import io
 from uuid import UUID
 
 import structlog
-from telegram import Bot
+from arq import Retry
 
-from app.conf import settings
 from app.core.errors import AppError, NotFoundError
-from app.core.utils import get_s3_client
-from app.tg.agents.models import ChannelMetadata
+from app.core.storage import object_exists, upload_stream
 from app.tg.agents.services import TGAgentService
-from app.worker.conf import JobContext, task
+from app.tgbot.auth.services import TGUserService
+from app.tgbot.bot import Bot, stream_file
+from app.tgbot.channel_profile import (
+    DEBOUNCE_SECONDS,
+    LOCK_TIMEOUT,
+    UPDATE_TIMEOUT,
+    lock_key,
+    return_posts,
+    summarize_posts,
+    take_posts,
+)
+from app.worker.conf import JobContext, WorkerSettings, task
 
 logger = structlog.get_logger()
 
@@ -35,35 +43,99 @@ async def fetch_channel_photo(ctx: JobContext, agent_id: UUID) -> None:
         raise NotFoundError("Channel photo not found", agent_id=agent_id)
 
     bot = Bot(agent.user_bot.api_token)
-    channel_metadata = ChannelMetadata(**agent.channel_metadata.model_dump())
-    photo = channel_metadata.photo
-    if not photo:
-        raise NotFoundError("Channel photo not found", agent_id=agent_id)
-
-    if photo.small_file_id:
-        file_path = await _upload_file_id(bot, agent.tg_user_id, photo.small_file_id)
-        photo.small_file_path = file_path
-
-    if photo.big_file_id:
-        file_path = await _upload_file_id(bot, agent.tg_user_id, photo.big_file_id)
-        photo.big_file_path = file_path
-
+    photo = agent.channel_metadata.photo
+    (small_path, small_unique_id), (big_path, big_unique_id) = await asyncio.gather(
+        _store_photo(
+            bot,
+            photo.small_file_id,
+            photo.small_file_unique_id,
+            photo.small_file_path,
+        ),
+        _store_photo(
+            bot, photo.big_file_id, photo.big_file_unique_id, photo.big_file_path
+        ),
+    )
+    stored_photo = photo.model_copy(
+        update={
+            "small_file_path": small_path,
+            "small_file_unique_id": small_unique_id,
+            "big_file_path": big_path,
+            "big_file_unique_id": big_unique_id,
+        }
+    )
+    if stored_photo == photo:
+        return
+
+    channel_metadata = agent.channel_metadata.model_copy(update={"photo": stored_photo})
     agent = await tg_agent_svc.update_channel_metadata(agent_id, channel_metadata)
 
 
-async def _upload_file_id(bot: Bot, tg_user_id: int, file_id: str) -> str:
-    file_path = f"{tg_user_id}/bot/{file_id}"
-    s3_client = get_s3_client()
+@task("update_channel_profile", timeout=UPDATE_TIMEOUT)
+async def update_channel_profile(ctx: JobContext, agent_id: UUID) -> None:
+    """
+    Debounced by schedule_channel_profile_update
+    """
+    lock = ctx.redis.lock(lock_key(agent_id), timeout=LOCK_TIMEOUT)
+    if not await lock.acquire(blocking=False):
+        # the running update may have taken only a part of the posts
+        if ctx.job_try < WorkerSettings.max_tries:
+            raise Retry(defer=DEBOUNCE_SECONDS)
+        # the posts are scheduled already, a new publish won't enqueue a run
+        logger.warning("Channel profile is still locked", agent_id=agent_id)
+        await ctx.redis.enqueue_job(
+            "update_channel_profile", agent_id, _defer_by=DEBOUNCE_SECONDS
+        )
+        return
+    try:
+        posts = await take_posts(ctx.redis, agent_id)
+        if not posts:
+            return
+        try:
+            await summarize_posts(
+                TGAgentService(ctx.db_session),
+                TGUserService(ctx.db_session),
+                agent_id,
+                posts,
+            )
+        except Exception as e:
+            logger.exception(e)
+            await return_posts(ctx.redis, agent_id, posts)
+            raise Retry(defer=DEBOUNCE_SECONDS) from e
+        logger.info("Channel profile updated", agent_id=agent_id, posts=len(posts))
+    finally:
+        await lock.release()
+
+
+def photo_key(file_unique_id: str) -> str:
+    """
+    Same photo, same key, whoever's channel it is
+    """
+    return f"channel_photos/{file_unique_id}.jpg"
+
+
+async def _store_photo(
+    bot: Bot,
+    file_id: str | None,
+    file_unique_id: str | None,
+    stored_path: str | None,
+) -> tuple[str | None, str | None]:
+    """
+    Returns the storage key and file_unique_id, uploads only new photos
+    """
+    if not file_id:
+        return None, None
+    if file_unique_id and stored_path == photo_key(file_unique_id):
+        return stored_path, file_unique_id
+    if file_unique_id and await object_exists(photo_key(file_unique_id)):
+        return photo_key(file_unique_id), file_unique_id
 
     file = await bot.get_file(file_id)
-    buffer = io.BytesIO()
-    await file.download_to_memory(buffer)
-    buffer.seek(0)
-
-    def upload(buffer: io.BytesIO) -> None:
-        s3_client.upload_fileobj(buffer, settings.STORAGE_BUCKET, file_path)
+    file_path = photo_key(file.file_unique_id)
+    if file.file_unique_id != file_unique_id and await object_exists(file_path):
+        return file_path, file.file_unique_id
 
-    await asyncio.get_event_loop().run_in_executor(None, upload, buffer)
+    async with stream_file(file) as chunks:
+        await upload_stream(file_path, chunks, content_type="image/jpeg")
     logger.info(f"File uploaded {file_path}")
 
-    return file_path
+    return file_path, file.file_unique_id
@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import structlog
+from pydantic import BaseModel
+
+from app.core.llm import load_prompts
+from app.tgbot.utils import LocalizedTexts
+
+logger = structlog.get_logger()
+
+
+class StartTexts(BaseModel):
+    welcome_text: str
+    welcome_back_text: str
+
+
+class AdmissionTexts(BaseModel):
+    no_credits_text: str
+    user_busy_text: str
+    # {seconds}
+    queue_full_text: str
+    top_up_button: str
+
+
+class JobsTexts(BaseModel):
+    merged_text: str
+    cancelled_text: str
+    cancelled_job_text: str
+    already_finished_text: str
+    timed_out_text: str
+    unavailable_text: str
+    cancel_button: str
+
+
+class HandlersTexts(BaseModel):
+    start: StartTexts
+    admission: AdmissionTexts
+    jobs: JobsTexts
+
+
+class Texts(LocalizedTexts[HandlersTexts]):
+    en: HandlersTexts
+    ru: HandlersTexts
+
+
+try:
+    TEXTS = load_prompts(
+        Path(__file__).parent / "texts.yaml",
+        Texts,
+        key="handlers",
+    )
+except:
+    logger.error("Failed to load the bot texts")
+    raise
@@ -1,8 +1,9 @@
 from functools import lru_cache
 from typing import Generic, Literal, TypeVar, cast
+from uuid import UUID
 
 from pydantic import BaseModel
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 
 from app.tgbot.context import Context
 from app.tgbot.schemas import UserTGData
@@ -54,3 +55,9 @@ def get_invite_code(context: Context) -> str | None:
 
     payload = context.args[0]
     return str(payload).split("&")[0].strip()
+
+
+def cancel_job_markup(job_id: UUID, label: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(label, callback_data=f"/cancel-job/{job_id}")]]
+    )
@@ -3,8 +3,8 @@ import app.tgbot.tasks  # noqa
 import app.models.all  # noqa
 # from app.logging import configure_logging
 
-from .conf import WorkerSettings, task
+from .conf import WorkerSettings, cron_task, task
 
 # configure_logging("worker")
 
-__all__ = ["WorkerSettings", "task"]
+__all__ = ["WorkerSettings", "cron_task", "task"]
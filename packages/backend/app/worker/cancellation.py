@@ -0,0 +1,108 @@
+"""
+Cancellation of running jobs
+
+A cancel request sets a flag in Redis and is broadcast to all workers.
+The worker running the job cancels its asyncio task, so the job stops
+mid-LLM-call or mid-scrape, and the job gets JobCancelledError.
+The flag covers jobs that are picked up after the broadcast.
+"""
+
+import asyncio
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from typing import Any
+from uuid import UUID
+
+import structlog
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from app.core.errors import JobCancelledError
+
+logger = structlog.get_logger()
+
+CANCEL_CHANNEL = "viralink:jobs:cancel"
+# longer than any job may wait in the queue and run
+CANCEL_FLAG_TTL = 60 * 60
+
+_running: dict[UUID, asyncio.Task[Any]] = {}
+_cancelled: set[UUID] = set()
+
+
+def _cancel_flag_key(job_id: UUID) -> str:
+    return f"viralink:jobs:{job_id}:cancel"
+
+
+async def request_cancel(redis: Redis, job_id: UUID) -> None:
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.set(_cancel_flag_key(job_id), 1, ex=CANCEL_FLAG_TTL)
+        pipe.publish(CANCEL_CHANNEL, str(job_id))
+        await pipe.execute()
+
+
+@asynccontextmanager
+async def cancellable(redis: Redis, job_id: UUID) -> AsyncGenerator[None, None]:
+    """
+    Registers the current task, raises JobCancelledError if the job is cancelled
+    """
+    task = asyncio.current_task()
+    if task is None:
+        raise RuntimeError("cancellable must be used inside a task")
+
+    _running[job_id] = task
+    try:
+        try:
+            is_cancelled = await redis.exists(_cancel_flag_key(job_id))
+        except RedisError as e:
+            logger.warning(f"Can't check the cancel flag: {e}", job_id=job_id)
+            is_cancelled = False
+        if is_cancelled:
+            raise JobCancelledError(code=JobCancelledError.code, job_id=job_id)
+        yield
+    except asyncio.CancelledError:
+        if job_id not in _cancelled:
+            # job timeout or worker shutdown
+            raise
+        task.uncancel()
+        raise JobCancelledError(code=JobCancelledError.code, job_id=job_id) from None
+    finally:
+        _running.pop(job_id, None)
+        _cancelled.discard(job_id)
+
+
+def cancel_running(job_id: UUID) -> bool:
+    """
+    Cancels the job if it's running in this process
+    """
+    task = _running.get(job_id)
+    if task is None or task.done():
+        return False
+    _cancelled.add(job_id)
+    task.cancel()
+    return True
+
+
+async def listen_for_cancellations(redis: Redis) -> None:
+    """
+    Runs for the lifetime of the worker
+    """
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(CANCEL_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    try:
+                        job_id = UUID(message["data"].decode())
+                    except (ValueError, UnicodeDecodeError) as e:
+                        logger.warning(
+                            f"Malformed cancellation message: {e}",
+                            data=message["data"],
+                        )
+                        continue
+                    if cancel_running(job_id):
+                        logger.info("Cancelling job", job_id=job_id)
+        except RedisError as e:
+            logger.warning(f"Cancellation listener is disconnected: {e}")
+            await asyncio.sleep(1)
@@ -1,24 +1,49 @@
+import asyncio
 import contextlib
 import functools
-from collections.abc import AsyncGenerator
+import time
+from collections.abc import AsyncGenerator, Coroutine
 from datetime import datetime
 from typing import Any, Callable, Protocol, TypedDict
 
 import structlog
-from arq.connections import RedisSettings
+from arq.connections import ArqRedis, RedisSettings
+from arq.cron import CronJob, cron
 from arq.worker import Function, func
 from pydantic import BaseModel, ConfigDict
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 
 from app.conf import settings
+from app.core.loop_monitor import LoopMonitor, start_loop_monitor
+from app.core.metrics import REGISTRY, gauge, histogram
+from app.core.profiling import profile, tracemalloc_diff
+from app.core.prometheus import Route, start_metrics_server
+from app.core.retry import retry_budget
+from app.core.telemetry import collect_telemetry
 from app.db import AsyncSessionMaker, create_async_engine, create_session_maker
+from app.worker.cancellation import listen_for_cancellations
 
 logger = structlog.get_logger()
 
+QUEUE_DEPTH = gauge("worker_queue_depth", "Jobs queued, deferred included", ("queue",))
+JOBS_IN_FLIGHT = gauge("worker_jobs_in_flight", "Jobs running", ("function",))
+JOB_WAIT = histogram(
+    "worker_job_wait_seconds",
+    "From the scheduled time of a job to its first try",
+    ("function",),
+)
+JOB_DURATION = histogram(
+    "worker_job_duration_seconds", "Tries of the jobs", ("function", "result")
+)
+
 
 class WorkerContext(TypedDict):
+    redis: ArqRedis
     engine: AsyncEngine
     db_session_maker: AsyncSessionMaker
+    cancellation_listener: asyncio.Task[None]
+    metrics_server: asyncio.Server | None
+    loop_monitor: LoopMonitor | None
 
 
 class JobContext(BaseModel):
@@ -27,6 +52,7 @@ class JobContext(BaseModel):
     job_try: int
     enqueue_time: datetime
     score: int
+    redis: ArqRedis
 
     engine: AsyncEngine
     db_session_maker: AsyncSessionMaker
@@ -43,8 +69,12 @@ class JobContext(BaseModel):
 
 class WorkerSettings:
     functions: list[Function] = []
+    cron_jobs: list[CronJob] = []
     queue_name: str = "viralink:queue"
-    job_timeout = 60 * 60
+    # fallback for tasks without their own timeout
+    job_timeout = 10 * 60
+    # arq's default, tasks raising Retry check it to act on their last try
+    max_tries = 5
 
     redis_settings = RedisSettings.from_dsn(settings.REDIS_URL.get_secret_value())
 
@@ -53,9 +83,19 @@ class WorkerSettings:
         logger.info("Worker startup")
         engine = ctx["engine"] = create_async_engine(settings.DATABASE_URL, "worker")
         ctx["db_session_maker"] = create_session_maker(engine)
+        ctx["cancellation_listener"] = asyncio.create_task(
+            listen_for_cancellations(ctx["redis"])
+        )
+        ctx["metrics_server"] = await _start_metrics(ctx["redis"])
+        ctx["loop_monitor"] = start_loop_monitor("worker")
 
     @staticmethod
     async def on_shutdown(ctx: WorkerContext) -> None:
+        ctx["cancellation_listener"].cancel()
+        if server := ctx["metrics_server"]:
+            server.close()
+        if loop_monitor := ctx["loop_monitor"]:
+            await loop_monitor.stop()
         await ctx["engine"].dispose()
         logger.info("Worker shutdown")
 
@@ -68,25 +108,133 @@ class Task[**P](Protocol):
 
 def task[**P](
     name: str,
+    *,
+    timeout: float | None = None,
+    retries: int = 10,
+    keep_result: float | None = None,
 ) -> Callable[[Task[P]], Task[P]]:
+    """
+    Registers the function as arq task
+
+    timeout: seconds, defaults to WorkerSettings.job_timeout
+    retries: budget of external call retries for a single job
+    keep_result: seconds to keep the result for Job.status(), defaults to arq's
+    """
+
     def decorator(
         f: Task[P],
     ) -> Task[P]:
-        @functools.wraps(f)
-        async def _func(ctx: dict[Any, Any], *args: P.args, **kwargs: P.kwargs) -> Any:
-            db_session_maker = ctx["db_session_maker"]
-            if not db_session_maker:
-                raise ValueError("Database session maker is None")
+        job = func(
+            _with_job_context(f, name, retries),
+            name=name,
+            timeout=timeout,
+            keep_result=keep_result,
+        )
+        WorkerSettings.functions.append(job)
 
-            async with db_session_maker() as db_session:
-                job_context = JobContext.model_validate(
-                    {**ctx, "db_session": db_session}
-                )
-                return await f(job_context, *args, **kwargs)
+        return f
+
+    return decorator
 
-        job = func(_func, name=name)
-        WorkerSettings.functions.append(job)
+
+def cron_task(
+    name: str,
+    *,
+    hour: int | set[int] | None = None,
+    minute: int | set[int] | None = None,
+    timeout: float | None = None,
+    retries: int = 10,
+) -> Callable[[Task[[]]], Task[[]]]:
+    """
+    Registers the function as arq cron job,
+    a run is skipped while the previous one is still running
+
+    hour, minute: schedule as in arq.cron, None means every
+    """
+
+    def decorator(f: Task[[]]) -> Task[[]]:
+        job = cron(
+            _with_job_context(f, name, retries),
+            name=name,
+            hour=hour,
+            minute=minute,
+            timeout=timeout,
+            unique=True,
+        )
+        WorkerSettings.cron_jobs.append(job)
 
         return f
 
     return decorator
+
+
+async def _start_metrics(redis: ArqRedis) -> asyncio.Server | None:
+    async def collect_queue_depth() -> None:
+        queue = WorkerSettings.queue_name
+        QUEUE_DEPTH.set(await redis.zcard(queue), queue=queue)
+
+    REGISTRY.add_collector(collect_queue_depth)
+    if settings.WORKER_METRICS_PORT is None:
+        return None
+
+    async def tracemalloc(query: dict[str, str]) -> str:
+        try:
+            limit = int(query.get("limit", 20))
+        except ValueError:
+            raise ValueError("limit must be an integer") from None
+        if not 0 < limit <= 200:
+            raise ValueError("limit must be in 1..200")
+        return await asyncio.to_thread(tracemalloc_diff, limit, "stop" in query)
+
+    # the metrics are open without the token, the memory dumps are not
+    routes: dict[str, Route] = {}
+    if settings.METRICS_TOKEN is not None:
+        routes["/tracemalloc"] = tracemalloc
+    try:
+        return await start_metrics_server(
+            "0.0.0.0", settings.WORKER_METRICS_PORT, routes
+        )
+    except OSError as e:
+        # e.g. another worker on the host, the jobs don't depend on it
+        logger.warning(f"Can't serve metrics: {e}")
+        return None
+
+
+def _with_job_context[**P](
+    f: Task[P], name: str, retries: int
+) -> Callable[..., Coroutine[Any, Any, Any]]:
+    @functools.wraps(f)
+    async def _func(ctx: dict[Any, Any], *args: P.args, **kwargs: P.kwargs) -> Any:
+        db_session_maker = ctx["db_session_maker"]
+        if not db_session_maker:
+            raise ValueError("Database session maker is None")
+
+        if ctx["job_try"] == 1:
+            # score is the time the job was due at in ms, deferred jobs included
+            JOB_WAIT.observe(max(time.time() - ctx["score"] / 1000, 0), function=name)
+        JOBS_IN_FLIGHT.inc(function=name)
+        started_at = time.perf_counter()
+        result = "error"
+        try:
+            async with db_session_maker() as db_session:
+                job_context = JobContext.model_validate(
+                    {**ctx, "db_session": db_session}
+                )
+                with retry_budget(retries), collect_telemetry():
+                    async with profile(
+                        "job", name, job_id=ctx["job_id"], job_try=ctx["job_try"]
+                    ):
+                        output = await f(job_context, *args, **kwargs)
+            result = "ok"
+            return output
+        except asyncio.CancelledError:
+            # aborted or timed out
+            result = "cancelled"
+            raise
+        finally:
+            JOBS_IN_FLIGHT.dec(function=name)
+            JOB_DURATION.observe(
+                time.perf_counter() - started_at, function=name, result=result
+            )
+
+    return _func
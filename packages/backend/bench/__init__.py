@@ -0,0 +1,5 @@
+"""
+Benchmarks, run from packages/backend with the app settings in the environment:
+
+    python -m bench.<name>
+"""
@@ -0,0 +1,318 @@
+"""
+Deterministic fake backends for the pipeline benchmarks
+
+Replace the LLMs, the image model, the web search, the page fetch of the scraper
+and the Telegram calls of the post generation tasks. Every fake waits for a latency
+drawn from its distribution, so the pipeline does the same work it does against
+the real providers, including trafilatura extracting the fetched pages.
+"""
+
+import asyncio
+import contextlib
+import math
+import random
+import time
+from collections.abc import Iterator, Sequence
+from typing import Any
+from unittest import mock
+
+import trafilatura
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
+from langchain_core.messages import AIMessage, BaseMessage, ToolCall, ToolMessage
+from langchain_core.messages.ai import UsageMetadata
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import BaseModel, ConfigDict
+
+from app.core import llm as core_llm
+from app.tg.agents import tasks
+from app.tg.agents.post_generator.tools import (
+    content_provider,
+    image_generator,
+    publisher,
+    search_query_builder,
+)
+
+WORDS = [
+    *("канал", "новости", "рынок", "неделя", "запуск", "продукт", "команда"),
+    *("рост", "данные", "модель", "пользователи", "релиз", "обновление"),
+    *("тренд", "аналитика", "стартап", "инвестиции", "идея"),
+]
+FAKE_HOST = "bench.invalid"
+
+
+class Distribution(BaseModel):
+    """
+    Log-normal around the median, sigma 0 makes it constant
+    """
+
+    median: float
+    sigma: float = 0.5
+
+    def sample(self, rng: random.Random, scale: float = 1) -> float:
+        if not self.sigma:
+            return self.median * scale
+        return self.median * math.exp(rng.gauss(0, self.sigma)) * scale
+
+
+class LLMConfig(BaseModel):
+    # seconds
+    latency: Distribution = Distribution(median=4)
+    output_tokens: Distribution = Distribution(median=350, sigma=0.3)
+    # share of post generations that call content_provider
+    web_search_rate: float = 0.7
+    # shares of post updates that call publish and image_generator
+    publish_rate: float = 0.2
+    image_rate: float = 0.3
+
+
+class FakeBackendsConfig(BaseModel):
+    llm: LLMConfig = LLMConfig()
+    # seconds
+    image: Distribution = Distribution(median=10, sigma=0.3)
+    image_download: Distribution = Distribution(median=0.5)
+    search: Distribution = Distribution(median=0.6)
+    page_fetch: Distribution = Distribution(median=1)
+    telegram: Distribution = Distribution(median=0.15, sigma=0.3)
+    # bytes of the fetched page HTML
+    page_size: Distribution = Distribution(median=60_000, sigma=0.6)
+    # multiplies every latency, e.g. 0.1 for a quick run
+    latency_scale: float = 1
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Answers with tool calls as often as configured, then with a post
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    config: LLMConfig
+    latency_scale: float = 1
+    rng: random.Random
+
+    @property
+    def _llm_type(self) -> str:
+        return "bench-fake"
+
+    def bind_tools(
+        self,
+        tools: Sequence[Any],
+        *,
+        tool_choice: str | None = None,
+        **kwargs: Any,
+    ) -> Runnable[LanguageModelInput, BaseMessage]:
+        return self.bind(
+            tools=[convert_to_openai_tool(tool) for tool in tools],
+            tool_choice=tool_choice,
+            **kwargs,
+        )
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        The same answers without the latency, the pipeline calls it asynchronously
+        """
+        return self._result(messages, kwargs.get("tools"))
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await asyncio.sleep(self.config.latency.sample(self.rng, self.latency_scale))
+        return self._result(messages, kwargs.get("tools"))
+
+    def _result(
+        self, messages: list[BaseMessage], tools: list[dict[str, Any]] | None
+    ) -> ChatResult:
+        message = self._respond(
+            messages, {tool["function"]["name"] for tool in tools or []}
+        )
+        input_tokens = sum(len(str(m.content)) for m in messages) // 3
+        output_tokens = len(str(message.content)) // 3 + 20 * len(message.tool_calls)
+        message.usage_metadata = UsageMetadata(
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            total_tokens=input_tokens + output_tokens,
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _respond(self, messages: list[BaseMessage], tools: set[str]) -> AIMessage:
+        if "SearchQueries" in tools:
+            return self._tool_call("SearchQueries", {"queries": [self._text(8)]})
+        if messages and isinstance(messages[-1], ToolMessage):
+            return AIMessage(self._post())
+        if (
+            "content_provider" in tools
+            and self.rng.random() < self.config.web_search_rate
+        ):
+            return self._tool_call("content_provider", {"user_prompt": ""})
+        if "publish" in tools:
+            choice = self.rng.random()
+            if choice < self.config.publish_rate:
+                return self._tool_call("publish", {})
+            if choice < self.config.publish_rate + self.config.image_rate:
+                return self._tool_call("image_generator", {})
+        return AIMessage(self._post())
+
+    def _tool_call(self, name: str, args: dict[str, Any]) -> AIMessage:
+        return AIMessage(
+            "",
+            tool_calls=[
+                ToolCall(
+                    name=name,
+                    args=args,
+                    id=f"call_{self.rng.getrandbits(64):x}",
+                    type="tool_call",
+                )
+            ],
+        )
+
+    def _post(self) -> str:
+        words = int(self.config.output_tokens.sample(self.rng) * 0.75)
+        return f"<b>{self._text(6)}</b>\n\n<p>{self._text(words)}</p>"
+
+    def _text(self, words: int) -> str:
+        return " ".join(self.rng.choices(WORDS, k=max(words, 1)))
+
+
+class FakeImageLLM:
+    def __init__(self, config: FakeBackendsConfig, rng: random.Random) -> None:
+        self.config = config
+        self.rng = rng
+
+    async def ainvoke(self, prompt: str) -> str:
+        await asyncio.sleep(
+            self.config.image.sample(self.rng, self.config.latency_scale)
+        )
+        return f"https://{FAKE_HOST}/images/{self.rng.getrandbits(64):x}.jpg"
+
+
+class FakeBot:
+    """
+    Stands for app.tgbot.bot.Bot in the tasks, messages go nowhere
+    """
+
+    config: FakeBackendsConfig
+    rng: random.Random
+
+    def __init__(self, token: str, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    async def send_message(self, *args: Any, **kwargs: Any) -> None:
+        await self._call()
+
+    async def send_photo(self, *args: Any, **kwargs: Any) -> None:
+        await self._call()
+
+    async def _call(self) -> None:
+        await asyncio.sleep(
+            self.config.telegram.sample(self.rng, self.config.latency_scale)
+        )
+
+
+def _page(size: int, rng: random.Random) -> str:
+    paragraphs = []
+    length = 0
+    while length < size:
+        paragraph = f"<p>{' '.join(rng.choices(WORDS, k=60))}.</p>"
+        paragraphs.append(paragraph)
+        length += len(paragraph)
+    return (
+        "<html><head><title>Bench</title></head><body><article>"
+        f"<h1>{' '.join(rng.choices(WORDS, k=6))}</h1>{''.join(paragraphs)}"
+        "</article></body></html>"
+    )
+
+
+@contextlib.contextmanager
+def fake_backends(
+    config: FakeBackendsConfig, seed: int, *, telegram: bool = True
+) -> Iterator[None]:
+    """
+    Patches the providers of the post generation tasks for the current process
+
+    telegram: False keeps the real Bot, e.g. against bench.telegram_emulator
+    """
+    rng = random.Random(seed)
+    scale = config.latency_scale
+    chat_model = FakeChatModel(config=config.llm, latency_scale=scale, rng=rng)
+    image_llm = FakeImageLLM(config, rng)
+    FakeBot.config = config
+    FakeBot.rng = rng
+
+    def get_llm(model: str = "gpt-4o") -> FakeChatModel:
+        return chat_model
+
+    def get_image_llm(model: str = "recraft-ai/recraft-v3") -> FakeImageLLM:
+        return image_llm
+
+    class FakeGoogleSearch:
+        def __init__(self, **kwargs: Any) -> None:
+            pass
+
+        def results(
+            self, query: str, num_results: int, **kwargs: Any
+        ) -> list[dict[str, Any]]:
+            # runs in the executor as the real one
+            time.sleep(config.search.sample(rng, scale))
+            return [
+                {
+                    "title": query,
+                    "link": f"https://{FAKE_HOST}/pages/{rng.getrandbits(64):x}",
+                    "snippet": query,
+                }
+                for _ in range(num_results)
+            ]
+
+    class FakeDuckDuckGoSearch:
+        def __init__(self, **kwargs: Any) -> None:
+            pass
+
+        async def ainvoke(self, query: str) -> list[dict[str, Any]]:
+            await asyncio.sleep(config.search.sample(rng, scale))
+            return FakeGoogleSearch().results(query, 1)
+
+    def fetch_url(url: str, *args: Any, **kwargs: Any) -> str:
+        time.sleep(config.page_fetch.sample(rng, scale))
+        return _page(int(config.page_size.sample(rng)), rng)
+
+    async def download_image(url: str) -> str:
+        await asyncio.sleep(config.image_download.sample(rng, scale))
+        return url
+
+    patches: list[tuple[Any, str, Any]] = [
+        (core_llm, "get_llm", get_llm),
+        (search_query_builder, "get_llm", get_llm),
+        (image_generator, "get_llm", get_llm),
+        (image_generator, "get_image_llm", get_image_llm),
+        (content_provider, "GoogleSearchAPIWrapper", FakeGoogleSearch),
+        (content_provider, "DuckDuckGoSearchResults", FakeDuckDuckGoSearch),
+        (trafilatura, "fetch_url", fetch_url),
+        (tasks, "download_image", download_image),
+    ]
+    if telegram:
+        patches += [(tasks, "Bot", FakeBot), (publisher, "Bot", FakeBot)]
+
+    with contextlib.ExitStack() as stack:
+        for target, name, fake in patches:
+            stack.enter_context(mock.patch.object(target, name, fake))
+        # runnables built from the real clients
+        core_llm._llms_with_tools.clear()
+        search_query_builder._get_runnables.cache_clear()
+        stack.callback(core_llm._llms_with_tools.clear)
+        stack.callback(search_query_builder._get_runnables.cache_clear)
+        yield
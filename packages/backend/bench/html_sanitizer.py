@@ -0,0 +1,173 @@
+"""
+Telegram HTML sanitizer against the BeautifulSoup round-trip it replaced
+
+    python -m bench.html_sanitizer [--posts 2000] [--seed 1]
+
+Generates posts like the LLM writes them (paragraphs, emojis, links, lists,
+stray < and &, misnested and unclosed tags) and reports as JSON the time per
+post of sanitize_html, split_html and of the former keep_only_allowed_tags,
+and how many of their outputs Telegram would reject: unbalanced tags,
+links without http(s) href or unescaped < and &.
+"""
+
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+from collections.abc import Callable
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup, Tag
+
+from app.tgbot.formatting import CAPTION_LIMIT, sanitize_html, split_html
+
+WORDS = [
+    *("growth", "channel", "audience", "post", "viral", "content", "launch"),
+    *("AI", "strategy", "week", "results", "metrics", "tips", "team", "product"),
+]
+EMOJIS = ["🚀", "🔥", "✅", "📈", "💡"]
+
+
+def keep_only_allowed_tags(html: str) -> str:
+    """
+    The former implementation of app.tg.agents.post_generator
+    """
+    allowed_tags = {"a", "b", "i", "pre", "u", "s", "code"}
+    soup = BeautifulSoup(html, "html.parser")
+
+    for tag in soup.find_all(True):
+        if isinstance(tag, Tag) and tag.name not in allowed_tags:
+            tag.unwrap()
+
+    return str(soup)
+
+
+def _sentence(rnd: random.Random) -> str:
+    words = rnd.choices(WORDS, k=rnd.randint(6, 16))
+    match rnd.randint(0, 9):
+        case 0:
+            words[0] = f"<b>{words[0]}</b>"
+        case 1:
+            words[1] = (
+                f'<a href="https://example.com/{words[1]}?a=1&b=2">{words[1]}</a>'
+            )
+        case 2:
+            words[2] = f"<i>{words[2]}"
+        case 3:
+            words[0] = f"<b><i>{words[0]}</b></i>"
+        case 4:
+            words.append("3 < 5 & 7 > 2")
+        case 5:
+            words[0] = f'<a href="/relative">{words[0]}</a>'
+        case 6:
+            words.append(rnd.choice(EMOJIS))
+    return " ".join(words).capitalize() + "."
+
+
+def generate_post(rnd: random.Random) -> str:
+    paragraphs = []
+    for _ in range(rnd.randint(2, 6)):
+        text = " ".join(_sentence(rnd) for _ in range(rnd.randint(1, 4)))
+        match rnd.randint(0, 3):
+            case 0:
+                paragraphs.append(f"<p>{text}</p>")
+            case 1:
+                items = "".join(f"<li>{_sentence(rnd)}</li>" for _ in range(3))
+                paragraphs.append(f"{text}<ul>{items}</ul>")
+            case _:
+                paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+
+class _Validator(HTMLParser):
+    """
+    Rejects what the Telegram HTML parse mode rejects, roughly
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+        self.stack: list[str] = []
+        self.valid = True
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag == "a" and not (dict(attrs).get("href") or "").startswith("http"):
+            self.valid = False
+        self.stack.append(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        if not self.stack or self.stack.pop() != tag:
+            self.valid = False
+
+
+def is_valid(html: str) -> bool:
+    # < and & are allowed only as the start of a tag or of an entity
+    if re.search(r"<(?![a-z/])|&(?!(lt|gt|amp|quot|#\d+);)", html):
+        return False
+    validator = _Validator()
+    validator.feed(html)
+    validator.close()
+    return validator.valid and not validator.stack
+
+
+def _measure[T](
+    func: Callable[[str], T], posts: list[str]
+) -> tuple[dict[str, float], list[T]]:
+    outputs = []
+    seconds = []
+    for post in posts:
+        started_at = time.perf_counter()
+        outputs.append(func(post))
+        seconds.append(time.perf_counter() - started_at)
+    cuts = statistics.quantiles(seconds, n=100, method="inclusive")
+    return {
+        "mean_us": round(statistics.fmean(seconds) * 1_000_000, 1),
+        "p50_us": round(cuts[49] * 1_000_000, 1),
+        "p99_us": round(cuts[98] * 1_000_000, 1),
+    }, outputs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    posts = [generate_post(rnd) for _ in range(args.posts)]
+    # warm up the imports and the regexes
+    for post in posts[:50]:
+        keep_only_allowed_tags(post)
+        split_html(post)
+
+    beautifulsoup, soup_outputs = _measure(keep_only_allowed_tags, posts)
+    sanitizer, outputs = _measure(sanitize_html, posts)
+    splitter, parts = _measure(
+        lambda post: split_html(post, first_limit=CAPTION_LIMIT), posts
+    )
+    report = {
+        "posts": args.posts,
+        "mean_post_chars": round(statistics.fmean(len(post) for post in posts)),
+        "beautifulsoup": {
+            **beautifulsoup,
+            "invalid": sum(not is_valid(html) for html in soup_outputs),
+        },
+        "sanitize_html": {
+            **sanitizer,
+            "invalid": sum(not is_valid(html) for html in outputs),
+        },
+        "split_html_caption": {
+            **splitter,
+            "invalid": sum(
+                not is_valid(part) for post_parts in parts for part in post_parts
+            ),
+            "split_posts": sum(len(post_parts) > 1 for post_parts in parts),
+        },
+        "speedup": round(beautifulsoup["mean_us"] / sanitizer["mean_us"], 2),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Overhead of the Prometheus metrics
+
+    python -m bench.metrics_overhead [--requests 2000] [--rounds 7] [--series 2000]
+
+Measures offline, without the database or the providers:
+- a Histogram.observe() and a Counter.inc() with labels
+- a request through a bare FastAPI app with and without MetricsMiddleware,
+  over the ASGI transport, so the difference is the middleware alone; the apps
+  are measured in alternating rounds and the medians are compared
+- a scrape (collectors and rendering) of a registry with --series label sets
+
+Reports the costs in microseconds as JSON, the middleware overhead also as the
+share of the bare request, the cheapest route the API has.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import timeit
+from typing import Any
+
+import httpx
+from fastapi import FastAPI
+
+from app.core.metrics import Histogram, Registry, counter, histogram, render_text
+from app.core.prometheus import MetricsMiddleware
+
+
+def _app(with_metrics: bool) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int) -> dict[str, int]:
+        return {"id": item_id}
+
+    if with_metrics:
+        app.add_middleware(MetricsMiddleware)
+    return app
+
+
+async def _request_seconds(app: FastAPI, requests: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for i in range(100):
+            await client.get(f"/items/{i}")
+        started_at = time.perf_counter()
+        for i in range(requests):
+            await client.get(f"/items/{i}")
+        return (time.perf_counter() - started_at) / requests
+
+
+async def _scrape_seconds(series: int) -> float:
+    registry = Registry()
+    metric = registry.register(
+        Histogram("bench_scrape_seconds", "Bench", ("route", "status"))
+    )
+    for i in range(series):
+        metric.observe(i / series, route=f"/route/{i}", status="200")
+    started_at = time.perf_counter()
+    await registry.collect()
+    render_text(registry)
+    return time.perf_counter() - started_at
+
+
+def _us(seconds: float) -> float:
+    return round(seconds * 1_000_000, 2)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--series", type=int, default=2000)
+    args = parser.parse_args()
+
+    observed = histogram("bench_observe_seconds", "Bench", ("function", "result"))
+    counted = counter("bench_inc_total", "Bench", ("function", "result"))
+    loops = 200_000
+    observe = timeit.timeit(
+        lambda: observed.observe(0.3, function="generate_post", result="ok"),
+        number=loops,
+    )
+    inc = timeit.timeit(
+        lambda: counted.inc(function="generate_post", result="ok"), number=loops
+    )
+
+    apps = {False: _app(with_metrics=False), True: _app(with_metrics=True)}
+    rounds: dict[bool, list[float]] = {False: [], True: []}
+    for _ in range(args.rounds):
+        for with_metrics, app in apps.items():
+            rounds[with_metrics].append(await _request_seconds(app, args.requests))
+    bare, measured = statistics.median(rounds[False]), statistics.median(rounds[True])
+    scrape = await _scrape_seconds(args.series)
+
+    report: dict[str, Any] = {
+        "observe_us": _us(observe / loops),
+        "inc_us": _us(inc / loops),
+        "request_us": {"bare": _us(bare), "with_metrics": _us(measured)},
+        "middleware_us": _us(measured - bare),
+        "middleware_share": round((measured - bare) / bare, 4),
+        "scrape_ms": {"series": args.series, "ms": round(scrape * 1000, 2)},
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,402 @@
+"""
+End-to-end throughput and latency of generate_post and update_post
+
+    python -m bench.pipeline [--jobs 200] [--workers 1,4] [--max-jobs 10]
+        [--latency-scale 1] [--config fakes.json] [--output result.json]
+
+Runs the real tasks in arq workers against the Postgres and Redis of the settings
+(migrated, e.g. from docker compose) with the providers replaced by bench.fakes.
+For every worker count the jobs are enqueued up front and drained by that many
+worker processes in burst mode. Reports p50/p95/p99 of every stage, of the queue
+wait and of the whole job, jobs per second and the peak RSS of a worker as JSON.
+The fixtures are created with negative Telegram ids and deleted afterwards.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import resource
+import statistics
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any
+from uuid import UUID, uuid4
+
+import structlog
+from arq import Worker, create_pool
+from arq.connections import ArqRedis
+from arq.jobs import Job
+from sqlalchemy import sql
+
+import app.worker  # registers the tasks
+from app.conf import settings
+from app.core.timeouts import observe_stages
+from app.db import AsyncSessionMaker, create_async_engine, create_session_maker
+from app.tg.agents.models import (
+    BotMetadata,
+    ChannelMetadata,
+    ChannelProfile,
+    PostGenerationMetadata,
+    PostUpdateMetadata,
+    TGAgent,
+    TGAgentJob,
+    TGAgentJobStatus,
+    TGAgentJobType,
+    TGAgentStatus,
+    TGUserBot,
+)
+from app.tg.credits.models import TGUserCreditsTx
+from app.tgbot.auth.models import TGUser
+from app.worker.conf import WorkerSettings
+from bench.fakes import FakeBackendsConfig, fake_backends
+
+# stage samples of a worker process: (stage, seconds, failed)
+StageSample = tuple[str, float, bool]
+
+PROFILE = ChannelProfile(
+    content_description="Новости технологий и стартапов, разборы запусков " * 5,
+    persona_description="Основатель стартапа, пишет коротко и по делу " * 5,
+)
+CHANNEL_PROFILE_GENERATED = "Канал публикует короткие разборы новостей. " * 60
+ORIGINAL_MESSAGE = "<b>Запуск недели</b>\n\nКоманда выпустила обновление. " * 8
+
+
+def _quiet_logs() -> None:
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+    logging.getLogger("arq").setLevel(logging.WARNING)
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {"count": 0}
+    if len(values) == 1:
+        p50 = p95 = p99 = values[0]
+    else:
+        cuts = statistics.quantiles(values, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    return {
+        "count": len(values),
+        "p50_ms": round(p50 * 1000, 1),
+        "p95_ms": round(p95 * 1000, 1),
+        "p99_ms": round(p99 * 1000, 1),
+    }
+
+
+def run_worker(
+    queue_name: str, max_jobs: int, config_json: str, seed: int
+) -> dict[str, Any]:
+    """
+    Worker process, drains the queue and returns its stage samples
+    """
+    _quiet_logs()
+    config = FakeBackendsConfig.model_validate_json(config_json)
+    samples: list[StageSample] = []
+    observe_stages(
+        lambda name, seconds, failed: samples.append((name, seconds, failed))
+    )
+
+    async def main() -> None:
+        worker = Worker(
+            WorkerSettings.functions,
+            queue_name=queue_name,
+            redis_settings=WorkerSettings.redis_settings,
+            burst=True,
+            max_jobs=max_jobs,
+            job_timeout=WorkerSettings.job_timeout,
+            poll_delay=0.05,
+            max_tries=1,
+            handle_signals=False,
+            # the context is a WorkerContext TypedDict
+            on_startup=WorkerSettings.on_startup,  # type: ignore[arg-type]
+            on_shutdown=WorkerSettings.on_shutdown,  # type: ignore[arg-type]
+            log_results=False,
+        )
+        try:
+            await worker.async_run()
+        finally:
+            await worker.close()
+
+    with fake_backends(config, seed):
+        asyncio.run(main())
+    return {
+        "samples": samples,
+        # KiB on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+class Fixtures:
+    def __init__(self) -> None:
+        self.tg_user_ids: list[int] = []
+        self.agent_ids: list[UUID] = []
+        self.bot_ids: list[UUID] = []
+
+
+async def create_fixtures(
+    session_maker: AsyncSessionMaker, agents: int, jobs: int
+) -> Fixtures:
+    fixtures = Fixtures()
+    base_id = -int(time.time() * 1000)
+    async with session_maker() as session, session.begin():
+        for i in range(agents):
+            tg_id = base_id - i
+            user = TGUser(
+                tg_id=tg_id,
+                username=f"bench{i}",
+                first_name="Bench",
+                language_code="ru",
+                # generate_post locks credits twice
+                credits_balance=jobs * 4,
+            )
+            session.add(user)
+            await session.flush()
+            bot = TGUserBot(
+                tg_id=tg_id,
+                api_token=f"{-tg_id}:bench",
+                metadata_=BotMetadata(id=tg_id, username=f"bench{i}_bot"),
+                tg_user_id=tg_id,
+            )
+            agent = TGAgent(
+                channel_id=tg_id,
+                channel_username=f"bench{i}",
+                channel_metadata=ChannelMetadata(
+                    id=tg_id,
+                    username=f"bench{i}",
+                    title=f"Bench {i}",
+                    description="Канал для нагрузочного теста",
+                ),
+                channel_profile=PROFILE,
+                channel_profile_generated=CHANNEL_PROFILE_GENERATED,
+                status=TGAgentStatus.ACTIVE,
+                tg_user_id=tg_id,
+                user_bot=bot,
+            )
+            session.add_all([bot, agent])
+            await session.flush()
+            fixtures.tg_user_ids.append(tg_id)
+            fixtures.agent_ids.append(agent.id)
+            fixtures.bot_ids.append(bot.id)
+    return fixtures
+
+
+async def delete_fixtures(session_maker: AsyncSessionMaker, fixtures: Fixtures) -> None:
+    async with session_maker() as session, session.begin():
+        await session.execute(
+            sql.delete(TGAgentJob).where(TGAgentJob.agent_id.in_(fixtures.agent_ids))
+        )
+        await session.execute(
+            sql.delete(TGUserCreditsTx).where(
+                TGUserCreditsTx.tg_user_id.in_(fixtures.tg_user_ids)
+            )
+        )
+        await session.execute(
+            sql.delete(TGAgent).where(TGAgent.id.in_(fixtures.agent_ids))
+        )
+        await session.execute(
+            sql.delete(TGUserBot).where(TGUserBot.id.in_(fixtures.bot_ids))
+        )
+        await session.execute(
+            sql.delete(TGUser).where(TGUser.tg_id.in_(fixtures.tg_user_ids))
+        )
+
+
+async def enqueue_jobs(
+    session_maker: AsyncSessionMaker,
+    redis: ArqRedis,
+    fixtures: Fixtures,
+    args: argparse.Namespace,
+) -> list[Job]:
+    rng = random.Random(args.seed)
+    rows = []
+    for i in range(args.jobs):
+        tg_user_id = fixtures.tg_user_ids[i % len(fixtures.tg_user_ids)]
+        agent_id = fixtures.agent_ids[i % len(fixtures.agent_ids)]
+        if rng.random() < args.update_ratio:
+            type_ = TGAgentJobType.POST_UPDATE
+            metadata = PostUpdateMetadata(
+                original_message=ORIGINAL_MESSAGE,
+                user_prompt="Сделай пост короче",
+                notify_message_id=1,
+                chat_id=tg_user_id,
+            ).model_dump()
+        else:
+            type_ = TGAgentJobType.POST_GENERATION
+            metadata = PostGenerationMetadata(
+                user_prompt="Напиши пост о главной новости недели",
+                chat_id=tg_user_id,
+            ).model_dump()
+        rows.append(
+            TGAgentJob(
+                type_=type_,
+                status=TGAgentJobStatus.INITIAL,
+                metadata_=metadata,
+                tg_user_id=tg_user_id,
+                agent_id=agent_id,
+            )
+        )
+    async with session_maker() as session, session.begin():
+        session.add_all(rows)
+
+    jobs = []
+    for row in rows:
+        chat_id = row.tg_user_id
+        if row.type_ == TGAgentJobType.POST_UPDATE:
+            job = await redis.enqueue_job("update_post", row.id, chat_id)
+        else:
+            job = await redis.enqueue_job(
+                "generate_post",
+                row.id,
+                chat_id,
+                with_photo=rng.random() < args.photo_ratio,
+            )
+        if job is None:
+            raise RuntimeError(f"Job {row.id} is already enqueued")
+        jobs.append(job)
+    return jobs
+
+
+async def run(
+    session_maker: AsyncSessionMaker, workers: int, args: argparse.Namespace
+) -> dict[str, Any]:
+    queue_name = f"viralink:bench:{uuid4()}"
+    redis = await create_pool(
+        WorkerSettings.redis_settings, default_queue_name=queue_name
+    )
+    fixtures = await create_fixtures(session_maker, args.agents, args.jobs)
+    try:
+        jobs = await enqueue_jobs(session_maker, redis, fixtures, args)
+
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(
+            workers, mp_context=get_context("spawn"), max_tasks_per_child=1
+        ) as pool:
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        pool,
+                        run_worker,
+                        queue_name,
+                        args.max_jobs,
+                        args.config.model_dump_json(),
+                        args.seed + i,
+                    )
+                    for i in range(workers)
+                )
+            )
+
+        job_results = [await job.result_info() for job in jobs]
+        finished = [r for r in job_results if r is not None]
+        async with session_maker() as session:
+            statuses = (
+                await session.execute(
+                    sql.select(TGAgentJob.status, sql.func.count())
+                    .where(TGAgentJob.agent_id.in_(fixtures.agent_ids))
+                    .group_by(TGAgentJob.status)
+                )
+            ).all()
+    finally:
+        await delete_fixtures(session_maker, fixtures)
+        await redis.delete(queue_name)
+        await redis.aclose()
+
+    stages: dict[str, list[float]] = defaultdict(list)
+    stage_failures: dict[str, int] = defaultdict(int)
+    for result in results:
+        for name, seconds, failed in result["samples"]:
+            stages[name].append(seconds)
+            stage_failures[name] += failed
+
+    if not finished:
+        raise RuntimeError("No job finished, see the worker logs")
+    wall_seconds = (
+        max(r.finish_time for r in finished) - min(r.start_time for r in finished)
+    ).total_seconds()
+    succeeded = sum(1 for r in finished if r.success)
+    return {
+        "workers": workers,
+        "max_jobs": args.max_jobs,
+        "jobs": args.jobs,
+        "succeeded": succeeded,
+        "job_statuses": {status.value: count for status, count in statuses},
+        "wall_seconds": round(wall_seconds, 2),
+        "jobs_per_sec": round(succeeded / wall_seconds, 3) if wall_seconds else None,
+        "peak_rss_mb": round(max(r["peak_rss_mb"] for r in results), 1),
+        "job": percentiles(
+            [(r.finish_time - r.start_time).total_seconds() for r in finished]
+        ),
+        "queue_wait": percentiles(
+            [(r.start_time - r.enqueue_time).total_seconds() for r in finished]
+        ),
+        "stages": {
+            name: {**percentiles(values), "failed": stage_failures[name]}
+            for name, values in sorted(stages.items())
+        },
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument(
+        "--workers",
+        type=lambda value: [int(n) for n in value.split(",")],
+        default=[1, 4],
+        help="comma separated worker process counts, a run for each",
+    )
+    parser.add_argument(
+        "--max-jobs", type=int, default=10, help="concurrent jobs of a worker"
+    )
+    parser.add_argument("--agents", type=int, default=20)
+    parser.add_argument("--update-ratio", type=float, default=0.3)
+    parser.add_argument("--photo-ratio", type=float, default=0.2)
+    parser.add_argument(
+        "--config", type=Path, help="JSON of bench.fakes.FakeBackendsConfig"
+    )
+    parser.add_argument("--latency-scale", type=float)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    config = (
+        FakeBackendsConfig.model_validate_json(args.config.read_text())
+        if args.config
+        else FakeBackendsConfig()
+    )
+    if args.latency_scale is not None:
+        config.latency_scale = args.latency_scale
+    args.config = config
+
+    _quiet_logs()
+    engine = create_async_engine(settings.DATABASE_URL, "bench")
+    session_maker = create_session_maker(engine)
+    try:
+        runs = [await run(session_maker, workers, args) for workers in args.workers]
+    finally:
+        await engine.dispose()
+
+    report = json.dumps(
+        {
+            "config": config.model_dump(),
+            "mix": {
+                "update_ratio": args.update_ratio,
+                "photo_ratio": args.photo_ratio,
+                "agents": args.agents,
+            },
+            "runs": runs,
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,138 @@
+"""
+Per-job setup of the LLM calls of a post generation and a post update
+
+    python -m bench.prompt_setup [--jobs 1000]
+
+Compares building the templates, the clients, the tool bindings and the
+structured output on every job (as before the caches) with the cached ones.
+Nothing is sent to the LLM, only OPENAI_API_KEY needs to be set.
+"""
+
+import argparse
+import json
+import statistics
+import time
+from collections.abc import Callable
+from typing import Annotated, Any, TypedDict
+
+from langchain_core.prompts import ChatPromptTemplate
+
+from app.core.llm import get_llm, get_llm_with_tools
+from app.tg.agents.post_generator.post_generator import PROMPTS, TEMPLATES
+from app.tg.agents.post_generator.tools.content_provider import ContentProvider
+from app.tg.agents.post_generator.tools.image_generator import ImageGenerator
+from app.tg.agents.post_generator.tools.publisher import Publisher
+from app.tg.agents.post_generator.tools.scraper import Scraper
+from app.tg.agents.post_generator.tools.search_query_builder import (
+    PROMPTS as SEARCH_PROMPTS,
+)
+from app.tg.agents.post_generator.tools.search_query_builder import _get_runnables
+
+SUMMARY: dict[str, Any] = {
+    "channel_id": 1,
+    "channel_username": "channel",
+    "channel_title": "Channel",
+    "channel_description": "About the channel " * 20,
+    "channel_profile_generated": "Profile of the channel " * 100,
+    "content_description": "Content of the channel " * 20,
+    "persona_description": "Persona of the author " * 20,
+}
+USER_PROMPT = "Write a post about the news of the week"
+
+
+def _tools() -> tuple[
+    list[ContentProvider | Scraper], list[Publisher | ImageGenerator]
+]:
+    return [ContentProvider(**SUMMARY), Scraper()], [
+        Publisher(chat_id=1),
+        ImageGenerator(
+            model="o4-mini",
+            image_model="recraft-ai/recraft-v3",
+            prompts=PROMPTS.ru.image_generator_query_builder,
+        ),
+    ]
+
+
+def setup_uncached() -> None:
+    prompts = PROMPTS.ru
+    new_llm = get_llm.__wrapped__  # type: ignore[attr-defined]
+    generate_tools, update_tools = _tools()
+
+    new_llm("o4-mini").bind_tools(generate_tools)
+    ChatPromptTemplate(
+        [
+            ("system", prompts.main.system_prompt),
+            ("system", prompts.define_action.system_prompt),
+            ("user", USER_PROMPT),
+        ]
+    ).format_messages(**SUMMARY)
+
+    search_prompts = SEARCH_PROMPTS.ru
+
+    class SearchQueries(TypedDict):
+        queries: Annotated[list[str], "List of search queries"]
+
+    SearchQueries.__doc__ = search_prompts.structured_output
+    ChatPromptTemplate(
+        [("system", search_prompts.system_prompt), ("user", USER_PROMPT)]
+    ).format_messages(current_date="2025-01-01", user_prompt=USER_PROMPT, **SUMMARY)
+    new_llm().with_structured_output(SearchQueries)
+
+    new_llm("o4-mini").bind_tools(update_tools)
+    ChatPromptTemplate(
+        [
+            ("system", prompts.main.system_prompt),
+            ("system", prompts.update_post.system_prompt),
+            ("user", prompts.update_post.user_prompt),
+            ("user", USER_PROMPT),
+        ]
+    ).format_messages(original_message="Post", **SUMMARY)
+
+
+def setup_cached() -> None:
+    templates = TEMPLATES["ru"]
+    generate_tools, update_tools = _tools()
+
+    get_llm_with_tools("o4-mini", generate_tools)
+    templates.generate_post.format_messages(user_prompt=USER_PROMPT, **SUMMARY)
+
+    prompt_template, _ = _get_runnables("ru")
+    prompt_template.format_messages(
+        current_date="2025-01-01", user_prompt=USER_PROMPT, **SUMMARY
+    )
+
+    get_llm_with_tools("o4-mini", update_tools)
+    templates.update_post.format_messages(
+        original_message="Post", user_prompt=USER_PROMPT, **SUMMARY
+    )
+
+
+def measure(setup: Callable[[], None], jobs: int) -> dict[str, float]:
+    setup()
+    latencies = []
+    for _ in range(jobs):
+        started_at = time.perf_counter()
+        setup()
+        latencies.append(time.perf_counter() - started_at)
+    latencies.sort()
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "jobs_per_sec": jobs / sum(latencies),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=int, default=1000)
+    args = parser.parse_args()
+
+    results = {
+        "uncached": measure(setup_uncached, args.jobs),
+        "cached": measure(setup_cached, args.jobs),
+    }
+    print(json.dumps({"jobs": args.jobs, **results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Replays recorded post generations and updates offline
+
+    python -m bench.replay recordings/*.json.gz [--latency-scale 0] [--output result.json]
+
+Recordings are written by the worker with POST_GENERATOR_RECORD_DIR set. The
+pipeline runs as in the worker (prompt assembly, token budgets, tool dispatch)
+with the LLM responses and the tool outputs of the recording, returned after their
+recorded latencies multiplied by --latency-scale, 0 for none. Nothing is sent to
+the providers, the database or Telegram, only OPENAI_API_KEY needs to be set.
+
+Reports as JSON the recorded and the replayed seconds of every job and their
+percentiles, the stages, the prompt tokens, the LLM calls whose prompt differs
+from the recorded one and the jobs whose result changed.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import time
+from collections import defaultdict, deque
+from collections.abc import AsyncGenerator
+from pathlib import Path
+from typing import Any, cast
+from unittest import mock
+
+from langchain_community.tools import BaseTool
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.messages import (
+    BaseMessage,
+    ToolCall,
+    message_to_dict,
+    messages_from_dict,
+)
+from langchain_core.runnables import Runnable
+
+from app.core.timeouts import observe_stages
+from app.tg.agents.models import (
+    ChannelMetadata,
+    ChannelProfile,
+    LLMCallUsage,
+    TGAgent,
+    TGAgentJob,
+    TGAgentJobType,
+)
+from app.tg.agents.post_generator import post_generator
+from app.tg.agents.post_generator.post_generator import PostGenerator
+from app.tg.agents.post_generator.recorder import (
+    JobRecording,
+    PostGeneratorCalls,
+    load_recording,
+)
+from bench.pipeline import _quiet_logs, percentiles
+
+
+class ReplayError(Exception):
+    pass
+
+
+class ReplayCalls(PostGeneratorCalls):
+    """
+    Answers the calls with the recorded responses in the recorded order
+    """
+
+    def __init__(self, recording: JobRecording, latency_scale: float) -> None:
+        self.llm_calls = deque(recording.llm_calls)
+        self.tool_calls = deque(recording.tool_calls)
+        self.latency_scale = latency_scale
+        self.diverged = 0
+
+    async def llm(
+        self,
+        llm: Runnable[LanguageModelInput, BaseMessage],
+        messages: list[BaseMessage],
+        usage: LLMCallUsage,
+    ) -> BaseMessage:
+        if not self.llm_calls:
+            raise ReplayError(f"LLM call {usage.name} wasn't recorded")
+        call = self.llm_calls.popleft()
+        if _prompt([message_to_dict(m) for m in messages]) != _prompt(call.messages):
+            self.diverged += 1
+        await asyncio.sleep(call.seconds * self.latency_scale)
+        return messages_from_dict([call.response])[0]
+
+    async def tool(self, tool: BaseTool, tool_call: ToolCall) -> BaseMessage:
+        if not self.tool_calls or self.tool_calls[0].name != tool.name:
+            raise ReplayError(f"Tool call {tool.name} wasn't recorded")
+        call = self.tool_calls.popleft()
+        await asyncio.sleep(call.seconds * self.latency_scale)
+        return messages_from_dict([call.output])[0]
+
+
+def _prompt(messages: list[dict[str, Any]]) -> list[tuple[str, Any]]:
+    return [(m["type"], m["data"]["content"]) for m in messages]
+
+
+def _agent(recording: JobRecording) -> TGAgent:
+    summary = recording.agent
+    return TGAgent(
+        channel_id=summary["channel_id"],
+        channel_username=summary["channel_username"],
+        channel_metadata=ChannelMetadata(
+            id=summary["channel_id"],
+            username=summary["channel_username"],
+            title=summary["channel_title"],
+            description=summary["channel_description"],
+        ),
+        channel_profile=ChannelProfile(
+            content_description=summary["content_description"],
+            persona_description=summary["persona_description"],
+        ),
+        channel_profile_generated=summary["channel_profile_generated"],
+        tg_user_id=recording.tg_user_id,
+    )
+
+
+@contextlib.asynccontextmanager
+async def _no_credits(*args: Any, **kwargs: Any) -> AsyncGenerator[None, None]:
+    yield
+
+
+async def replay(recording: JobRecording, latency_scale: float) -> dict[str, Any]:
+    calls = ReplayCalls(recording, latency_scale)
+    generator = PostGenerator(
+        cast(Any, None),
+        cast(Any, None),
+        lang=cast(Any, recording.lang),
+        model=cast(Any, recording.model),
+        image_model=cast(Any, recording.image_model),
+        calls=calls,
+    )
+    job = TGAgentJob(
+        id=recording.job_id,
+        type_=recording.job_type,
+        metadata_=recording.job_metadata,
+    )
+    agent = _agent(recording)
+
+    result: str | dict[str, str | None] | None = None
+    error = None
+    started_at = time.perf_counter()
+    try:
+        if recording.job_type == TGAgentJobType.POST_GENERATION:
+            result = await generator._generate_post(job, agent)
+        else:
+            result = await generator._update_post(job, agent)
+    except Exception as e:
+        error = repr(e)
+    seconds = time.perf_counter() - started_at
+
+    return {
+        "job_id": str(recording.job_id),
+        "job_type": recording.job_type.value,
+        "recorded_seconds": recording.seconds,
+        "replayed_seconds": round(seconds, 3),
+        "recorded_prompt_tokens": sum(
+            call.usage.prompt_tokens for call in recording.llm_calls
+        ),
+        "replayed_prompt_tokens": sum(
+            call.prompt_tokens for call in generator.llm_usage.calls
+        ),
+        "diverged_llm_calls": calls.diverged,
+        "unused_calls": len(calls.llm_calls) + len(calls.tool_calls),
+        "same_result": error is None and result == recording.result,
+        "error": error,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("recordings", type=Path, nargs="+")
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1,
+        help="multiplies the recorded latencies, 0 replays without them",
+    )
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    _quiet_logs()
+    stages: dict[str, list[float]] = defaultdict(list)
+    jobs = []
+    with mock.patch.object(post_generator, "spend_credits", _no_credits):
+        # the tokenizer, the clients and the templates are set up on the first job
+        await replay(load_recording(args.recordings[0]), 0)
+        observe_stages(lambda name, seconds, failed: stages[name].append(seconds))
+        for path in args.recordings:
+            jobs.append(await replay(load_recording(path), args.latency_scale))
+
+    report = json.dumps(
+        {
+            "latency_scale": args.latency_scale,
+            "seconds": {
+                "recorded": percentiles(
+                    [job["recorded_seconds"] for job in jobs if job["recorded_seconds"]]
+                ),
+                "replayed": percentiles([job["replayed_seconds"] for job in jobs]),
+            },
+            "stages": {name: percentiles(values) for name, values in stages.items()},
+            "prompt_tokens": {
+                "recorded": sum(job["recorded_prompt_tokens"] for job in jobs),
+                "replayed": sum(job["replayed_prompt_tokens"] for job in jobs),
+            },
+            "diverged_llm_calls": sum(job["diverged_llm_calls"] for job in jobs),
+            "changed_results": sum(not job["same_result"] for job in jobs),
+            "jobs": jobs,
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,115 @@
+"""
+Signing of channel photo URLs in an agent list response of a user with 50 agents
+
+    python -m bench.signed_urls [--agents 50] [--requests 200]
+
+Compares signing every URL on the event loop (as before the cache) with
+cold and warm cache batches. Signing needs no network, so no storage is required.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from datetime import UTC, datetime
+from uuid import uuid4
+
+from app.conf import settings
+from app.core import signed_urls
+from app.core.utils import get_s3_client
+from app.tg.agents.models import ChannelMetadata, ChannelPhoto, TGAgentStatus
+from app.tg.agents.schemas import TGAgent, sign_agents
+
+
+def make_agents(count: int) -> list[TGAgent]:
+    return [
+        TGAgent(
+            id=uuid4(),
+            created_at=datetime.now(UTC),
+            status=TGAgentStatus.ACTIVE,
+            channel_id=i,
+            channel_username=f"channel{i}",
+            channel_metadata=ChannelMetadata(
+                id=i,
+                username=f"channel{i}",
+                photo=ChannelPhoto(
+                    small_file_path=f"1/bot/small{i}",
+                    big_file_path=f"1/bot/big{i}",
+                ),
+            ),
+            channel_profile_generated="",
+        )
+        for i in range(count)
+    ]
+
+
+def sign_on_loop(agents: list[TGAgent]) -> list[TGAgent]:
+    s3_client = get_s3_client()
+    urls = {
+        path: s3_client.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": settings.STORAGE_BUCKET, "Key": path},
+            ExpiresIn=signed_urls.EXPIRES_IN,
+        )
+        for agent in agents
+        for path in agent.file_paths()
+    }
+    return [agent.with_signed_urls(urls) for agent in agents]
+
+
+async def measure(name: str, agents: list[TGAgent], requests: int) -> dict[str, float]:
+    """
+    Latency of a response and the longest time the event loop was blocked
+    """
+    max_lag = 0.0
+    stopped = False
+
+    async def ticker() -> None:
+        nonlocal max_lag
+        while not stopped:
+            started_at = time.perf_counter()
+            await asyncio.sleep(0)
+            max_lag = max(max_lag, time.perf_counter() - started_at)
+
+    ticker_task = asyncio.create_task(ticker())
+    latencies = []
+    for _ in range(requests):
+        if name == "cold_cache":
+            signed_urls._cache.clear()
+        started_at = time.perf_counter()
+        if name == "on_loop":
+            sign_on_loop(agents)
+        else:
+            await sign_agents(agents)
+        latencies.append(time.perf_counter() - started_at)
+        await asyncio.sleep(0)
+    stopped = True
+    await ticker_task
+
+    latencies.sort()
+    return {
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "max_loop_block_ms": max_lag * 1000,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--agents", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    agents = make_agents(args.agents)
+    # client creation isn't a part of a request
+    get_s3_client()
+    results = {
+        name: await measure(name, agents, args.requests)
+        for name in ("on_loop", "cold_cache", "warm_cache")
+    }
+    print(json.dumps({"agents": args.agents, **results}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,658 @@
+"""
+In-process Telegram Bot API emulator for load tests
+
+    python -m bench.telegram_emulator [--port 8081] [--agents 20]
+        [--rate 5] [--duration 60] [--flood-rate 0] [--output result.json]
+
+Speaks the Bot API HTTP interface (/bot<token>/<method> and /file/bot<token>/<path>)
+for any token, backed by in-memory chats. Sends are rate limited like Telegram does:
+per bot, per private chat and per group or channel, a request over a limit gets
+429 with retry_after. --flood-rate adds random 429s on top.
+
+Run the server and the workers with TGBOT_API_URL=http://localhost:<port>, a
+TGBOT_WEBHOOK_URL pointing to the server and TGBOT_WEBHOOK_SECRET_TOKEN, and the
+workers as bench.worker so the LLMs are faked. Once the server has set its webhook,
+text messages from the users of the fixtures (active agents, see bench.pipeline)
+are posted to it at --rate per second, Poisson distributed. Reports the webhook
+latency, the time to the first bot reply in the chat, the API calls by method
+and status, and the 429s as JSON.
+"""
+
+import argparse
+import asyncio
+import email.parser
+import email.policy
+import hashlib
+import json
+import math
+import random
+import time
+from collections import Counter, deque
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+from urllib.parse import parse_qsl
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from app.conf import settings
+from app.db import create_async_engine, create_session_maker
+from bench.fakes import Distribution
+from bench.pipeline import (
+    _quiet_logs,
+    create_fixtures,
+    delete_fixtures,
+    percentiles,
+)
+
+# messages kept per chat
+CHAT_HISTORY = 100
+# bytes of the emulated channel photos
+CHAT_PHOTO_SIZE = 32 * 1024
+RATE_LIMITED_METHODS = frozenset(
+    ("sendmessage", "sendphoto", "sendinvoice", "editmessagetext")
+    + ("editmessagereplymarkup", "editmessagecaption", "copymessage")
+)
+USER_TEXTS = (
+    "Напиши пост о главной новости недели",
+    "Сделай подборку инструментов для команды",
+    "Расскажи о запуске нового продукта",
+)
+
+
+class EmulatorConfig(BaseModel):
+    # seconds of every API call
+    latency: Distribution = Distribution(median=0.05, sigma=0.3)
+    # sends per second of a bot to all chats
+    bot_rate: float = 30
+    # sends per second to a private chat
+    private_chat_rate: float = 1
+    # sends per minute to a group or a channel
+    group_chat_per_minute: float = 20
+    # sends over the rate a chat accepts at once
+    burst: int = 3
+    # share of sends answered with 429 regardless of the limits
+    flood_rate: float = 0
+    # seconds
+    flood_retry_after: int = 5
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, retry_after: int | None = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Returns 0 when a token is taken, otherwise seconds until there is one
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Chat:
+    def __init__(self, chat_id: int, type_: str) -> None:
+        self.id = chat_id
+        self.type = type_
+        self.messages: deque[dict[str, Any]] = deque(maxlen=CHAT_HISTORY)
+        self.last_message_id = 0
+        # when the updates the bot hasn't replied to yet were sent
+        self.waiting_since: deque[float] = deque()
+
+    def json(self) -> dict[str, Any]:
+        if self.type == "private":
+            return {"id": self.id, "type": "private", "first_name": f"User {self.id}"}
+        return {
+            "id": self.id,
+            "type": self.type,
+            "title": f"Chat {self.id}",
+            "username": f"chat{abs(self.id)}",
+        }
+
+
+class StoredFile:
+    def __init__(self, bot_id: int, unique_id: str, data: bytes) -> None:
+        self.bot_id = bot_id
+        self.unique_id = unique_id
+        self.data = data
+
+
+class TelegramEmulator:
+    def __init__(self, config: EmulatorConfig, seed: int = 0) -> None:
+        self.config = config
+        self.rng = random.Random(seed)
+        self.chats: dict[int, Chat] = {}
+        self.files: dict[str, StoredFile] = {}
+        # token -> (url, secret token)
+        self.webhooks: dict[str, tuple[str, str | None]] = {}
+        self.calls: Counter[tuple[str, int]] = Counter()
+        self.reply_latencies: list[float] = []
+        self._bot_buckets: dict[int, TokenBucket] = {}
+        self._chat_buckets: dict[tuple[int, int], TokenBucket] = {}
+        self._methods: dict[str, Callable[[dict[str, Any], int], Any]] = {
+            "getme": self._get_me,
+            "sendmessage": self._send_message,
+            "sendphoto": self._send_photo,
+            "sendinvoice": self._send_invoice,
+            "editmessagetext": self._edit_message,
+            "editmessagereplymarkup": self._edit_message,
+            "editmessagecaption": self._edit_message,
+            "getfile": self._get_file,
+            "getchat": self._get_chat,
+            "getchatmember": self._get_chat_member,
+            "getchatmembercount": lambda params, bot_id: 1000,
+            "getwebhookinfo": self._get_webhook_info,
+        }
+
+        self.app = FastAPI()
+        self.app.add_api_route(
+            "/bot{token}/{method}", self._handle_call, methods=["GET", "POST"]
+        )
+        self.app.add_api_route(
+            "/file/bot{token}/{path:path}", self._handle_download, methods=["GET"]
+        )
+
+    def chat(self, chat_id: int, type_: str | None = None) -> Chat:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = Chat(
+                chat_id, type_ or ("private" if chat_id > 0 else "channel")
+            )
+        return chat
+
+    async def _handle_call(self, token: str, method: str, request: Request) -> Response:
+        method = method.lower()
+        bot_id = _bot_id(token)
+        params = await _read_params(request)
+        await asyncio.sleep(self.config.latency.sample(self.rng))
+        try:
+            if method == "setwebhook":
+                self.webhooks[token] = (params["url"], params.get("secret_token"))
+                result: Any = True
+            elif method == "deletewebhook":
+                self.webhooks.pop(token, None)
+                result = True
+            else:
+                if method in RATE_LIMITED_METHODS:
+                    self._check_rate_limits(bot_id, int(params["chat_id"]))
+                handler = self._methods.get(method)
+                # answerCallbackQuery, setMyCommands, deleteMessage, ...
+                result = handler(params, bot_id) if handler else True
+        except ApiError as e:
+            self.calls[method, e.code] += 1
+            body: dict[str, Any] = {
+                "ok": False,
+                "error_code": e.code,
+                "description": e.description,
+            }
+            if e.retry_after is not None:
+                body["parameters"] = {"retry_after": e.retry_after}
+            return JSONResponse(body, status_code=e.code)
+        self.calls[method, 200] += 1
+        return JSONResponse({"ok": True, "result": result})
+
+    async def _handle_download(self, token: str, path: str) -> Response:
+        file_id = Path(path).stem
+        stored = self.files.get(file_id)
+        if stored is None or stored.bot_id != _bot_id(token):
+            return JSONResponse(
+                {"ok": False, "error_code": 404, "description": "Not Found"},
+                status_code=404,
+            )
+        return Response(stored.data, media_type="image/jpeg")
+
+    def _check_rate_limits(self, bot_id: int, chat_id: int) -> None:
+        chat = self.chat(chat_id)
+        if self.rng.random() < self.config.flood_rate:
+            self._flood(self.config.flood_retry_after)
+
+        bot_bucket = self._bot_buckets.get(bot_id)
+        if bot_bucket is None:
+            bot_bucket = self._bot_buckets[bot_id] = TokenBucket(
+                self.config.bot_rate, self.config.bot_rate
+            )
+        chat_bucket = self._chat_buckets.get((bot_id, chat_id))
+        if chat_bucket is None:
+            rate = (
+                self.config.private_chat_rate
+                if chat.type == "private"
+                else self.config.group_chat_per_minute / 60
+            )
+            chat_bucket = self._chat_buckets[bot_id, chat_id] = TokenBucket(
+                rate, self.config.burst
+            )
+        for bucket in (chat_bucket, bot_bucket):
+            if wait := bucket.take():
+                self._flood(math.ceil(wait))
+
+    def _flood(self, retry_after: int) -> None:
+        raise ApiError(
+            429, f"Too Many Requests: retry after {retry_after}", retry_after
+        )
+
+    def _bot_user(self, bot_id: int) -> dict[str, Any]:
+        return {
+            "id": bot_id,
+            "is_bot": True,
+            "first_name": f"Bot {bot_id}",
+            "username": f"bot{bot_id}_bot",
+        }
+
+    def _message(
+        self, chat: Chat, bot_id: int, content: dict[str, Any]
+    ) -> dict[str, Any]:
+        chat.last_message_id += 1
+        message = {
+            "message_id": chat.last_message_id,
+            "date": int(time.time()),
+            "chat": chat.json(),
+            **content,
+        }
+        if chat.type != "channel":
+            message["from"] = self._bot_user(bot_id)
+        chat.messages.append(message)
+        if chat.waiting_since:
+            self.reply_latencies.append(time.monotonic() - chat.waiting_since.popleft())
+        return message
+
+    def _store_file(self, bot_id: int, data: bytes, unique_id: str = "") -> str:
+        unique_id = unique_id or hashlib.sha1(data).hexdigest()[:16]
+        file_id = f"{bot_id}_{unique_id}_{self.rng.getrandbits(32):x}"
+        self.files[file_id] = StoredFile(bot_id, unique_id, data)
+        return file_id
+
+    def _photo_sizes(self, file_id: str) -> list[dict[str, Any]]:
+        stored = self.files[file_id]
+        return [
+            {
+                "file_id": file_id,
+                "file_unique_id": stored.unique_id,
+                "width": 1280,
+                "height": 720,
+                "file_size": len(stored.data),
+            }
+        ]
+
+    def _get_me(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        return {**self._bot_user(bot_id), "can_join_groups": True}
+
+    def _send_message(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        text = params.get("text") or ""
+        if not text:
+            raise ApiError(400, "Bad Request: message text is empty")
+        if len(text) > 4096:
+            raise ApiError(400, "Bad Request: message is too long")
+        return self._message(
+            self.chat(int(params["chat_id"])),
+            bot_id,
+            {"text": text, **_reply_markup(params)},
+        )
+
+    def _send_photo(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        photo = params.get("photo")
+        if isinstance(photo, bytes):
+            file_id = self._store_file(bot_id, photo)
+        elif isinstance(photo, str) and photo.startswith(("http://", "https://")):
+            file_id = self._store_file(bot_id, photo.encode())
+        elif isinstance(photo, str) and photo in self.files:
+            stored = self.files[photo]
+            # file_ids are valid only for the bot that received the file
+            if stored.bot_id != bot_id:
+                raise ApiError(
+                    400, "Bad Request: wrong file identifier/HTTP URL specified"
+                )
+            file_id = photo
+        else:
+            raise ApiError(400, "Bad Request: wrong file identifier/HTTP URL specified")
+        if len(params.get("caption") or "") > 1024:
+            raise ApiError(400, "Bad Request: message caption is too long")
+        return self._message(
+            self.chat(int(params["chat_id"])),
+            bot_id,
+            {
+                "photo": self._photo_sizes(file_id),
+                "caption": params.get("caption") or "",
+                **_reply_markup(params),
+            },
+        )
+
+    def _send_invoice(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        prices = params.get("prices") or []
+        return self._message(
+            self.chat(int(params["chat_id"])),
+            bot_id,
+            {
+                "invoice": {
+                    "title": params.get("title", ""),
+                    "description": params.get("description", ""),
+                    "start_parameter": params.get("start_parameter", ""),
+                    "currency": params.get("currency", "XTR"),
+                    "total_amount": sum(int(p["amount"]) for p in prices),
+                }
+            },
+        )
+
+    def _edit_message(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        chat = self.chat(int(params["chat_id"]))
+        message_id = int(params["message_id"])
+        for message in chat.messages:
+            if message["message_id"] == message_id:
+                break
+        else:
+            message = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": chat.json(),
+            }
+        if "text" in params:
+            message["text"] = params["text"]
+        if "caption" in params:
+            message["caption"] = params["caption"]
+        message.pop("reply_markup", None)
+        message.update(_reply_markup(params))
+        return {**message, "edit_date": int(time.time())}
+
+    def _get_file(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        file_id = params["file_id"]
+        stored = self.files.get(file_id)
+        if stored is None or stored.bot_id != bot_id:
+            raise ApiError(400, "Bad Request: invalid file_id")
+        return {
+            "file_id": file_id,
+            "file_unique_id": stored.unique_id,
+            "file_size": len(stored.data),
+            "file_path": f"photos/{file_id}.jpg",
+        }
+
+    def _get_chat(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        chat = self.chat(_chat_id(params["chat_id"]))
+        photo: dict[str, Any] = {}
+        if chat.type != "private":
+            # the same photo for every bot, file_ids differ
+            data = random.Random(chat.id).randbytes(CHAT_PHOTO_SIZE)
+            unique_id = f"chat{abs(chat.id)}"
+            photo = {
+                "photo": {
+                    "small_file_id": self._store_file(bot_id, data[:4096], unique_id),
+                    "small_file_unique_id": unique_id,
+                    "big_file_id": self._store_file(bot_id, data, unique_id + "b"),
+                    "big_file_unique_id": unique_id + "b",
+                }
+            }
+        return {
+            **chat.json(),
+            "description": f"Description of {chat.id}",
+            "accent_color_id": 0,
+            "max_reaction_count": 11,
+            **photo,
+        }
+
+    def _get_chat_member(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        user_id = int(params["user_id"])
+        if user_id != bot_id:
+            return {
+                "status": "member",
+                "user": {"id": user_id, "is_bot": False, "first_name": "User"},
+            }
+        # the bot is an administrator of every channel
+        return {
+            "status": "administrator",
+            "user": self._bot_user(bot_id),
+            "can_be_edited": False,
+            "is_anonymous": False,
+            "can_manage_chat": True,
+            "can_delete_messages": True,
+            "can_manage_video_chats": True,
+            "can_restrict_members": True,
+            "can_promote_members": False,
+            "can_change_info": True,
+            "can_invite_users": True,
+            "can_post_stories": True,
+            "can_edit_stories": True,
+            "can_delete_stories": True,
+            "can_post_messages": True,
+            "can_edit_messages": True,
+        }
+
+    def _get_webhook_info(self, params: dict[str, Any], bot_id: int) -> dict[str, Any]:
+        url = next(
+            (
+                url
+                for token, (url, _) in self.webhooks.items()
+                if _bot_id(token) == bot_id
+            ),
+            "",
+        )
+        return {"url": url, "has_custom_certificate": False, "pending_update_count": 0}
+
+
+class UpdateGenerator:
+    """
+    Posts text messages of the users to the webhook the bot has set
+    """
+
+    def __init__(
+        self,
+        emulator: TelegramEmulator,
+        token: str,
+        users: list[int],
+        rate: float,
+        seed: int = 0,
+    ) -> None:
+        self.emulator = emulator
+        self.token = token
+        self.users = users
+        self.rate = rate
+        self.rng = random.Random(seed)
+        self.latencies: list[float] = []
+        self.statuses: Counter[int] = Counter()
+        self._update_id = 0
+
+    async def wait_for_webhook(self, timeout: float) -> tuple[str, str | None]:
+        async with asyncio.timeout(timeout):
+            while self.token not in self.emulator.webhooks:
+                await asyncio.sleep(0.5)
+        return self.emulator.webhooks[self.token]
+
+    async def run(self, duration: float) -> None:
+        url, secret_token = self.emulator.webhooks[self.token]
+        headers = {"x-telegram-bot-api-secret-token": secret_token or ""}
+        for user_id in self.users:
+            self.emulator.chat(user_id, "private")
+
+        async with httpx.AsyncClient(timeout=30, headers=headers) as client:
+            posts: set[asyncio.Task[None]] = set()
+            finish_at = time.monotonic() + duration
+            while time.monotonic() < finish_at:
+                task = asyncio.create_task(self._post(client, url))
+                posts.add(task)
+                task.add_done_callback(posts.discard)
+                await asyncio.sleep(self.rng.expovariate(self.rate))
+            await asyncio.gather(*posts)
+
+    async def _post(self, client: httpx.AsyncClient, url: str) -> None:
+        self._update_id += 1
+        user_id = self.rng.choice(self.users)
+        chat = self.emulator.chat(user_id, "private")
+        chat.last_message_id += 1
+        update = {
+            "update_id": self._update_id,
+            "message": {
+                "message_id": chat.last_message_id,
+                "date": int(time.time()),
+                "chat": chat.json(),
+                "from": {
+                    "id": user_id,
+                    "is_bot": False,
+                    "first_name": f"User {user_id}",
+                    "language_code": "ru",
+                },
+                "text": self.rng.choice(USER_TEXTS),
+            },
+        }
+        started_at = time.monotonic()
+        chat.waiting_since.append(started_at)
+        try:
+            response = await client.post(url, json=update)
+        except httpx.HTTPError:
+            self.statuses[0] += 1
+            return
+        self.latencies.append(time.monotonic() - started_at)
+        self.statuses[response.status_code] += 1
+
+
+def _bot_id(token: str) -> int:
+    bot_id, _, _ = token.partition(":")
+    return int(bot_id) if bot_id.isdigit() else abs(hash(token)) % 10**10
+
+
+def _chat_id(value: str) -> int:
+    # channels are also addressed by @username
+    if value.startswith("@"):
+        return -(int(hashlib.sha1(value.encode()).hexdigest()[:12], 16))
+    return int(value)
+
+
+def _reply_markup(params: dict[str, Any]) -> dict[str, Any]:
+    markup = params.get("reply_markup")
+    # only inline keyboards are a part of the message
+    if isinstance(markup, dict) and "inline_keyboard" in markup:
+        return {"reply_markup": markup}
+    return {}
+
+
+async def _read_params(request: Request) -> dict[str, Any]:
+    """
+    python-telegram-bot sends forms, JSON encoding the values that aren't strings,
+    and multipart forms with the uploaded files
+    """
+    content_type = request.headers.get("content-type", "")
+    body = await request.body()
+    if content_type.startswith("application/json"):
+        return dict(json.loads(body or b"{}"))
+
+    fields: dict[str, Any] = {}
+    files: dict[str, bytes] = {}
+    if content_type.startswith("multipart/form-data"):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            if not isinstance(name, str) or not isinstance(payload, bytes):
+                continue
+            if part.get_filename() is not None:
+                files[name] = payload
+            else:
+                fields[name] = payload.decode()
+    else:
+        fields = dict(parse_qsl(body.decode()))
+
+    params: dict[str, Any] = {}
+    for name, value in fields.items():
+        if value.startswith("attach://"):
+            params[name] = files.get(value.removeprefix("attach://"))
+        elif value[:1] in ("{", "["):
+            params[name] = json.loads(value)
+        else:
+            params[name] = value
+    for name, data in files.items():
+        params.setdefault(name, data)
+    return params
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument(
+        "--agents", type=int, default=20, help="users with an active agent"
+    )
+    parser.add_argument("--rate", type=float, default=5, help="updates per second")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument(
+        "--drain", type=float, default=60, help="seconds to wait for the replies"
+    )
+    parser.add_argument("--flood-rate", type=float, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    _quiet_logs()
+    emulator = TelegramEmulator(EmulatorConfig(flood_rate=args.flood_rate), args.seed)
+    server = uvicorn.Server(
+        uvicorn.Config(
+            emulator.app, host=args.host, port=args.port, log_level="warning"
+        )
+    )
+    serving = asyncio.create_task(server.serve())
+
+    engine = create_async_engine(settings.DATABASE_URL, "bench")
+    session_maker = create_session_maker(engine)
+    fixtures = await create_fixtures(session_maker, args.agents, jobs=1000)
+    try:
+        generator = UpdateGenerator(
+            emulator,
+            settings.TGBOT_TOKEN.get_secret_value(),
+            fixtures.tg_user_ids,
+            args.rate,
+            args.seed,
+        )
+        print(f"Waiting for the bot to set its webhook at {args.host}:{args.port}")
+        await generator.wait_for_webhook(timeout=300)
+        await generator.run(args.duration)
+        await asyncio.sleep(args.drain)
+    finally:
+        server.should_exit = True
+        await serving
+        await delete_fixtures(session_maker, fixtures)
+        await engine.dispose()
+
+    calls: dict[str, dict[int, int]] = {}
+    for (method, status), count in sorted(emulator.calls.items()):
+        calls.setdefault(method, {})[status] = count
+    report = json.dumps(
+        {
+            "config": emulator.config.model_dump(),
+            "rate": args.rate,
+            "duration": args.duration,
+            "updates": {
+                "statuses": dict(generator.statuses),
+                "webhook": percentiles(generator.latencies),
+            },
+            "first_reply": percentiles(emulator.reply_latencies),
+            "unanswered": sum(len(c.waiting_since) for c in emulator.chats.values()),
+            "api_calls": calls,
+            "rate_limited": sum(
+                count for (_, status), count in emulator.calls.items() if status == 429
+            ),
+        },
+        indent=2,
+    )
+    if args.output:
+        args.output.write_text(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+"""
+arq worker with the LLM, image, search and scraper providers replaced by bench.fakes
+
+    TGBOT_API_URL=http://localhost:8081 python -m bench.worker [--config fakes.json]
+
+Telegram calls stay real, point them to bench.telegram_emulator for load tests
+of the whole webhook -> handler -> worker -> send loop.
+"""
+
+import argparse
+from pathlib import Path
+
+from arq.worker import run_worker
+
+import app.worker  # registers the tasks
+from bench.fakes import FakeBackendsConfig, fake_backends
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--config", type=Path, help="JSON of bench.fakes.FakeBackendsConfig"
+    )
+    parser.add_argument("--latency-scale", type=float)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = (
+        FakeBackendsConfig.model_validate_json(args.config.read_text())
+        if args.config
+        else FakeBackendsConfig()
+    )
+    if args.latency_scale is not None:
+        config.latency_scale = args.latency_scale
+
+    with fake_backends(config, args.seed, telegram=False):
+        run_worker(app.worker.WorkerSettings)  # type: ignore[arg-type]
+
+
+if __name__ == "__main__":
+    main()
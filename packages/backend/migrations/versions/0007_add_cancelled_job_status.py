@@ -0,0 +1,37 @@
+"""add_cancelled_job_status
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2025-06-02 11:08:21.403512
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "0007"
+down_revision: Union[str, None] = "0006"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TYPE tg_agent_job_status ADD VALUE IF NOT EXISTS 'cancelled'")
+
+
+def downgrade() -> None:
+    # enum values can't be dropped, recreate the type without it
+    op.execute("UPDATE tg_agent_jobs SET status = 'failed' WHERE status = 'cancelled'")
+    op.execute("ALTER TYPE tg_agent_job_status RENAME TO tg_agent_job_status_old")
+    sa.Enum(
+        "initial", "in_progress", "completed", "failed", name="tg_agent_job_status"
+    ).create(op.get_bind())  # type: ignore[no-untyped-call]
+    op.execute(
+        "ALTER TABLE tg_agent_jobs ALTER COLUMN status TYPE tg_agent_job_status "
+        "USING status::text::tg_agent_job_status"
+    )
+    op.execute("DROP TYPE tg_agent_job_status_old")
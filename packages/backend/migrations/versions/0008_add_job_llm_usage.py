@@ -0,0 +1,39 @@
+"""add_job_llm_usage
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2025-06-04 10:12:37.512904
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+from alembic import op
+
+import app.models.base
+from app.tg.agents.models import LLMUsage
+
+# revision identifiers, used by Alembic.
+revision: str = "0008"
+down_revision: Union[str, None] = "0007"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tg_agent_jobs",
+        sa.Column(
+            "llm_usage",
+            app.models.base.PydanticJSON(
+                LLMUsage, none_as_null=True, astext_type=sa.Text()
+            ),
+            nullable=True,
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("tg_agent_jobs", "llm_usage")
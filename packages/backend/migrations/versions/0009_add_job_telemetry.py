@@ -0,0 +1,39 @@
+"""add_job_telemetry
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+from alembic import op
+
+import app.models.base
+from app.core.telemetry import JobTelemetry
+
+# revision identifiers, used by Alembic.
+revision: str = "0009"
+down_revision: Union[str, None] = "0008"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "tg_agent_jobs",
+        sa.Column(
+            "telemetry",
+            app.models.base.PydanticJSON(
+                JobTelemetry, none_as_null=True, astext_type=sa.Text()
+            ),
+            nullable=True,
+        ),
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("tg_agent_jobs", "telemetry")
@@ -0,0 +1,84 @@
+import asyncio
+import unittest
+from typing import Any, cast
+
+from redis.asyncio import Redis
+
+from app.core.circuit_breaker import CircuitBreaker, CircuitState
+
+
+class FakeRedis:
+    """
+    The commands the breaker uses, without expiration
+    """
+
+    def __init__(self) -> None:
+        self.data: dict[str, Any] = {}
+
+    async def mget(self, *keys: str) -> list[Any]:
+        return [self.data.get(key) for key in keys]
+
+    async def set(self, key: str, value: Any, *, nx: bool = False, **_: Any) -> bool:
+        if nx and key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def pipeline(self, **_: Any) -> "FakePipeline":
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis) -> None:
+        self.redis = redis
+        self.commands: list[Any] = []
+
+    async def __aenter__(self) -> "FakePipeline":
+        return self
+
+    async def __aexit__(self, *_: object) -> None: ...
+
+    def set(self, *args: Any, **kwargs: Any) -> None:
+        self.commands.append(self.redis.set(*args, **kwargs))
+
+    def delete(self, *keys: str) -> None:
+        self.commands.append(self.redis.delete(*keys))
+
+    async def execute(self) -> list[Any]:
+        return [await command for command in self.commands]
+
+
+class CircuitBreakerProbeTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.redis = FakeRedis()
+        self.breaker = CircuitBreaker("test", redis=cast(Redis, self.redis))
+        await self.breaker._open()
+        # as if open_seconds passed
+        await self.redis.delete("viralink:breaker:test:open")
+
+    async def test_cancelled_probe_keeps_half_open(self) -> None:
+        started = asyncio.Event()
+
+        async def hanging() -> None:
+            started.set()
+            await asyncio.sleep(60)
+
+        probe = asyncio.create_task(self.breaker.call(hanging))
+        await started.wait()
+        probe.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await probe
+
+        # neither closed nor opened, and the next caller may probe
+        self.assertEqual(await self.breaker.state(), CircuitState.HALF_OPEN)
+        self.assertTrue(await self.breaker._take_probe())
+
+    async def test_successful_probe_closes(self) -> None:
+        async def ok() -> int:
+            return 1
+
+        self.assertEqual(await self.breaker.call(ok), 1)
+        self.assertEqual(await self.breaker.state(), CircuitState.CLOSED)